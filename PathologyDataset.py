@@ -2,71 +2,205 @@ from __future__ import print_function, division
 import os
 import torch
 import numpy as np
-import pandas as pd
 
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.data import sampler
-from torchvision import transforms, utils, models
 from PIL import Image
 
+import resnet_helper as H
+import decode
 
 
-import pdb
+def _default_transform(name):
+	# torchvision is imported on first use, so importing the datasets stays cheap
+	from torchvision import transforms
+	return getattr(transforms, name)()
+
+
+class PackedStrings(object):
+	"""Immutable array of strings packed as one UTF-8 byte buffer plus offsets
+
+	Both live in shared memory (torch storage), so forked or spawned DataLoader workers read the
+	same pages: unlike an object array of Python strings, indexing touches no per-string refcounts
+	and never triggers copy-on-write.
+	"""
+	def __init__(self, buffer, offsets):
+		"""
+		Args:
+			buffer: uint8 array, the concatenated UTF-8 encoded strings
+			offsets: int64 array [len+1], string i is buffer[offsets[i]:offsets[i+1]]
+		"""
+		self._buffer = torch.as_tensor(np.asarray(buffer, dtype = np.uint8)).share_memory_()
+		self._offsets = torch.as_tensor(np.asarray(offsets, dtype = np.int64)).share_memory_()
+		self.buffer = self._buffer.numpy()
+		self.offsets = self._offsets.numpy()
+
+	@classmethod
+	def from_strings(cls, strings):
+		""" packs a sequence of str (vectorized: one join, one encode and one scan for the separators) """
+		if len(strings) == 0:
+			return cls(np.zeros(0, dtype = np.uint8), np.zeros(1, dtype = np.int64))
+		# NUL cannot appear in the file paths, it separates the strings while locating the offsets
+		packed = np.frombuffer(('\0'.join(strings) + '\0').encode('utf-8'), dtype = np.uint8)
+		ends = np.flatnonzero(packed == 0)
+		starts = np.concatenate([[0], ends[:-1] + 1])
+		keep = np.ones(len(packed), dtype = bool)
+		keep[ends] = False
+		offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+		return cls(packed[keep], offsets)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, idx):
+		if isinstance(idx, (int, np.integer)):
+			if idx < 0:
+				idx += len(self)
+			return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+		# slices, boolean masks and index arrays are resolved to rows without touching the other strings
+		if isinstance(idx, slice):
+			rows = np.arange(*idx.indices(len(self)))
+		else:
+			rows = np.asarray(idx)
+			if rows.dtype == bool:
+				rows = np.flatnonzero(rows)
+			rows = np.where(rows < 0, rows + len(self), rows).astype(np.int64)
+		starts, ends = self.offsets[rows], self.offsets[rows + 1]
+		return np.array([self.buffer[s:e].tobytes().decode('utf-8') for s, e in zip(starts, ends)])
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def __array__(self, dtype = None):
+		# decodes every string, index with the rows that are needed instead (self[indices])
+		return np.array(list(self), dtype = dtype)
+
+	def copy(self):
+		# immutable, copies share the buffers
+		return self
+
+	def __getstate__(self):
+		# only the shared tensors travel to spawned workers (by handle), the numpy views are rebuilt
+		return {'_buffer': self._buffer, '_offsets': self._offsets}
+
+	def __setstate__(self, state):
+		self._buffer, self._offsets = state['_buffer'], state['_offsets']
+		self.buffer = self._buffer.numpy()
+		self.offsets = self._offsets.numpy()
+
+
+def read_manifest(csv_file, shuffle = False, seed = 7, class_to_label = None):
+	"""
+	Reads a ground truth csv of (image file, class) rows, without a Python loop over the rows
+
+	Args:
+		shuffle (boolean): shuffle rows within each class, keeping each class's row positions
+		seed (int): random seed for shuffling the data
+	Returns:
+		PackedStrings of 'class/file' ids, int32 labels (in shared memory)
+	"""
+	import pandas as pd
+	if class_to_label is None:
+		class_to_label = {'Normal':0, 'Benign':1, "InSitu":2, 'Invasive':3}
+	print('Class to label dictionary map: ')
+	print(class_to_label)
+	data = pd.read_csv(csv_file, header = None, dtype = object, usecols = [0, 1], keep_default_na = False)
+	labels = data[1].map(class_to_label)
+	if labels.isnull().any():
+		raise KeyError('Unknown class %s in %s' % (data[1][labels.isnull()].iloc[0], csv_file))
+	labels = labels.values.astype(np.int32)
+	ids = data[1].values + '/' + data[0].values
+	if shuffle:
+		# enforce seeding and shuffle rows within each class, keeping each class's row positions
+		keys = np.random.RandomState(seed).random_sample(len(labels))
+		order = np.empty(len(labels), dtype = np.int64)
+		order[np.argsort(labels, kind = 'stable')] = np.lexsort((keys, labels))
+		ids, labels = ids[order], labels[order]
+
+	ids = PackedStrings.from_strings(ids)
+	return ids, torch.from_numpy(labels).share_memory_().numpy()
 
 
-import nets 
 class PathologyDataset(Dataset):
 	"""Pathology dataset"""
-	def __init__(self, img_dir, csv_file = 'microscopy_ground_truth.csv', transform=transforms.ToTensor(), shuffle = False, seed = 7):
+	def __init__(self, img_dir, csv_file = 'microscopy_ground_truth.csv', transform=None, shuffle = False, seed = 7, decode_size = None):
 		"""
 		Args:
 			csv_file (string): Path to the csv file with annotations.
 			root_dir (string): Directory with all the images.
-			transform (callable, optional): Optional transform to be applied on a sample
+			transform (callable, optional): Optional transform to be applied on a sample, defaults to transforms.ToTensor()
 			shuffle (boolean): Whether to shuffle
 			seed (int): random seed for shuffling the data
+			decode_size (tuple, optional): (height, width) to decode the images to, at reduced resolution
+				when the transform only needs a downsampled image (see decode.open_image), None decodes in full
 		"""
-		data = pd.read_csv(os.path.join(img_dir, "microscopy_ground_truth.csv"), header = None).values
 		self.shuffle = shuffle
-		#shuffle data
-		if self.shuffle:
-			for c in range(4):
-				# enforce seeding and shuffle for each class
-				np.random.seed(seed)
-				np.random.shuffle(data[0 + c*100:100 + c*100, :])
-
-
-
-		img_ids = data[:,0]
-		img_classes = data[:,1]
-		img_labels = np.zeros((len(img_classes),), dtype=np.int32)
-		class_to_label = {'Normal':0, 'Benign':1, "InSitu":2, 'Invasive':3}
-		print('Class to label dictionary map: ')
-		print(class_to_label)     
-
-		for i in range(len(img_ids)):
-			img_ids[i] = str(img_classes[i])+'/'+img_ids[i]
-			#map from string class names to integer labels
-			img_labels[i] = class_to_label[str(img_classes[i])]
-
-		self.img_ids = img_ids
-		self.img_labels = img_labels
+		self.img_ids, self.img_labels = read_manifest(os.path.join(img_dir, csv_file), shuffle = shuffle, seed = seed)
 		self.img_dir = img_dir
-		self.transform = transform
+		self.transform = transform if transform is not None else _default_transform('ToTensor')
+		self.decode_size = decode_size
 
 	def __len__(self):
 		return len(self.img_ids)
 
+	def image_size(self, idx = 0):
+		""" (height, width) of image idx as the dataset decodes it, read from the file header """
+		if self.decode_size is not None:
+			return tuple(self.decode_size)
+		return decode.image_size(os.path.join(self.img_dir, self.img_ids[idx]))
+
 	def __getitem__(self, idx):
 		img_name = os.path.join(self.img_dir,
 								self.img_ids[idx])
 		
-		img = Image.open(img_name, mode='r')
+		if self.decode_size is not None:
+			img = decode.open_image(img_name, self.decode_size)
+		else:
+			img = Image.open(img_name, mode='r')
 		label = self.img_labels[idx]
 		
 		if self.transform:
 			img = self.transform(img)
 
 		return img, label
-  
 
+
+class TiledPathologyDataset(PathologyDataset):
+	"""Pathology dataset yielding pre-cut uint8 tiles, so tiling runs in the DataLoader workers
+
+	Use with resnet_helper.collate_tiles, the model normalizes the tiles on device.
+	"""
+	def __init__(self, img_dir, csv_file = 'microscopy_ground_truth.csv', transform=None, shuffle = False, seed = 7, res = [0,1,2], fine_tiles = None, spec = None):
+		"""
+		Args:
+			csv_file (string): Path to the csv file with annotations.
+			root_dir (string): Directory with all the images.
+			transform (callable, optional): Optional transform to be applied on a sample, must return a uint8 tensor, defaults to transforms.PILToTensor()
+			shuffle (boolean): Whether to shuffle
+			seed (int): random seed for shuffling the data
+			res (list): resolutions used in tiling, 0 is coarse (1 tile), 1 is medium (12 tiles), 2 is fine (234 tiles)
+			fine_tiles (int, optional): number of fine tiles randomly sampled per image on every access, None keeps all
+			spec (TilingSpec, optional): tiling geometry, defaults to resnet_helper.default_spec()
+		"""
+		if transform is None:
+			transform = _default_transform('PILToTensor')
+		super(TiledPathologyDataset, self).__init__(img_dir, csv_file = csv_file, transform = transform, shuffle = shuffle, seed = seed)
+		self.res = res
+		self.fine_tiles = fine_tiles
+		self.spec = spec if spec is not None else H.default_spec()
+
+	def __getitem__(self, idx):
+		img, label = super(TiledPathologyDataset, self).__getitem__(idx)
+		tiles, levels = H.tile_image_uint8(img, self.res, spec = self.spec)
+
+		# the finest level is the last level of the spec
+		finest = len(self.spec.levels) - 1
+		if self.fine_tiles is not None and finest in self.res:
+			fine = (levels == self.res.index(finest)).nonzero().view(-1)
+			if self.fine_tiles < fine.numel():
+				keep = fine[torch.randperm(fine.numel())[:self.fine_tiles]]
+				keep = torch.cat([(levels != self.res.index(finest)).nonzero().view(-1), keep.sort()[0]])
+				tiles, levels = tiles[keep], levels[keep]
+
+		return tiles, levels, label
@@ -0,0 +1,178 @@
+from __future__ import print_function, division
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+
+from torch.utils.data import Dataset, DataLoader
+
+import resnet_helper as H
+from embeddings import tile_metadata
+
+
+def data_digest(image_ids, labels):
+	""" sha256 of the ordered image ids and labels, a changed csv or shuffle gives a different digest """
+	digest = hashlib.sha256()
+	digest.update('\n'.join(str(i) for i in image_ids).encode('utf-8'))
+	digest.update(np.asarray(labels, dtype = np.int64).tobytes())
+	return digest.hexdigest()
+
+
+def stage_digest(model, stage):
+	""" sha256 of the parameters and buffers of conv1..stage of a ResNet_Tiling, the part of the trunk that is cached """
+	modules = ['conv1', 'bn1'] + model.trunk_stages[1:model.trunk_stages.index(stage) + 1]
+	digest = hashlib.sha256()
+	for name, value in sorted(model.state_dict().items()):
+		if name.split('.')[0] in modules:
+			digest.update(name.encode('utf-8'))
+			digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+	return digest.hexdigest()
+
+
+class ActivationStore(object):
+	"""Float16 memory-mapped store of intermediate trunk activations (e.g. layer3) of every tile
+
+	Layout of the store directory:
+		meta.json: stage, activation shape, resolutions, tiling and the digests of the images and cached stages
+		activations.f16: [num_tiles, C, h, w] activations
+		tile_meta.npy: image, level, row, col of every tile
+		image_ids.npy, labels.npy: id and label of every image
+	"""
+	def __init__(self, path, mode = 'r'):
+		with open(os.path.join(path, 'meta.json')) as f:
+			self.meta = json.load(f)
+		self.path = path
+		self.res = self.meta['res']
+		self.stage = self.meta['stage']
+		self.activations = np.memmap(os.path.join(path, 'activations.f16'), dtype = np.float16, mode = mode,
+									 shape = tuple([self.meta['num_tiles']] + self.meta['shape']))
+		self.tile_meta = np.load(os.path.join(path, 'tile_meta.npy'), mmap_mode = 'r')
+		self.image_ids = np.load(os.path.join(path, 'image_ids.npy'), allow_pickle = True)
+		self.labels = np.load(os.path.join(path, 'labels.npy'))
+		self.tiles_per_image = self.meta['num_tiles'] // self.meta['num_images']
+
+	@classmethod
+	def create(cls, path, image_ids, labels, res, stage, shape, image_size, spec = None, trunk_digest = None):
+		if not os.path.exists(path):
+			os.makedirs(path)
+		tile_meta = tile_metadata(len(image_ids), res, image_size, spec)
+		meta = {'num_tiles': int(tile_meta.size), 'num_images': int(len(image_ids)), 'res': list(res), 'stage': stage,
+				'shape': list(shape), 'spec': repr(spec if spec is not None else H.default_spec()), 'image_size': list(image_size),
+				'data_digest': data_digest(image_ids, labels), 'trunk_digest': trunk_digest, 'complete': False}
+		np.save(os.path.join(path, 'tile_meta.npy'), tile_meta)
+		np.save(os.path.join(path, 'image_ids.npy'), np.asarray(image_ids).astype(str))
+		np.save(os.path.join(path, 'labels.npy'), np.asarray(labels, dtype = np.int64))
+		np.memmap(os.path.join(path, 'activations.f16'), dtype = np.float16, mode = 'w+', shape = tuple([tile_meta.size] + list(shape))).flush()
+		with open(os.path.join(path, 'meta.json'), 'w') as f:
+			json.dump(meta, f, indent = 1)
+		return cls(path, mode = 'r+')
+
+	def mark_complete(self):
+		self.activations.flush()
+		self.meta['complete'] = True
+		with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+			json.dump(self.meta, f, indent = 1)
+
+	@staticmethod
+	def is_complete(path, res = None, stage = None, spec = None, image_size = None, num_images = None, data_digest = None,
+					trunk_digest = None):
+		"""
+		Whether path holds a complete store, exported with the given settings (those not None)
+
+		data_digest and trunk_digest (see data_digest and stage_digest) tell a store of other images,
+		labels or order, or of other trunk weights, apart from one with the same sizes.
+		"""
+		if not os.path.exists(os.path.join(path, 'meta.json')):
+			return False
+		with open(os.path.join(path, 'meta.json')) as f:
+			meta = json.load(f)
+		expected = {'res': list(res) if res is not None else None, 'stage': stage, 'spec': repr(spec) if spec is not None else None,
+					'image_size': list(image_size) if image_size is not None else None, 'num_images': num_images,
+					'data_digest': data_digest, 'trunk_digest': trunk_digest}
+		return meta.get('complete', False) and all(meta.get(k) == v for k, v in expected.items() if v is not None)
+
+
+def export_activations(model, dataset, path, stage = 'layer3', batch_size = 2, num_workers = 4, device = torch.device('cpu'),
+					   image_size = None):
+	"""
+	Runs the frozen part of the trunk (conv1..stage) once over every tile of a dataset
+
+	Args:
+		model: ResNet_Tiling
+		dataset: TiledPathologyDataset without augmentation, shuffle or tile sampling
+		path: store directory
+		image_size: (height, width) of every image, defaults to dataset.image_size()
+	Returns:
+		ActivationStore
+	Raises:
+		ValueError if an image does not have the tiles of image_size
+	"""
+	if dataset.fine_tiles is not None:
+		raise ValueError('The activation cache needs every tile, got fine_tiles=%d' % dataset.fine_tiles)
+	if image_size is None:
+		image_size = dataset.image_size()
+	model = model.to(device = device).eval()
+	with torch.no_grad():
+		probe = model.trunk_until(torch.zeros(1, 3, 224, 224, device = device), stage)
+	store = ActivationStore.create(path, dataset.img_ids, dataset.img_labels, model.res, stage, probe.shape[1:], image_size,
+								   spec = model.spec, trunk_digest = stage_digest(model, stage))
+
+	loader = DataLoader(dataset, batch_size = batch_size, shuffle = False, num_workers = num_workers, collate_fn = H.collate_tiles)
+	row = 0
+	with torch.no_grad():
+		for (tiles, levels, image_index), _ in loader:
+			counts = torch.bincount(image_index)
+			wrong = (counts != store.tiles_per_image).nonzero().view(-1)
+			if wrong.numel():
+				first = int(wrong[0])
+				raise ValueError('Image %s has %d tiles, %d expected for size %s' % (dataset.img_ids[row // store.tiles_per_image + first],
+								 int(counts[first]), store.tiles_per_image, tuple(image_size)))
+			x = H.normalize_tiles_uint8(tiles.to(device = device), dtype = model.conv1.weight.dtype)
+			x = model.trunk_until(x, stage)
+			store.activations[row:row + x.shape[0]] = x.cpu().numpy()
+			row += x.shape[0]
+	if row != store.meta['num_tiles']:
+		raise ValueError('Exported %d tiles, the store has %d' % (row, store.meta['num_tiles']))
+	store.mark_complete()
+	return store
+
+
+class CachedActivationDataset(Dataset):
+	"""Images as cached activations of all their tiles, (activations, levels, label) for collate_tiles
+
+	There is no augmentation: the activations of a flipped image are not the flipped feature maps
+	of the cached tiles, training from the cache runs without the random flips.
+	"""
+	def __init__(self, store):
+		self.store = store
+		self.img_ids = store.image_ids
+		self.img_labels = store.labels
+		per_image = store.tile_meta[:store.tiles_per_image]['level']
+		self.levels = torch.as_tensor([store.res.index(l) for l in per_image], dtype = torch.long)
+
+	def __len__(self):
+		return len(self.img_labels)
+
+	def __getitem__(self, idx):
+		rows = slice(idx * self.store.tiles_per_image, (idx + 1) * self.store.tiles_per_image)
+		x = torch.from_numpy(np.array(self.store.activations[rows]))
+		return x, self.levels, self.img_labels[idx]
+
+
+class CachedStageModel(nn.Module):
+	"""ResNet_Tiling running from cached activations of a trunk stage, so only the later stages and fc1 run
+
+	The wrapped model is unchanged, save model.model.state_dict() for a normal checkpoint.
+	"""
+	def __init__(self, model, stage = 'layer3'):
+		super(CachedStageModel, self).__init__()
+		self.model = model
+		self.stage = stage
+
+	def forward(self, x):
+		activations, levels, image_index = x
+		num_images = int(image_index[-1]) + 1
+		x = self.model.trunk_from(activations.to(dtype = self.model.conv1.weight.dtype), self.stage)
+		return self.model.head(x, levels, image_index, num_images)
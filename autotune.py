@@ -0,0 +1,176 @@
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import hashlib
+import platform
+import argparse
+import subprocess
+import numpy as np
+import torch
+
+# tuned profiles of every host, keyed by host_key()
+profile_file = os.environ.get('PATH_AUTOTUNE_FILE', os.path.join(os.path.expanduser('~'), '.path_pytorch_autotune.json'))
+
+# intra-op and inter-op threads are fixed once a process has run parallel work, every setting runs in a fresh interpreter
+_trunk_probe = """
+import sys, json, torch
+settings = json.loads(sys.argv[1])
+if settings['threads'] is not None:
+	torch.set_num_threads(settings['threads'])
+if settings['interop'] is not None:
+	torch.set_num_interop_threads(settings['interop'])
+import resnet, distill
+model = resnet.resnet50_tiling_1fc(num_classes = 4)
+print(json.dumps(dict((b, distill.trunk_throughput(model, batch_size = b, iters = settings['iters'])) for b in settings['batches'])))
+"""
+
+
+def host_key():
+	""" hostname, CPU model and count, GPU and torch version: a profile is only reused on the same hardware and build """
+	cpu = platform.processor()
+	if os.path.exists('/proc/cpuinfo'):
+		with open('/proc/cpuinfo') as f:
+			names = [line.split(':', 1)[1].strip() for line in f if line.startswith('model name')]
+		cpu = names[0] if names else cpu
+	gpu = torch.cuda.get_device_name(0) if torch.cuda.is_available() else ''
+	digest = hashlib.sha256(json.dumps([cpu, os.cpu_count(), gpu, torch.__version__]).encode('utf-8')).hexdigest()
+	return '%s-%s' % (platform.node(), digest[:12])
+
+
+def benchmark_trunk(threads = None, interop = None, batches = [16, 32, 64], iters = 3):
+	"""
+	Tiles per second of the ResNet-50 tiling trunk for every trunk batch size, with the given thread counts
+
+	Returns:
+		{trunk batch: tiles/s}
+	"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	settings = {'threads': threads, 'interop': interop, 'iters': iters, 'batches': list(batches)}
+	out = subprocess.check_output([sys.executable, '-c', _trunk_probe, json.dumps(settings)], cwd = here)
+	return dict((int(b), v) for b, v in json.loads(out.decode('utf-8').strip().splitlines()[-1]).items())
+
+
+def benchmark_loader(img_dir, workers = [0, 1, 2, 4], num_images = 32, decode_size = None):
+	"""
+	Images per second of the training DataLoader (decoding and transforms) for every worker count
+
+	Returns:
+		{num_workers: images/s}
+	"""
+	import transformations
+	from torch.utils.data import DataLoader, Subset
+	from PathologyDataset import PathologyDataset
+	dataset = PathologyDataset(img_dir, transform = transformations.tiling_train(), decode_size = decode_size)
+	subset = Subset(dataset, np.arange(min(num_images, len(dataset))))
+	rates = {}
+	for w in workers:
+		loader = DataLoader(subset, batch_size = 4, num_workers = w)
+		start = time.time()
+		for _ in loader:
+			pass
+		rates[w] = len(subset) / (time.time() - start)
+	return rates
+
+
+def tune(img_dir = None, threads = None, interops = [1, 2], batches = [16, 32, 64], workers = None, tiles_per_image = 247, iters = 3):
+	"""
+	Benchmarks the grid on this host and returns the best profile
+
+	The trunk setting is the fastest (threads, inter-op threads, trunk batch). The DataLoader gets the
+	fewest workers that load images at least 1.2x as fast as the tuned trunk consumes them (tiles_per_image
+	tiles per image), or the fastest worker count, so the workers do not take cores from the trunk.
+	"""
+	cpus = os.cpu_count() or 1
+	if threads is None:
+		threads = sorted(set([1, 2, 4, 8, 16, 32, cpus, max(cpus // 2, 1)]) & set(range(1, cpus + 1)))
+	if workers is None:
+		workers = sorted(set([0, 1, 2, 4, 8, cpus]) & set(range(0, cpus + 1)))
+
+	default = max(benchmark_trunk(batches = batches, iters = iters).values())
+	results = []
+	for t in threads:
+		for i in interops:
+			for b, rate in benchmark_trunk(t, i, batches, iters).items():
+				results.append({'num_threads': t, 'num_interop_threads': i, 'trunk_batch': b, 'tiles_per_second': rate})
+				print('threads %2d, inter-op %d, trunk batch %3d: %.1f tiles/s' % (t, i, b, rate))
+	best = max(results, key = lambda r: r['tiles_per_second'])
+	profile = dict(best, host = host_key(), default_tiles_per_second = default, tuned = time.strftime('%Y-%m-%d %H:%M:%S'))
+
+	profile['num_workers'] = None
+	if img_dir is not None:
+		rates = benchmark_loader(img_dir, workers)
+		for w in sorted(rates):
+			print('%d DataLoader workers: %.2f images/s' % (w, rates[w]))
+		needed = 1.2 * best['tiles_per_second'] / tiles_per_image
+		enough = [w for w in sorted(rates) if rates[w] >= needed]
+		profile['num_workers'] = enough[0] if enough else max(rates, key = rates.get)
+		profile['images_per_second'] = rates[profile['num_workers']]
+	return profile
+
+
+def save_profile(profile, filename = None):
+	filename = filename or profile_file
+	profiles = {}
+	if os.path.exists(filename):
+		with open(filename) as f:
+			profiles = json.load(f)
+	profiles[profile['host']] = profile
+	with open(filename + '.tmp', 'w') as f:
+		json.dump(profiles, f, indent = 1)
+	os.rename(filename + '.tmp', filename)
+
+
+def load_profile(filename = None):
+	""" the tuned profile of this host, None if it was never tuned """
+	filename = filename or profile_file
+	if not os.path.exists(filename):
+		return None
+	with open(filename) as f:
+		return json.load(f).get(host_key())
+
+
+def apply(profile = None):
+	"""
+	Sets torch intra-op / inter-op threads from the profile of this host (loaded if not given)
+
+	Call before any parallel work, inter-op threads cannot change afterwards. The caller applies
+	num_workers and trunk_batch to its loaders and models.
+
+	Returns:
+		the profile, or None if this host has none
+	"""
+	if profile is None:
+		profile = load_profile()
+	if profile is None:
+		return None
+	torch.set_num_threads(profile['num_threads'])
+	try:
+		torch.set_num_interop_threads(profile['num_interop_threads'])
+	except RuntimeError:
+		print('inter-op threads already in use, keeping %d' % torch.get_num_interop_threads())
+	return profile
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Benchmarks thread counts, trunk batch size and DataLoader workers and saves the best profile of this host')
+	parser.add_argument('--img_dir', default = None, help = 'dataset directory for the DataLoader benchmark')
+	parser.add_argument('--threads', type = int, nargs = '+', default = None)
+	parser.add_argument('--interop', type = int, nargs = '+', default = [1, 2])
+	parser.add_argument('--batches', type = int, nargs = '+', default = [16, 32, 64])
+	parser.add_argument('--workers', type = int, nargs = '+', default = None)
+	parser.add_argument('--iters', type = int, default = 3)
+	parser.add_argument('--profile_file', default = profile_file)
+	args = parser.parse_args()
+
+	profile = tune(args.img_dir, args.threads, args.interop, args.batches, args.workers, iters = args.iters)
+	save_profile(profile, args.profile_file)
+	print('best: %d threads, %d inter-op, trunk batch %d, %.1f tiles/s (%.2fx the defaults), %s DataLoader workers' % (
+		profile['num_threads'], profile['num_interop_threads'], profile['trunk_batch'], profile['tiles_per_second'],
+		profile['tiles_per_second'] / profile['default_tiles_per_second'], profile['num_workers']))
+	print('saved to %s under %s' % (args.profile_file, profile['host']))
+
+
+if __name__ == '__main__':
+	main()
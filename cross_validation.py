@@ -1,5 +1,5 @@
+import os
 import numpy as np
-import pdb
 
 # Developer: Alejandro Debus
 # Email: aledebus@gmail.com
@@ -45,44 +45,160 @@ def k_folds(n_splits = 10, samples = 400):
         train_idx = np.setdiff1d(indices, test_idx)
         yield train_idx, test_idx
 
-def k_folds_2(n_splits = 10, samples = 400, num_classes = 4, monte_carlo = False):
-    indices = np.arange(samples).astype(int)
-    for test_idx in get_indices_2(n_splits, samples, num_classes, monte_carlo = monte_carlo):
-        train_idx = np.setdiff1d(indices, test_idx)
-        yield train_idx, test_idx
-
-def get_indices_2(n_splits = 10, samples = 400, num_classes = 4, monte_carlo = False):
-    # using n_splits = 10 as example
-    if monte_carlo:
-        subfold_sizes = int(samples*0.1/num_classes) #400/10/4 = 10 
+def _class_ranks(labels, keys = None):
+    '''
+    Orders samples by class and computes the rank of each sample within its class
+    Args:
+        labels: integer label of every sample
+        keys: optional sort keys to order samples within a class (defaults to original order)
+    Returns:
+        order: sample indices grouped by class
+        rank: rank of order[i] within its class
+        count: size of the class of order[i]
+    '''
+    if keys is None:
+        order = np.argsort(labels, kind = 'stable')
     else:
-        subfold_sizes = int(samples/n)
-    
-    samples_per_class = int(samples/n_splits/num_classes) #400/4 = 100
-    
-    indices = np.arange(samples).astype(int)
-    current = 0
-    
+        order = np.lexsort((keys, labels))
+    sorted_labels = labels[order]
+    start = np.searchsorted(sorted_labels, sorted_labels, side = 'left')
+    stop = np.searchsorted(sorted_labels, sorted_labels, side = 'right')
+    rank = np.arange(len(labels)) - start
+    return order, rank, stop - start
+
+def stratified_fold_assignments(labels, n_splits = 10, seed = None):
+    '''
+    Assigns every sample to one of n_splits folds, keeping class proportions in each fold
+    Args:
+        labels: integer label of every sample
+        n_splits: folds number
+        seed: random seed used to shuffle samples within each class, None keeps the original order
+    Returns:
+        folds: fold id of every sample, shape [samples]
+    '''
+    labels = np.asarray(labels)
+    keys = None
+    if seed is not None:
+        keys = np.random.RandomState(seed).random_sample(len(labels))
+    order, rank, count = _class_ranks(labels, keys)
+    # contiguous blocks of each class go to consecutive folds, sizes differ by at most one
+    folds = np.empty(len(labels), dtype = np.int32)
+    folds[order] = rank * n_splits // count
+    return folds
+
+def monte_carlo_test_masks(labels, n_splits = 10, test_size = 0.1, seed = None):
+    '''
+    Draws n_splits independent stratified test sets
+    Args:
+        labels: integer label of every sample
+        n_splits: number of random splits
+        test_size: fraction of every class held out for testing
+        seed: random seed
+    Returns:
+        masks: boolean test membership, shape [n_splits, samples]
+    '''
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    masks = np.zeros((n_splits, len(labels)), dtype = bool)
     for i in range(n_splits):
-        idx = np.empty((0,)).astype(int)
-
-        if monte_carlo:
-            for c in range(num_classes):
-                idx = np.append(idx, np.random.choice(indices[int(c*samples_per_class):int((c+1)*samples_per_class)], subfold_sizes, replace = False))
-
-            yield idx
-        
-        else: 
-            start = current #0, 10, 20, 30, 40, 50, 60, 70, 80, 90
-            stop =  current + subfold_sizes #10, 20, 30, 40, 50, 60, 70, 80, 90, 100
-            current = stop 
-            for c in range(num_classes): #0, 1, 2, 3
-                idx = np.append(idx, indices[int(start+c*samples_per_class):int(stop+c*samples_per_class)])
-                #0:10, 100:110, 200:210, 300:310
-                #10:20, 110:120, 210:220, 310:320
-                #...
-                #90:100, 190:200, 290:300, 390:400
-            yield idx
+        order, rank, count = _class_ranks(labels, rng.random_sample(len(labels)))
+        masks[i, order] = rank < np.maximum(np.round(count * test_size), 1)
+    return masks
+
+def stratified_test_masks(labels, n_splits = 10, seed = None, monte_carlo = False, test_size = 0.1):
+    '''
+    Test membership of every sample for every split
+    Args:
+        labels: integer label of every sample
+        n_splits: folds number
+        seed: random seed, None keeps the original order (k-fold only)
+        monte_carlo: draw independent random test sets instead of disjoint folds
+        test_size: fraction of every class held out for testing (monte carlo only)
+    Returns:
+        masks: boolean test membership, shape [n_splits, samples]
+    '''
+    if monte_carlo:
+        return monte_carlo_test_masks(labels, n_splits, test_size, seed)
+    folds = stratified_fold_assignments(labels, n_splits, seed)
+    return folds[None, :] == np.arange(n_splits)[:, None]
+
+def _masks_to_folds(masks):
+    indices = np.arange(masks.shape[1])
+    for mask in masks:
+        yield indices[~mask], indices[mask]
+
+def stratified_k_folds(labels, n_splits = 10, seed = None, monte_carlo = False, test_size = 0.1):
+    '''
+    Generates stratified folds for cross validation from the actual labels
+    Args:
+        labels: integer label of every sample
+        n_splits: folds number
+        seed: random seed, None keeps the original order (k-fold only)
+        monte_carlo: draw independent random test sets instead of disjoint folds
+        test_size: fraction of every class held out for testing (monte carlo only)
+    '''
+    return _masks_to_folds(stratified_test_masks(labels, n_splits, seed, monte_carlo, test_size))
+
+def load_folds(filename, labels, n_splits = 10, seed = 7, monte_carlo = False, test_size = 0.1):
+    '''
+    Generates stratified folds, persisting the assignment so all workers and reruns use identical splits
+
+    The fold file is reused as long as it was built from the same labels and settings, otherwise
+    it is regenerated. Writes go through a temporary file so concurrent readers never see a partial file.
+    Args:
+        filename: path of the fold file (.npz)
+        labels: integer label of every sample
+        n_splits: folds number
+        seed: random seed
+        monte_carlo: draw independent random test sets instead of disjoint folds
+        test_size: fraction of every class held out for testing (monte carlo only)
+    '''
+    labels = np.asarray(labels)
+    settings = np.array([n_splits, -1 if seed is None else seed, int(monte_carlo), test_size], dtype = np.float64)
+    if os.path.exists(filename):
+        with np.load(filename) as f:
+            if np.array_equal(f['labels'], labels) and np.array_equal(f['settings'], settings):
+                masks = np.unpackbits(f['masks'], axis = 1, count = len(labels)).astype(bool)
+                return _masks_to_folds(masks)
+
+    masks = stratified_test_masks(labels, n_splits, seed, monte_carlo, test_size)
+    tmp = '%s.%d.tmp.npz' % (os.path.splitext(filename)[0], os.getpid())
+    np.savez_compressed(tmp, labels = labels, settings = settings, masks = np.packbits(masks, axis = 1))
+    os.replace(tmp, filename)
+    return _masks_to_folds(masks)
+
+def _block_labels(samples, num_classes):
+    # datasets laid out as contiguous equally sized class blocks
+    return np.repeat(np.arange(num_classes), int(samples/num_classes))
+
+def k_folds_2(n_splits = 10, samples = 400, num_classes = 4, monte_carlo = False, labels = None, seed = None):
+    '''
+    Generates stratified folds for cross validation
+    Args:
+        n_splits: folds number
+        samples: number of samples, ignored when labels are given
+        num_classes: number of classes, ignored when labels are given
+        monte_carlo: draw independent random test sets instead of disjoint folds
+        labels: integer label of every sample, defaults to contiguous equally sized class blocks
+        seed: random seed
+    '''
+    if labels is None:
+        labels = _block_labels(samples, num_classes)
+    return stratified_k_folds(labels, n_splits, seed = seed, monte_carlo = monte_carlo)
+
+def get_indices_2(n_splits = 10, samples = 400, num_classes = 4, monte_carlo = False, labels = None, seed = None):
+    '''
+    Indices of the stratified test sets
+    Args:
+        n_splits: folds number
+        samples: number of samples, ignored when labels are given
+        num_classes: number of classes, ignored when labels are given
+        monte_carlo: draw independent random test sets instead of disjoint folds
+        labels: integer label of every sample, defaults to contiguous equally sized class blocks
+        seed: random seed
+    '''
+    for _, test_idx in k_folds_2(n_splits, samples, num_classes, monte_carlo, labels, seed):
+        yield test_idx
 
 
 def test_kfold(k = 10, samples = 400):
@@ -95,8 +211,8 @@ def test_kfold(k = 10, samples = 400):
         s = list(train_idx.intersection(test_idx))
         assert s == []
 
-def test_kfold_2(k = 15, samples = 400, num_classes = 4, monte_carlo=True):
-    for train_idx, test_idx in k_folds_2(n_splits = 10, samples = samples, num_classes=num_classes, monte_carlo=monte_carlo):
+def test_kfold_2(k = 10, samples = 400, num_classes = 4, monte_carlo=True):
+    for train_idx, test_idx in k_folds_2(n_splits = k, samples = samples, num_classes=num_classes, monte_carlo=monte_carlo):
         print(test_idx)
         if not monte_carlo:
             assert np.unique(train_idx).size == samples/k*(k-1)
@@ -105,6 +221,3 @@ def test_kfold_2(k = 15, samples = 400, num_classes = 4, monte_carlo=True):
         test_idx = set(test_idx)
         s = list(train_idx.intersection(test_idx))
         assert s == []
-
-test_kfold_2()
-
@@ -0,0 +1,102 @@
+from __future__ import print_function, division
+import numpy as np
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+def open_image(filename, size = None):
+	"""
+	Opens an RGB image, decoding at reduced resolution when only size (height, width) is needed
+
+	JPEG files are decoded with DCT scaling (1/2 .. 1/8, via PIL draft) and multi-page (pyramidal)
+	TIFF files start from the smallest page that is still at least size, so the pixels that would
+	be thrown away by the resize are never decoded. The result is resized to exactly size.
+	"""
+	img = Image.open(filename, mode = 'r')
+	if size is not None:
+		height, width = size
+		if img.format == 'JPEG':
+			img.draft('RGB', (width, height))
+		elif getattr(img, 'n_frames', 1) > 1:
+			best, best_area = 0, None
+			for page in range(img.n_frames):
+				img.seek(page)
+				w, h = img.size
+				if w >= width and h >= height and (best_area is None or w * h < best_area):
+					best, best_area = page, w * h
+			img.seek(best)
+	if img.mode != 'RGB':
+		img = img.convert('RGB')
+	if size is not None and img.size != (size[1], size[0]):
+		# reducing_gap first shrinks by an integer factor with a box filter, then resamples
+		img = img.resize((size[1], size[0]), Image.BILINEAR, reducing_gap = 2.0)
+	return img
+
+
+def decode_into(filename, out, size = None):
+	"""
+	Decodes an image into a preallocated uint8 buffer
+
+	Args:
+		out: uint8 Tensor [3, H, W] (or numpy array [H, W, 3]), size defaults to its shape
+	"""
+	if size is None:
+		size = tuple(out.shape[1:]) if isinstance(out, torch.Tensor) else tuple(out.shape[:2])
+	pixels = np.asarray(open_image(filename, size))
+	if isinstance(out, torch.Tensor):
+		# channels-last view of the buffer, numpy does the transposing copy without the GIL
+		out.permute(1, 2, 0).numpy()[...] = pixels
+	else:
+		out[...] = pixels
+	return out
+
+
+def image_size(filename):
+	""" (height, width) from the file header, without decoding """
+	with Image.open(filename, mode = 'r') as img:
+		return img.size[1], img.size[0]
+
+
+class BatchDecoder(object):
+	"""Decodes batches of images on a thread pool into a reused uint8 buffer
+
+	PIL releases the GIL while decoding and resizing, so the threads decode in parallel.
+	"""
+	def __init__(self, size = None, num_threads = 4, pin_memory = False):
+		"""
+		Args:
+			size: (height, width) to decode to, None for the native size of the images
+			num_threads: decoding threads
+			pin_memory: allocate the buffer in page-locked memory for asynchronous copies to the GPU
+		"""
+		self.size = size
+		self.pin_memory = pin_memory and torch.cuda.is_available()
+		self.pool = ThreadPoolExecutor(max_workers = num_threads)
+		self.buffer = None
+
+	def _buffer(self, n, height, width):
+		shape = (n, 3, height, width)
+		if self.buffer is None or self.buffer.shape[0] < n or tuple(self.buffer.shape[1:]) != shape[1:]:
+			self.buffer = torch.empty(shape, dtype = torch.uint8, pin_memory = self.pin_memory)
+		return self.buffer[:n]
+
+	def __call__(self, filenames):
+		"""
+		Returns:
+			uint8 Tensor [len(filenames), 3, H, W], a view of the reused buffer (copy it to keep it
+			past the next call), or a list of [3, H, W] tensors if native sizes differ
+		"""
+		size = self.size
+		if size is None:
+			sizes = set(self.pool.map(image_size, filenames))
+			if len(sizes) > 1:
+				return list(self.pool.map(lambda f: torch.from_numpy(np.asarray(open_image(f))).permute(2, 0, 1), filenames))
+			size = sizes.pop()
+		out = self._buffer(len(filenames), size[0], size[1])
+		list(self.pool.map(lambda i: decode_into(filenames[i], out[i], size), range(len(filenames))))
+		return out
+
+	def close(self):
+		self.pool.shutdown()
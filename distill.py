@@ -0,0 +1,226 @@
+from __future__ import print_function, division
+import os
+import time
+import json
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch.utils.data import Dataset, DataLoader
+
+import resnet_helper as H
+from resnet import resnet18_tiling_student, resnet50_tiling_1fc
+from loaders import FoldSubsetSampler
+from cross_validation import load_folds
+from embeddings import EmbeddingStore, export_embeddings
+from sweep import CachedFeatures, default_params, _make_optimizer
+
+
+class IndexedTiles(Dataset):
+	"""TiledPathologyDataset returning the dataset index in place of the label, so collate_tiles
+	yields the image indices of every minibatch (the rows of the teacher EmbeddingStore)"""
+	def __init__(self, dataset):
+		self.dataset = dataset
+
+	def __len__(self):
+		return len(self.dataset)
+
+	def __getitem__(self, idx):
+		tiles, levels, _ = self.dataset[idx]
+		return tiles, levels, idx
+
+
+def distillation_loss(student, teacher, cosine_weight = 1.0):
+	""" mse on the teacher tile features plus a cosine term, so both scale and direction are matched """
+	mse = F.mse_loss(student, teacher)
+	cosine = 1 - F.cosine_similarity(student, teacher, dim = 1).mean()
+	return mse + cosine_weight * cosine, mse.item(), cosine.item()
+
+
+def distill(student, dataset, teacher_store, epochs = 10, batch_size = 2, learning_rate = 1e-3, cosine_weight = 1.0,
+			num_workers = 4, device = torch.device('cpu'), seed = 0, indices = None):
+	"""
+	Trains a student trunk to reproduce the frozen teacher tile features of an EmbeddingStore
+
+	Args:
+		student: ResNet_Tiling with feature_dim equal to the teacher's (see resnet18_tiling_student)
+		dataset: TiledPathologyDataset without shuffle or tile sampling, in the order the store was exported
+		teacher_store: EmbeddingStore exported from the teacher (embeddings.py export)
+		indices: images used for distillation, None for all (no labels are needed, so all folds can be used)
+
+	Returns:
+		list of per-epoch mean loss
+	"""
+	if dataset.fine_tiles is not None:
+		raise ValueError('Distillation needs every tile, got fine_tiles=%d' % dataset.fine_tiles)
+	if list(teacher_store.image_ids) != [str(i) for i in dataset.img_ids]:
+		raise ValueError('Dataset order does not match the teacher store, build it with shuffle=False')
+	if list(teacher_store.res) != list(student.res):
+		raise ValueError('Student res %s does not match the teacher store res %s' % (student.res, teacher_store.res))
+
+	indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+	loader = DataLoader(IndexedTiles(dataset), batch_size = batch_size, sampler = FoldSubsetSampler(indices, shuffle = True, seed = seed),
+						num_workers = num_workers, collate_fn = H.collate_tiles)
+
+	student = student.to(device = device)
+	# the student trunk and projection are trained, fc1 is fit per fold afterwards
+	parameters = [p for name, p in student.named_parameters() if not name.startswith('fc1')]
+	for p in parameters:
+		p.requires_grad = True
+	optimizer = torch.optim.Adam(parameters, lr = learning_rate)
+	scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs * len(loader))
+
+	per_image = teacher_store.meta['num_tiles'] // teacher_store.meta['num_images']
+	history = []
+	for epoch in range(epochs):
+		student.train()
+		total, mse_total, cosine_total, batches = 0.0, 0.0, 0.0, 0
+		start = time.time()
+		for (tiles, levels, image_index), images in loader:
+			rows = (images.numpy()[:, None] * per_image + np.arange(per_image)[None, :]).ravel()
+			target = torch.from_numpy(np.asarray(teacher_store.tiles[rows], dtype = np.float32)).to(device = device)
+			features = student.tile_features((tiles.to(device = device), levels, image_index))
+
+			loss, mse, cosine = distillation_loss(features, target, cosine_weight)
+			optimizer.zero_grad()
+			loss.backward()
+			optimizer.step()
+			scheduler.step()
+
+			total += loss.item()
+			mse_total += mse
+			cosine_total += cosine
+			batches += 1
+		history.append(total / max(batches, 1))
+		print('Distillation epoch %d: loss %.4f (mse %.4f, cosine %.4f), %.1fs' % (epoch, history[-1], mse_total / max(batches, 1),
+			  cosine_total / max(batches, 1), time.time() - start))
+	return history
+
+
+def trunk_throughput(model, tile_size = 224, batch_size = 64, iters = 5, device = torch.device('cpu')):
+	""" tiles per second of model.trunk on random tiles, after one warmup batch """
+	model = model.to(device = device).eval()
+	x = torch.randn(batch_size, 3, tile_size, tile_size, device = device)
+	with torch.no_grad():
+		model.trunk(x)
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		start = time.time()
+		for _ in range(iters):
+			model.trunk(x)
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+	return batch_size * iters / (time.time() - start)
+
+
+def fit_head(features, labels, train_idx, test_idx, params, epochs = 100, num_classes = 4, seed = 0):
+	"""
+	Trains fc1 on cached pooled features of one fold (as train_net.py with a frozen trunk)
+
+	Returns:
+		validation accuracy
+	"""
+	torch.manual_seed(seed)
+	train_idx, test_idx = np.sort(train_idx), np.sort(test_idx)
+	head = nn.Linear(features.shape[1], num_classes)
+	nn.init.normal_(head.weight, std = 0.01)
+	nn.init.constant_(head.bias, 0)
+	optimizer = _make_optimizer(params, head.parameters())
+	scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size = params['step_size'], gamma = params['gamma'])
+	y = torch.from_numpy(labels)
+	for epoch in range(epochs):
+		order = np.random.permutation(train_idx)
+		for b in range(0, len(order), params['batch_size']):
+			idx = order[b:b + params['batch_size']]
+			loss = F.cross_entropy(head(features[idx]), y[idx])
+			optimizer.zero_grad()
+			loss.backward()
+			optimizer.step()
+		scheduler.step()
+	with torch.no_grad():
+		return (head(features[test_idx]).argmax(1) == y[test_idx]).float().mean().item()
+
+
+def compare(teacher_store, student_store, teacher, student, fold_file, n_splits = 10, folds = None, epochs = 100,
+			params = None, device = torch.device('cpu')):
+	"""
+	Per-fold accuracy of fc1 on teacher vs student pooled features, and tiles/s of both trunks
+
+	Args:
+		teacher_store, student_store: EmbeddingStore directories of the same images
+		teacher, student: ResNet_Tiling models, only used for the throughput measurement
+
+	Returns:
+		dict with throughput and per-fold accuracy of both trunks
+	"""
+	params = dict(default_params, **(params or {}))
+	teacher_features = CachedFeatures(teacher_store, params['res'])
+	student_features = CachedFeatures(student_store, params['res'])
+	labels = teacher_features.store.labels
+	if labels is None:
+		raise ValueError('The teacher store has no labels, re-export it with embeddings.py')
+	every = np.arange(len(labels))
+	x_teacher = teacher_features.pooled(every)
+	x_student = student_features.pooled(every)
+
+	report = {'teacher_tiles_per_s': trunk_throughput(teacher, device = device),
+			  'student_tiles_per_s': trunk_throughput(student, device = device),
+			  'teacher_params': sum(p.numel() for p in teacher.parameters()),
+			  'student_params': sum(p.numel() for p in student.parameters()),
+			  'folds': []}
+	report['speedup'] = report['student_tiles_per_s'] / report['teacher_tiles_per_s']
+	for fold, (train_idx, test_idx) in enumerate(list(load_folds(fold_file, labels, n_splits = n_splits))[:folds or n_splits]):
+		acc_teacher = fit_head(x_teacher, labels, train_idx, test_idx, params, epochs, seed = fold)
+		acc_student = fit_head(x_student, labels, train_idx, test_idx, params, epochs, seed = fold)
+		report['folds'].append({'fold': fold, 'teacher_acc': acc_teacher, 'student_acc': acc_student})
+		print('Fold %d: teacher %.4f, student %.4f' % (fold, acc_teacher, acc_student))
+	report['teacher_acc'] = float(np.mean([f['teacher_acc'] for f in report['folds']]))
+	report['student_acc'] = float(np.mean([f['student_acc'] for f in report['folds']]))
+	print('Teacher %.1f tiles/s, student %.1f tiles/s (%.1fx)' % (report['teacher_tiles_per_s'], report['student_tiles_per_s'], report['speedup']))
+	return report
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Distillation of the frozen ResNet-50 tile features into a small student trunk')
+	parser.add_argument('--img_dir', required = True)
+	parser.add_argument('--teacher_store', required = True, help = 'embedding store exported from the teacher by embeddings.py')
+	parser.add_argument('--out', required = True, help = 'output directory for the student checkpoint, store and report')
+	parser.add_argument('--width', type = int, default = 64, help = 'student conv1 / layer1 channels, 32 for a narrower trunk')
+	parser.add_argument('--epochs', type = int, default = 10)
+	parser.add_argument('--batch_size', type = int, default = 2)
+	parser.add_argument('--lr', type = float, default = 1e-3)
+	parser.add_argument('--head_epochs', type = int, default = 100)
+	parser.add_argument('--k', type = int, default = 10)
+	parser.add_argument('--folds', type = int, default = None)
+	parser.add_argument('--num_workers', type = int, default = 4)
+	args = parser.parse_args()
+
+	import transformations
+	from PathologyDataset import TiledPathologyDataset
+
+	device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+	teacher_store = EmbeddingStore(args.teacher_store)
+	res = teacher_store.res
+	dataset = TiledPathologyDataset(img_dir = args.img_dir, transform = transformations.tiling_val_uint8(), res = res)
+
+	student = resnet18_tiling_student(pretrained = True, width = args.width, num_classes = 4, res = res)
+	distill(student, dataset, teacher_store, args.epochs, args.batch_size, args.lr, num_workers = args.num_workers, device = device)
+	if not os.path.exists(args.out):
+		os.makedirs(args.out)
+	torch.save(student.state_dict(), os.path.join(args.out, 'student.pt'))
+
+	student_store = os.path.join(args.out, 'store')
+	export_embeddings(student, dataset, student_store, args.batch_size, args.num_workers, device, checkpoint = os.path.join(args.out, 'student.pt'))
+
+	# weights do not matter for the throughput measurement
+	teacher = resnet50_tiling_1fc(pretrained = False, num_classes = 4, res = res)
+	report = compare(args.teacher_store, student_store, teacher, student, os.path.join(args.out, 'folds.npz'), args.k, args.folds,
+					 args.head_epochs, {'res': res}, device)
+	with open(os.path.join(args.out, 'report.json'), 'w') as f:
+		json.dump(report, f, indent = 1)
+
+
+if __name__ == '__main__':
+	main()
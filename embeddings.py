@@ -0,0 +1,389 @@
+from __future__ import print_function, division
+import os
+import json
+import argparse
+import torch
+import numpy as np
+
+from torch.utils.data import DataLoader
+
+import resnet_helper as H
+
+tile_meta_dtype = np.dtype([('image', np.int32), ('level', np.int8), ('row', np.int16), ('col', np.int16)])
+
+
+def tile_metadata(num_images, res, image_size, spec = None):
+	"""
+	Image, resolution level, row and column of every tile of num_images whole images
+
+	Returns:
+		structured array of shape [num_images*tiles_per_image] with fields image, level, row, col
+	"""
+	if spec is None:
+		spec = H.default_spec()
+	table = spec.tile_table(res, image_size[0], image_size[1])
+	per_image = np.zeros(table.size, dtype = tile_meta_dtype)
+	for name in ['level', 'row', 'col']:
+		per_image[name] = table[name]
+	meta = np.tile(per_image, num_images)
+	meta['image'] = np.repeat(np.arange(num_images), per_image.size)
+	return meta
+
+
+class EmbeddingStore(object):
+	"""Float16 memory-mapped store of per-tile and per-image pooled embeddings
+
+	Layout of the store directory:
+		meta.json: sizes, resolutions and source checkpoint
+		tiles.f16: [num_tiles, dim] tile features (avgpool output)
+		images.f16: [num_images, len(res)*dim] pooled image features (max_tile output)
+		tile_meta.npy: image, level, row, col of every tile
+		image_ids.npy: image id of every image
+		labels.npy: label of every image (optional)
+	"""
+	def __init__(self, path, mode = 'r'):
+		with open(os.path.join(path, 'meta.json')) as f:
+			self.meta = json.load(f)
+		self.path = path
+		self.res = self.meta['res']
+		num_tiles, num_images, dim = self.meta['num_tiles'], self.meta['num_images'], self.meta['dim']
+		self.tiles = np.memmap(os.path.join(path, 'tiles.f16'), dtype = np.float16, mode = mode, shape = (num_tiles, dim))
+		self.images = np.memmap(os.path.join(path, 'images.f16'), dtype = np.float16, mode = mode, shape = (num_images, len(self.res) * dim))
+		self.tile_meta = np.load(os.path.join(path, 'tile_meta.npy'), mmap_mode = 'r')
+		self.image_ids = np.load(os.path.join(path, 'image_ids.npy'))
+		self.labels = None
+		if os.path.exists(os.path.join(path, 'labels.npy')):
+			self.labels = np.load(os.path.join(path, 'labels.npy'))
+
+	@classmethod
+	def create(cls, path, image_ids, res, image_size, dim = 2048, checkpoint = None, labels = None, spec = None):
+		"""Allocates an empty store for whole images of image_size tiled with res levels of spec"""
+		if not os.path.exists(path):
+			os.makedirs(path)
+		image_ids = np.asarray(image_ids).astype(str)
+		tile_meta = tile_metadata(len(image_ids), res, image_size, spec)
+		meta = {'num_tiles': int(tile_meta.size), 'num_images': int(len(image_ids)), 'dim': dim,
+				'res': list(res), 'checkpoint': checkpoint, 'spec': repr(spec if spec is not None else H.default_spec()),
+				'image_size': list(image_size)}
+		with open(os.path.join(path, 'meta.json'), 'w') as f:
+			json.dump(meta, f, indent = 1)
+		np.save(os.path.join(path, 'tile_meta.npy'), tile_meta)
+		np.save(os.path.join(path, 'image_ids.npy'), image_ids)
+		if labels is not None:
+			np.save(os.path.join(path, 'labels.npy'), np.asarray(labels, dtype = np.int64))
+		np.memmap(os.path.join(path, 'tiles.f16'), dtype = np.float16, mode = 'w+', shape = (tile_meta.size, dim)).flush()
+		np.memmap(os.path.join(path, 'images.f16'), dtype = np.float16, mode = 'w+', shape = (len(image_ids), len(res) * dim)).flush()
+		return cls(path, mode = 'r+')
+
+	def tiles_of(self, image):
+		"""Row range of the tiles of one image"""
+		per_image = self.meta['num_tiles'] // self.meta['num_images']
+		return slice(image * per_image, (image + 1) * per_image)
+
+	def flush(self):
+		self.tiles.flush()
+		self.images.flush()
+
+
+def export_embeddings(model, dataset, path, batch_size = 4, num_workers = 4, device = torch.device('cpu'), checkpoint = None, image_size = None):
+	"""
+	Exports per-tile and pooled per-image embeddings of a trained ResNet_Tiling
+
+	Args:
+		model: ResNet_Tiling
+		dataset: PathologyDataset (whole images) or TiledPathologyDataset without tile sampling
+		path: store directory
+		checkpoint: name of the checkpoint, recorded in the metadata
+		image_size: (height, width) of the dataset images, defaults to the size of the first batch
+			(whole images) or dataset.image_size() (tiles)
+
+	Returns:
+		EmbeddingStore
+	Raises:
+		ValueError if an image does not have the tiles of image_size
+	"""
+	collate_fn = None
+	if hasattr(dataset, 'fine_tiles'):
+		if dataset.fine_tiles is not None:
+			raise ValueError('Embedding export needs every tile, got fine_tiles=%d' % dataset.fine_tiles)
+		collate_fn = H.collate_tiles
+	loader = DataLoader(dataset, batch_size = batch_size, shuffle = False, num_workers = num_workers, collate_fn = collate_fn)
+
+	model = model.to(device = device).eval()
+	store = None
+	tile_row, image_row = 0, 0
+	with torch.no_grad():
+		for x, _ in loader:
+			if store is None:
+				if image_size is None:
+					image_size = dataset.image_size() if collate_fn is not None else tuple(x.shape[2:])
+				store = EmbeddingStore.create(path, dataset.img_ids, model.res, image_size, checkpoint = checkpoint,
+											  labels = dataset.img_labels, spec = model.spec)
+				per_image = store.meta['num_tiles'] // store.meta['num_images']
+			if isinstance(x, (tuple, list)):
+				counts = torch.bincount(x[2])
+				wrong = (counts != per_image).nonzero().view(-1)
+				if wrong.numel():
+					first = int(wrong[0])
+					raise ValueError('Image %s has %d tiles, %d expected for size %s' % (dataset.img_ids[image_row + first],
+									 int(counts[first]), per_image, tuple(image_size)))
+				x = tuple(t.to(device = device) for t in x)
+				num_images = int(x[2][-1]) + 1
+				features = model.tile_features(x)
+				pooled = H.max_tile_segments(features, x[1], x[2], num_images, len(model.res))
+			else:
+				if tuple(x.shape[2:]) != tuple(image_size):
+					raise ValueError('Image %s is %s, expected %s' % (dataset.img_ids[image_row], tuple(x.shape[2:]), tuple(image_size)))
+				x = x.to(device = device, dtype = torch.float32)
+				num_images = x.shape[0]
+				features = model.tile_features(x)
+				pooled = H.max_tile(features.view(features.shape[0], -1, 1, 1), num_images, model.res, model.spec.counts(x.shape[2], x.shape[3]))
+
+			store.tiles[tile_row:tile_row + features.shape[0]] = features.cpu().numpy()
+			store.images[image_row:image_row + num_images] = pooled.view(num_images, -1).cpu().numpy()
+			tile_row += features.shape[0]
+			image_row += num_images
+			print('exported %d / %d images' % (image_row, len(dataset)))
+
+	if tile_row != store.meta['num_tiles'] or image_row != store.meta['num_images']:
+		raise ValueError('Exported %d tiles of %d images, the store has %d tiles of %d images' % (tile_row, image_row,
+						 store.meta['num_tiles'], store.meta['num_images']))
+	store.flush()
+	return store
+
+
+def _normalize(x):
+	x = np.asarray(x, dtype = np.float32)
+	return x / np.maximum(np.linalg.norm(x, axis = -1, keepdims = True), 1e-12)
+
+def _merge_topk(scores, ids, best_scores, best_ids, k):
+	# keep the k highest scores per query among the running best and a new block
+	scores = np.concatenate([best_scores, scores], 1)
+	ids = np.concatenate([best_ids, ids], 1)
+	if scores.shape[1] > k:
+		part = np.argpartition(-scores, k - 1, axis = 1)[:, :k]
+		scores = np.take_along_axis(scores, part, 1)
+		ids = np.take_along_axis(ids, part, 1)
+	return scores, ids
+
+def kmeans(x, k, iters = 20, seed = 0):
+	"""
+	Lloyd's k-means with vectorized assignments
+
+	Returns:
+		centroids [k, dim], assignment [n]
+	"""
+	x = np.asarray(x, dtype = np.float32)
+	rng = np.random.RandomState(seed)
+	centroids = x[rng.choice(len(x), k, replace = len(x) < k)].copy()
+	for _ in range(iters):
+		# argmin ||x - c||^2 = argmax x.c - ||c||^2/2
+		assign = np.argmax(x.dot(centroids.T) - 0.5 * (centroids ** 2).sum(1), axis = 1)
+		counts = np.bincount(assign, minlength = k).astype(np.float32)
+		sums = np.zeros_like(centroids)
+		np.add.at(sums, assign, x)
+		empty = counts == 0
+		centroids[~empty] = sums[~empty] / counts[~empty, None]
+		# reseed empty clusters with random points
+		centroids[empty] = x[rng.choice(len(x), empty.sum())]
+	return centroids, assign
+
+
+class TileIndex(object):
+	"""Cosine similarity nearest neighbour index over the tile embeddings of an EmbeddingStore
+
+	Without a coarse quantizer the search is an exact blocked matrix multiply over the
+	memory-mapped float16 features. With nlist > 0 vectors are bucketed by k-means (IVF) and
+	only nprobe buckets are scanned; with pq_m > 0 the scanned vectors are scored from
+	pq_m-byte product quantization codes instead of the full features.
+	"""
+	def __init__(self, store, block_size = 65536):
+		self.store = store
+		self.block_size = block_size
+		self.inv_norms = None
+		self.centroids = None
+		self.list_order = None
+		self.list_offsets = None
+		self.pq_centroids = None
+		self.codes = None
+
+	def _blocks(self, rows = None):
+		n = self.store.tiles.shape[0] if rows is None else len(rows)
+		for start in range(0, n, self.block_size):
+			stop = min(start + self.block_size, n)
+			if rows is None:
+				yield np.arange(start, stop), np.asarray(self.store.tiles[start:stop], dtype = np.float32)
+			else:
+				ids = rows[start:stop]
+				yield ids, np.asarray(self.store.tiles[ids], dtype = np.float32)
+
+	def build(self, nlist = 0, pq_m = 0, train_size = 100000, iters = 20, seed = 0):
+		"""
+		Args:
+			nlist: number of IVF buckets, 0 for exact search
+			pq_m: number of product quantization sub-vectors (must divide the dimension), 0 to score exact features
+			train_size: number of vectors sampled to train the quantizers
+		"""
+		tiles = self.store.tiles
+		self.inv_norms = np.empty(tiles.shape[0], dtype = np.float32)
+		for ids, block in self._blocks():
+			self.inv_norms[ids] = 1.0 / np.maximum(np.linalg.norm(block, axis = 1), 1e-12)
+
+		rng = np.random.RandomState(seed)
+		sample = np.sort(rng.choice(tiles.shape[0], min(train_size, tiles.shape[0]), replace = False))
+		sample = _normalize(tiles[sample])
+
+		if nlist > 0:
+			self.centroids, _ = kmeans(sample, nlist, iters, seed)
+			assign = np.empty(tiles.shape[0], dtype = np.int32)
+			for ids, block in self._blocks():
+				assign[ids] = np.argmax(block.dot(self.centroids.T) * self.inv_norms[ids, None] - 0.5 * (self.centroids ** 2).sum(1), axis = 1)
+			self.list_order = np.argsort(assign, kind = 'stable').astype(np.int64)
+			self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength = nlist))]).astype(np.int64)
+
+		if pq_m > 0:
+			sub = tiles.shape[1] // pq_m
+			self.pq_centroids = np.stack([kmeans(sample[:, j * sub:(j + 1) * sub], 256, iters, seed)[0] for j in range(pq_m)])
+			self.codes = np.empty((tiles.shape[0], pq_m), dtype = np.uint8)
+			for ids, block in self._blocks():
+				block = block * self.inv_norms[ids, None]
+				for j in range(pq_m):
+					c = self.pq_centroids[j]
+					self.codes[ids, j] = np.argmax(block[:, j * sub:(j + 1) * sub].dot(c.T) - 0.5 * (c ** 2).sum(1), axis = 1)
+		return self
+
+	def _score(self, q, ids, block):
+		if self.codes is None:
+			return block.dot(q.T).T * self.inv_norms[ids]
+		# asymmetric distance: lookup table of query / sub-centroid inner products
+		pq_m, _, sub = self.pq_centroids.shape
+		lut = np.einsum('qmd,mkd->qmk', q.reshape(len(q), pq_m, sub), self.pq_centroids)
+		codes = self.codes[ids]
+		scores = np.zeros((len(q), len(ids)), dtype = np.float32)
+		for j in range(pq_m):
+			scores += lut[:, j, codes[:, j]]
+		return scores
+
+	def search(self, queries, k = 10, nprobe = 8, refine = 1):
+		"""
+		Args:
+			queries: [num_queries, dim] query features
+			k: number of neighbours
+			nprobe: IVF buckets scanned per query
+			refine: with product quantization, re-rank refine*k candidates with the exact features
+
+		Returns:
+			scores [num_queries, k] cosine similarities and ids [num_queries, k] tile rows, best first
+		"""
+		q = _normalize(np.atleast_2d(queries))
+		if self.codes is not None and refine > 1:
+			_, candidates = self.search(q, k * refine, nprobe)
+			valid = candidates >= 0
+			rows = np.where(valid, candidates, 0)
+			unique = np.unique(rows)
+			features = np.asarray(self.store.tiles[unique], dtype = np.float32)[np.searchsorted(unique, rows)]
+			scores = np.einsum('qkd,qd->qk', features, q) * self.inv_norms[rows]
+			scores = np.where(valid, scores, -np.inf)
+			order = np.argsort(-scores, axis = 1)[:, :k]
+			return np.take_along_axis(scores, order, 1), np.where(np.take_along_axis(valid, order, 1), np.take_along_axis(candidates, order, 1), -1)
+
+		best_scores = np.full((len(q), 0), -np.inf, dtype = np.float32)
+		best_ids = np.zeros((len(q), 0), dtype = np.int64)
+
+		if self.centroids is None:
+			groups = [(np.arange(len(q)), None)]
+		else:
+			probe = np.argsort(-q.dot(self.centroids.T), axis = 1)[:, :nprobe]
+			# queries probing the same buckets are scanned together
+			probe = np.sort(probe, axis = 1)
+			keys, inverse = np.unique(probe, axis = 0, return_inverse = True)
+			groups = []
+			for g, key in enumerate(keys):
+				rows = np.concatenate([self.list_order[self.list_offsets[l]:self.list_offsets[l + 1]] for l in key])
+				groups.append((np.nonzero(inverse.reshape(-1) == g)[0], np.sort(rows)))
+
+		results_scores = np.full((len(q), k), -np.inf, dtype = np.float32)
+		results_ids = np.full((len(q), k), -1, dtype = np.int64)
+		for members, rows in groups:
+			scores_g, ids_g = best_scores[members], best_ids[members]
+			if rows is None or len(rows):
+				for ids, block in self._blocks(rows):
+					scores = self._score(q[members], ids, block)
+					scores_g, ids_g = _merge_topk(scores, np.broadcast_to(ids, scores.shape), scores_g, ids_g, k)
+			order = np.argsort(-scores_g, axis = 1)
+			n = order.shape[1]
+			results_scores[members, :n] = np.take_along_axis(scores_g, order, 1)
+			results_ids[members, :n] = np.take_along_axis(ids_g, order, 1)
+		return results_scores, results_ids
+
+	def save(self, filename):
+		arrays = {'inv_norms': self.inv_norms}
+		for name in ['centroids', 'list_order', 'list_offsets', 'pq_centroids', 'codes']:
+			if getattr(self, name) is not None:
+				arrays[name] = getattr(self, name)
+		np.savez(filename, **arrays)
+
+	@classmethod
+	def load(cls, store, filename, block_size = 65536):
+		index = cls(store, block_size)
+		with np.load(filename) as f:
+			for name in f.files:
+				setattr(index, name, f[name])
+		return index
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Tile embedding export and similar region retrieval')
+	sub = parser.add_subparsers(dest = 'command')
+
+	p = sub.add_parser('export', help = 'export tile and image embeddings of a trained model')
+	p.add_argument('--checkpoint', required = True)
+	p.add_argument('--img_dir', required = True)
+	p.add_argument('--out', required = True)
+	p.add_argument('--res', type = int, nargs = '+', default = [0, 1, 2])
+	p.add_argument('--batch_size', type = int, default = 4)
+	p.add_argument('--num_workers', type = int, default = 4)
+
+	p = sub.add_parser('index', help = 'build a nearest neighbour index over a store')
+	p.add_argument('--store', required = True)
+	p.add_argument('--nlist', type = int, default = 0)
+	p.add_argument('--pq', type = int, default = 0)
+
+	p = sub.add_parser('query', help = 'find the tiles most similar to a tile of the store')
+	p.add_argument('--store', required = True)
+	p.add_argument('--image', required = True, help = 'image id of the query tile')
+	p.add_argument('--level', type = int, default = 2)
+	p.add_argument('--row', type = int, default = 0)
+	p.add_argument('--col', type = int, default = 0)
+	p.add_argument('-k', type = int, default = 10)
+	p.add_argument('--nprobe', type = int, default = 8)
+	p.add_argument('--refine', type = int, default = 1)
+
+	args = parser.parse_args()
+	if args.command == 'export':
+		import nets
+		import transformations
+		from PathologyDataset import TiledPathologyDataset
+		device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+		model = nets.load_tiling_checkpoint(args.checkpoint, res = args.res)
+		dataset = TiledPathologyDataset(img_dir = args.img_dir, transform = transformations.tiling_val_uint8(), res = args.res)
+		export_embeddings(model, dataset, args.out, args.batch_size, args.num_workers, device, checkpoint = os.path.abspath(args.checkpoint))
+	elif args.command == 'index':
+		store = EmbeddingStore(args.store)
+		TileIndex(store).build(nlist = args.nlist, pq_m = args.pq).save(os.path.join(args.store, 'index.npz'))
+	elif args.command == 'query':
+		store = EmbeddingStore(args.store)
+		index = TileIndex.load(store, os.path.join(args.store, 'index.npz'))
+		image = int(np.nonzero(store.image_ids == args.image)[0][0])
+		meta = store.tile_meta
+		row = np.nonzero((meta['image'] == image) & (meta['level'] == args.level) & (meta['row'] == args.row) & (meta['col'] == args.col))[0][0]
+		scores, ids = index.search(store.tiles[row:row + 1], k = args.k, nprobe = args.nprobe, refine = args.refine)
+		for score, i in zip(scores[0], ids[0]):
+			m = meta[i]
+			print('%s\tlevel %d\trow %d\tcol %d\t%.4f' % (store.image_ids[m['image']], m['level'], m['row'], m['col'], score))
+	else:
+		parser.print_help()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,232 @@
+from __future__ import print_function, division
+import os
+import re
+import hashlib
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import resnet_helper as H
+import pooling as P
+
+# parameters that differ between the fold models, everything else is the shared frozen trunk
+head_prefixes = ('fc1.', 'pool.')
+# BatchNorm buffers, updated by every fold's training unless train_net.py ran with FREEZE_BN
+bn_buffers = ('running_mean', 'running_var', 'num_batches_tracked')
+
+
+def trunk_digest(state_dict):
+	""" sha256 of the trunk parameters of a ResNet_Tiling state_dict (fc1, pooling and BatchNorm buffers excluded) """
+	digest = hashlib.sha256()
+	for name, value in sorted(state_dict.items()):
+		if name.startswith(head_prefixes) or name.endswith(bn_buffers):
+			continue
+		digest.update(name.encode('utf-8'))
+		digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+	return digest.hexdigest()
+
+
+def fold_checkpoints(results_dir):
+	""" model_<fold>.pt files written by train_net.train_network, in fold order """
+	found = []
+	for name in os.listdir(results_dir):
+		match = re.match(r'model_(\d+)\.pt$', name)
+		if match:
+			found.append((int(match.group(1)), os.path.join(results_dir, name)))
+	return [path for _, path in sorted(found)]
+
+
+class FoldEnsemble(nn.Module):
+	"""Fold models sharing one frozen trunk: the tiles go through the trunk once and all fc1
+	heads are applied as one batched matmul on the pooled features"""
+
+	def __init__(self, model, weights, biases, pools = None):
+		"""
+		Args:
+			model: ResNet_Tiling holding the shared trunk
+			weights: [num_folds, num_classes, len(res)*feature_dim] stacked fc1 weights
+			biases: [num_folds, num_classes] stacked fc1 biases
+			pools: list of per-fold pooling modules when pooling has parameters (attention), else None
+		"""
+		super(FoldEnsemble, self).__init__()
+		self.model = model
+		self.weight = nn.Parameter(weights, requires_grad = False)
+		self.bias = nn.Parameter(biases, requires_grad = False)
+		self.pools = nn.ModuleList(pools) if pools is not None else None
+
+	@property
+	def num_folds(self):
+		return self.weight.shape[0]
+
+	def _pool(self, x, segments, num_segments, pool = None):
+		if pool is not None:
+			return pool(x, segments, num_segments)
+		if self.model.pooling == 'max':
+			return P.segment_max(x, segments, num_segments)
+		return self.model.pool(x, segments, num_segments)
+
+	def forward(self, x):
+		"""
+		Args:
+			x: whole images [num_images,3,H,W] or pre-cut (tiles, levels, image_index)
+		Returns:
+			logits [num_images, num_folds, num_classes]
+		"""
+		model = self.model
+		num_res = len(model.res)
+		if isinstance(x, (tuple, list)):
+			num_images = int(x[2][-1]) + 1
+			segments = x[2].to(device = self.weight.device) * num_res + x[1].to(device = self.weight.device)
+		else:
+			num_images = x.shape[0]
+			segments = P.tile_segments(model.spec.counts(x.shape[2], x.shape[3]), model.res, num_images, device = self.weight.device)
+		features = model.tile_features(x)
+
+		if self.pools is None:
+			pooled = self._pool(features, segments, num_images * num_res).view(num_images, -1)
+			return torch.einsum('nd,fcd->nfc', pooled, self.weight) + self.bias
+		pooled = torch.stack([self._pool(features, segments, num_images * num_res, pool).view(num_images, -1) for pool in self.pools], 1)
+		return torch.einsum('nfd,fcd->nfc', pooled, self.weight) + self.bias
+
+	def probabilities(self, x):
+		"""
+		Returns:
+			per-fold probabilities [num_images, num_folds, num_classes], and their mean [num_images, num_classes]
+		"""
+		probs = F.softmax(self.forward(x), dim = 2)
+		return probs, probs.mean(1)
+
+
+def load_fold_ensemble(checkpoints, num_classes = 4, res = [0,1,2], map_location = 'cpu', spec = None, pooling = 'max', pooling_args = {}):
+	"""
+	Builds a FoldEnsemble from fold checkpoints saved by train_net.train_network
+
+	The frozen trunk parameters must be identical. The BatchNorm running statistics are identical
+	only when the folds trained with FREEZE_BN, otherwise every fold updated them on its own data:
+	the shared trunk then uses their mean, and ensemble.bn_deviation holds the largest relative
+	difference of a fold's buffers from that mean. The fold outputs are then approximate, verify()
+	measures how far they are from the individual checkpoints.
+
+	Args:
+		checkpoints: list of state_dict files, or a results directory holding model_<fold>.pt
+	Raises:
+		ValueError if the trunk parameters of the checkpoints are not identical
+	"""
+	import nets
+	if isinstance(checkpoints, str):
+		checkpoints = fold_checkpoints(checkpoints)
+	if not checkpoints:
+		raise ValueError('No fold checkpoints given')
+
+	model = nets.load_tiling_checkpoint(checkpoints[0], num_classes, res, map_location = map_location, spec = spec,
+										pooling = pooling, pooling_args = pooling_args)
+	reference = trunk_digest(model.state_dict())
+	weights, biases, pools, buffers = [], [], [], []
+	for filename in checkpoints:
+		state = torch.load(filename, map_location = map_location)
+		if trunk_digest(state) != reference:
+			raise ValueError('Trunk of %s differs from %s, the folds cannot share a trunk pass' % (filename, checkpoints[0]))
+		weights.append(state['fc1.weight'])
+		biases.append(state['fc1.bias'])
+		buffers.append(dict((k, v) for k, v in state.items() if k.endswith(bn_buffers)))
+		if hasattr(model, 'pool') and len(list(model.pool.parameters())):
+			pool = P.TilePooling(pooling, model.feature_dim, **pooling_args)
+			pool.load_state_dict(dict((k[len('pool.'):], v) for k, v in state.items() if k.startswith('pool.')))
+			pools.append(pool)
+
+	deviation = 0.0
+	shared = model.state_dict()
+	for name in buffers[0]:
+		values = torch.stack([b[name] for b in buffers], 0)
+		if name.endswith('num_batches_tracked'):
+			shared[name] = values.max()
+			continue
+		mean = values.mean(0)
+		deviation = max(deviation, ((values - mean).abs().max(0)[0] / (mean.abs() + 1e-3)).max().item())
+		shared[name] = mean
+	model.load_state_dict(shared)
+	if deviation > 0:
+		print('BatchNorm statistics differ between the folds (up to %.3g relative), the shared trunk uses their mean' % deviation)
+
+	ensemble = FoldEnsemble(model, torch.stack(weights, 0), torch.stack(biases, 0), pools or None).eval()
+	ensemble.bn_deviation = deviation
+	return ensemble
+
+
+def verify(ensemble, checkpoints, filenames, num_classes = 4, res = [0,1,2], spec = None, pooling = 'max', pooling_args = {},
+		   tolerance = None):
+	"""
+	Largest difference between the fold probabilities of the ensemble and those of every checkpoint loaded on its own
+
+	Args:
+		checkpoints: the fold checkpoints (or results directory) the ensemble was built from
+		filenames: images to compare on
+		tolerance: raise when the difference is larger
+	Returns:
+		max absolute probability difference per fold
+	"""
+	if isinstance(checkpoints, str):
+		checkpoints = fold_checkpoints(checkpoints)
+	folds, _ = predict(ensemble, filenames)
+	differences = []
+	for fold, filename in enumerate(checkpoints):
+		# a single checkpoint keeps its own BatchNorm statistics
+		single = load_fold_ensemble([filename], num_classes, res, spec = spec, pooling = pooling, pooling_args = pooling_args)
+		probs, _ = predict(single, filenames)
+		differences.append(float(np.abs(probs[:, 0] - folds[:, fold]).max()))
+	if tolerance is not None and max(differences) > tolerance:
+		raise ValueError('Fold probabilities differ from the checkpoints by up to %.4g (tolerance %.4g), train with FREEZE_BN '
+						 'for an exact shared trunk' % (max(differences), tolerance))
+	return differences
+
+
+def predict(ensemble, filenames, batch_size = 4, device = torch.device('cpu')):
+	"""
+	Per-fold and averaged probabilities of image files
+
+	Returns:
+		fold probabilities [num_images, num_folds, num_classes], mean probabilities [num_images, num_classes]
+	"""
+	import decode
+	decoder = decode.BatchDecoder()
+	model = ensemble.model
+	ensemble = ensemble.to(device = device).eval()
+	folds, means = [], []
+	with torch.no_grad():
+		for b in range(0, len(filenames), batch_size):
+			images = decoder(filenames[b:b + batch_size])
+			samples = [H.tile_image_uint8(image, model.res, spec = model.spec) + (0,) for image in images]
+			x, _ = H.collate_tiles(samples)
+			probs, mean = ensemble.probabilities(tuple(t.to(device = device) for t in x))
+			folds.append(probs.cpu().numpy())
+			means.append(mean.cpu().numpy())
+	decoder.close()
+	return np.concatenate(folds), np.concatenate(means)
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Fold ensemble inference with one shared trunk pass')
+	parser.add_argument('images', nargs = '+')
+	parser.add_argument('--results_dir', required = True, help = 'directory with the model_<fold>.pt checkpoints')
+	parser.add_argument('--res', type = int, nargs = '+', default = [0, 1, 2])
+	parser.add_argument('--pooling', default = 'max')
+	parser.add_argument('--batch_size', type = int, default = 4)
+	parser.add_argument('--verify', type = float, default = None, metavar = 'TOLERANCE',
+						help = 'check the fold probabilities against every checkpoint loaded on its own')
+	args = parser.parse_args()
+
+	device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+	ensemble = load_fold_ensemble(args.results_dir, res = args.res, pooling = args.pooling)
+	if args.verify is not None:
+		differences = verify(ensemble, args.results_dir, args.images, res = args.res, pooling = args.pooling, tolerance = args.verify)
+		print('fold probability differences to the checkpoints: %s' % ' '.join('%.2g' % d for d in differences))
+	folds, mean = predict(ensemble, args.images, args.batch_size, device)
+	for filename, p, f in zip(args.images, mean, folds):
+		print('%s\t%s\t%d\tfold predictions %s' % (filename, '\t'.join('%.4f' % v for v in p), int(np.argmax(p)),
+			  ' '.join(str(c) for c in f.argmax(1))))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,157 @@
+from __future__ import print_function, division
+import os
+import json
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from torch.utils.data import DataLoader
+
+import pooling as P
+
+
+def pooled_features(model, dataset, batch_size = 4, num_workers = 4, device = torch.device('cpu'), collate_fn = None):
+	"""
+	fc1 inputs [num_images, len(res)*feature_dim] of every image of a dataset, in dataset order
+
+	Args:
+		model: ResNet_Tiling with a parameter-free pooling ('max', 'topk' or 'lse')
+		dataset: PathologyDataset, or TiledPathologyDataset with collate_fn=resnet_helper.collate_tiles
+	"""
+	if hasattr(model, 'pool') and len(list(model.pool.parameters())):
+		raise ValueError('Pooling %s is trained with fc1, its features cannot be cached' % model.pooling)
+	loader = DataLoader(dataset, batch_size = batch_size, shuffle = False, num_workers = num_workers, collate_fn = collate_fn)
+	model = model.to(device = device).eval()
+	num_res = len(model.res)
+	features = []
+	with torch.no_grad():
+		for x, _ in loader:
+			if isinstance(x, (tuple, list)):
+				x = tuple(t.to(device = device) for t in x)
+				num_images = int(x[2][-1]) + 1
+				segments = x[2] * num_res + x[1]
+			else:
+				x = x.to(device = device, dtype = torch.float32)
+				num_images = x.shape[0]
+				segments = P.tile_segments(model.spec.counts(x.shape[2], x.shape[3]), model.res, num_images, device = device)
+			f = model.tile_features(x)
+			if model.pooling == 'max':
+				pooled = P.segment_max(f, segments, num_images * num_res)
+			else:
+				pooled = model.pool(f, segments, num_images * num_res)
+			features.append(pooled.view(num_images, -1).cpu())
+	return torch.cat(features, 0)
+
+
+def fit_fc1(features, labels, weight_decay = 0.0005, num_classes = 4, max_iter = 500, tol = 1e-7, init = None):
+	"""
+	Full-batch L-BFGS fit of fc1 as multinomial logistic regression
+
+	Minimizes mean cross entropy + weight_decay / 2 * (|W|^2 + |b|^2), the objective SGD with
+	weight_decay optimizes in train_net.py (decay applies to the bias as well).
+
+	Args:
+		features: [N, D] pooled features
+		labels: [N] class labels
+		init: (weight, bias) warm start, e.g. the solution for a nearby weight_decay
+	Returns:
+		weight [num_classes, D], bias [num_classes] (float32), final loss
+	"""
+	x = torch.as_tensor(np.asarray(features), dtype = torch.float64)
+	y = torch.as_tensor(np.asarray(labels), dtype = torch.long)
+	if init is not None:
+		weight = init[0].detach().to(torch.float64).clone().requires_grad_(True)
+		bias = init[1].detach().to(torch.float64).clone().requires_grad_(True)
+	else:
+		weight = torch.zeros(num_classes, x.shape[1], dtype = torch.float64, requires_grad = True)
+		bias = torch.zeros(num_classes, dtype = torch.float64, requires_grad = True)
+
+	optimizer = torch.optim.LBFGS([weight, bias], lr = 1, max_iter = max_iter, tolerance_grad = tol, tolerance_change = 1e-12,
+								  history_size = 20, line_search_fn = 'strong_wolfe')
+	def objective():
+		return F.cross_entropy(x.matmul(weight.t()) + bias, y) + 0.5 * weight_decay * (weight.pow(2).sum() + bias.pow(2).sum())
+	def closure():
+		optimizer.zero_grad()
+		loss = objective()
+		loss.backward()
+		return loss
+	optimizer.step(closure)
+	with torch.no_grad():
+		loss = objective().item()
+	return weight.detach().float(), bias.detach().float(), loss
+
+
+def predict_proba(features, weight, bias):
+	scores = torch.as_tensor(np.asarray(features), dtype = torch.float32).matmul(weight.t()) + bias
+	return F.softmax(scores, dim = 1).numpy()
+
+
+def regularization_path(features, labels, decays, val_features = None, val_labels = None, num_classes = 4, max_iter = 500):
+	"""
+	fc1 fits for many weight decays, from the strongest decay down, each warm started from the previous
+
+	Returns:
+		list of dicts per decay (in the given order): weight_decay, weight, bias, loss, and val_acc
+		when validation features are given
+	"""
+	fits = {}
+	init = None
+	for decay in sorted(decays, reverse = True):
+		weight, bias, loss = fit_fc1(features, labels, decay, num_classes, max_iter, init = init)
+		init = (weight, bias)
+		fit = {'weight_decay': decay, 'weight': weight, 'bias': bias, 'loss': loss}
+		if val_features is not None:
+			fit['val_acc'] = float((predict_proba(val_features, weight, bias).argmax(1) == np.asarray(val_labels)).mean())
+		fits[decay] = fit
+	return [fits[decay] for decay in decays]
+
+
+def write_checkpoint(model, weight, bias, filename):
+	""" saves model (a ResNet_Tiling with the shared trunk) with fc1 replaced, loadable like any train_net checkpoint """
+	with torch.no_grad():
+		model.fc1.weight.copy_(weight)
+		model.fc1.bias.copy_(bias)
+	torch.save(model.state_dict(), filename)
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Full-batch fc1 fits on cached pooled features over a weight decay path')
+	parser.add_argument('--store', required = True, help = 'embedding store exported by embeddings.py')
+	parser.add_argument('--decays', type = float, nargs = '+', default = [1e-2, 5e-3, 2e-3, 1e-3, 5e-4, 2e-4, 1e-4, 5e-5, 1e-5])
+	parser.add_argument('--res', type = int, nargs = '+', default = [0, 1, 2])
+	parser.add_argument('--k', type = int, default = 10)
+	parser.add_argument('--out', default = None, help = 'directory for model_<fold>.pt of the best decay')
+	args = parser.parse_args()
+
+	from sweep import CachedFeatures
+	from cross_validation import load_folds
+
+	features = CachedFeatures(args.store, args.res)
+	labels = features.store.labels
+	x = features.pooled(np.arange(len(labels)))
+	folds = list(load_folds(os.path.join(args.store, 'folds.npz'), labels, n_splits = args.k))
+
+	paths = []
+	for fold, (train_idx, test_idx) in enumerate(folds):
+		paths.append(regularization_path(x[train_idx], labels[train_idx], args.decays, x[test_idx], labels[test_idx]))
+		print('fold %d: %s' % (fold, ' '.join('%.3f' % p['val_acc'] for p in paths[-1])))
+	accuracy = np.array([[p['val_acc'] for p in path] for path in paths])
+	best = int(np.argmax(accuracy.mean(0)))
+	for decay, acc in zip(args.decays, accuracy.mean(0)):
+		print('weight decay %g: mean accuracy %.4f' % (decay, acc))
+	print('best weight decay %g' % args.decays[best])
+
+	if args.out is not None:
+		import nets
+		if not os.path.exists(args.out):
+			os.makedirs(args.out)
+		model = nets.resnet50_train_tiling(labels.max() + 1, res = args.res)
+		for fold, path in enumerate(paths):
+			write_checkpoint(model, path[best]['weight'], path[best]['bias'], os.path.join(args.out, 'model_%d.pt' % fold))
+		with open(os.path.join(args.out, 'fc1_path.json'), 'w') as f:
+			json.dump({'decays': args.decays, 'accuracy': accuracy.tolist(), 'best': args.decays[best]}, f, indent = 1)
+
+
+if __name__ == '__main__':
+	main()
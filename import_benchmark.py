@@ -0,0 +1,52 @@
+from __future__ import print_function, division
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# modules loaded by training / inference workers, and the heavy imports they should not pull in
+modules = ['resnet_helper', 'pooling', 'resnet', 'nets', 'PathologyDataset', 'loaders', 'cross_validation',
+		   'results', 'embeddings', 'infer_cache', 'train_net']
+heavy = ['torchvision', 'pandas', 'tensorboardX', 'pdb']
+
+_probe = """
+import sys, time, json
+import torch
+start = time.perf_counter()
+import %s
+print(json.dumps({'seconds': time.perf_counter() - start, 'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def time_import(module, repeats = 5):
+	"""
+	Import time of a module in fresh interpreters, on top of `import torch` which every worker pays
+
+	Returns:
+		median seconds, heavy modules loaded by the import
+	"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	times, loaded = [], []
+	for _ in range(repeats):
+		out = subprocess.check_output([sys.executable, '-c', _probe % (module, heavy)], cwd = here)
+		result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+		times.append(result['seconds'])
+		loaded = result['heavy']
+	return float(np.median(times)), loaded
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Import time of the package modules in fresh interpreters')
+	parser.add_argument('modules', nargs = '*', default = modules)
+	parser.add_argument('--repeats', type = int, default = 5)
+	args = parser.parse_args()
+
+	for module in args.modules:
+		seconds, loaded = time_import(module, args.repeats)
+		print('%-20s %8.1f ms  %s' % (module, seconds * 1000, ', '.join(loaded) if loaded else '-'))
+
+
+if __name__ == '__main__':
+	main()
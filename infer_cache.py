@@ -0,0 +1,209 @@
+from __future__ import print_function, division
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from PIL import Image
+
+import resnet_helper as H
+import decode
+
+
+def file_digest(filename, chunk_size = 1 << 20):
+	""" sha256 of the image file bytes, computed without decoding the image """
+	digest = hashlib.sha256()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+def checkpoint_digest(checkpoint):
+	""" sha256 of a checkpoint file, or of the parameters and buffers of a model """
+	if isinstance(checkpoint, str):
+		return file_digest(checkpoint)
+	digest = hashlib.sha256()
+	for name, value in sorted(checkpoint.state_dict().items()):
+		digest.update(name.encode('utf-8'))
+		digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+	return digest.hexdigest()
+
+
+def model_config(model):
+	""" everything besides the weights that changes the output of a ResNet_Tiling """
+	return {'res': list(model.res), 'spec': repr(model.spec), 'pooling': getattr(model, 'pooling', 'max')}
+
+
+class InferenceCache(object):
+	"""Persistent cache of inference results keyed by image content, checkpoint and tiling config
+
+	Entries hold the class probabilities and optionally the per-tile features (float16), in a
+	sqlite file shared by processes. The least recently used entries are evicted once the stored
+	bytes exceed max_bytes.
+	"""
+	def __init__(self, filename, model_hash, config, max_bytes = 1 << 30):
+		"""
+		Args:
+			filename: sqlite file, created if missing
+			model_hash: checkpoint_digest of the model
+			config: json-serializable tiling / pooling config, see model_config
+			max_bytes: size bound of the stored probabilities and features
+		"""
+		self.filename = filename
+		self.max_bytes = max_bytes
+		self.namespace = hashlib.sha256((model_hash + json.dumps(config, sort_keys = True)).encode('utf-8')).hexdigest()
+		self.hits = 0
+		self.misses = 0
+		self.db = sqlite3.connect(filename, timeout = 60)
+		with self.db:
+			self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, probs BLOB, features BLOB, '
+							'feature_shape TEXT, nbytes INTEGER, last_used REAL)')
+			self.db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+
+	def key(self, content_hash):
+		return hashlib.sha256((self.namespace + content_hash).encode('utf-8')).hexdigest()
+
+	def get(self, content_hash, features = False):
+		"""
+		Returns:
+			(probs, tile features or None), or None on a miss
+		"""
+		key = self.key(content_hash)
+		column = 'features, feature_shape' if features else 'NULL, NULL'
+		row = self.db.execute('SELECT probs, %s FROM entries WHERE key = ?' % column, (key,)).fetchone()
+		# a hit without the requested features is a miss
+		if row is None or (features and row[1] is None):
+			self.misses += 1
+			return None
+		with self.db:
+			self.db.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+		self.hits += 1
+		probs = np.frombuffer(row[0], dtype = np.float32)
+		tiles = np.frombuffer(row[1], dtype = np.float16).reshape(json.loads(row[2])) if features else None
+		return probs, tiles
+
+	def put(self, content_hash, probs, features = None):
+		probs = np.asarray(probs, dtype = np.float32).tobytes()
+		blob, shape = None, None
+		if features is not None:
+			features = np.asarray(features, dtype = np.float16)
+			blob, shape = features.tobytes(), json.dumps(features.shape)
+		nbytes = len(probs) + (len(blob) if blob is not None else 0)
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+							(self.key(content_hash), probs, blob, shape, nbytes, time.time()))
+		self.evict()
+
+	def size(self):
+		return self.db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM entries').fetchone()[0]
+
+	def evict(self):
+		""" drops least recently used entries until the cache fits in max_bytes """
+		excess = self.size() - self.max_bytes
+		if excess <= 0:
+			return
+		keys = []
+		for key, nbytes in self.db.execute('SELECT key, nbytes FROM entries ORDER BY last_used'):
+			keys.append((key,))
+			excess -= nbytes
+			if excess <= 0:
+				break
+		with self.db:
+			self.db.executemany('DELETE FROM entries WHERE key = ?', keys)
+
+	def close(self):
+		self.db.close()
+
+
+def predict(model, filenames, cache = None, transform = None, batch_size = 4, features = False, device = torch.device('cpu')):
+	"""
+	Class probabilities of image files, reading cached results where possible
+
+	Hits only hash the file bytes: decoding, tiling and the trunk are skipped.
+
+	Args:
+		model: ResNet_Tiling
+		filenames: image files
+		cache: InferenceCache for this model, None to always compute
+		transform: PIL image -> uint8 tensor, None decodes the misses in batches on a thread pool (decode.BatchDecoder)
+		features: also return the per-tile features of every image
+	Returns:
+		probs [num_images, num_classes], and a list of tile features [num_tiles, dim] if features is True
+	"""
+	hashes = [file_digest(f) for f in filenames]
+	probs = [None] * len(filenames)
+	tiles = [None] * len(filenames)
+	missing = []
+	for i, h in enumerate(hashes):
+		found = cache.get(h, features) if cache is not None else None
+		if found is None:
+			missing.append(i)
+		else:
+			probs[i], tiles[i] = found
+
+	decoder = decode.BatchDecoder() if transform is None and missing else None
+	model = model.to(device = device).eval()
+	with torch.no_grad():
+		for b in range(0, len(missing), batch_size):
+			batch = missing[b:b + batch_size]
+			if decoder is not None:
+				images = decoder([filenames[i] for i in batch])
+			else:
+				images = [transform(Image.open(filenames[i], mode = 'r')) for i in batch]
+			samples = [H.tile_image_uint8(image, model.res, spec = model.spec) + (0,) for image in images]
+			(x, levels, image_index), _ = H.collate_tiles(samples)
+			x, levels, image_index = x.to(device = device), levels.to(device = device), image_index.to(device = device)
+			tile_features = model.tile_features((x, levels, image_index))
+			scores = F.softmax(model.head(tile_features, levels, image_index, len(batch)), dim = 1).cpu().numpy()
+			tile_features = tile_features.cpu().numpy()
+			image_index = image_index.cpu().numpy()
+			for j, i in enumerate(batch):
+				probs[i] = scores[j]
+				tiles[i] = tile_features[image_index == j]
+				if cache is not None:
+					cache.put(hashes[i], probs[i], tiles[i] if features else None)
+
+	if decoder is not None:
+		decoder.close()
+	probs = np.stack(probs, 0) if probs else np.zeros((0, model.fc1.out_features), dtype = np.float32)
+	if features:
+		return probs, tiles
+	return probs
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Cached inference of a trained tiling model')
+	parser.add_argument('images', nargs = '+')
+	parser.add_argument('--checkpoint', required = True)
+	parser.add_argument('--cache', default = 'inference_cache.db')
+	parser.add_argument('--max_mb', type = float, default = 1024)
+	parser.add_argument('--res', type = int, nargs = '+', default = [0, 1, 2])
+	parser.add_argument('--features', action = 'store_true', help = 'also cache the per-tile features')
+	parser.add_argument('--batch_size', type = int, default = 4)
+	args = parser.parse_args()
+
+	import nets
+	import autotune
+	tuned = autotune.apply()
+	device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+	model = nets.load_tiling_checkpoint(args.checkpoint, res = args.res)
+	if tuned is not None:
+		model.trunk_chunk = tuned['trunk_batch']
+	cache = InferenceCache(args.cache, checkpoint_digest(args.checkpoint), model_config(model), int(args.max_mb * (1 << 20)))
+	probs = predict(model, args.images, cache, batch_size = args.batch_size, features = args.features, device = device)
+	if args.features:
+		probs = probs[0]
+	for filename, p in zip(args.images, probs):
+		print('%s\t%s\t%d' % (filename, '\t'.join('%.4f' % v for v in p), int(np.argmax(p))))
+	print('cache hits %d, misses %d' % (cache.hits, cache.misses))
+	cache.close()
+
+
+if __name__ == '__main__':
+	main()
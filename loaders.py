@@ -0,0 +1,343 @@
+from __future__ import print_function, division
+import time
+import queue
+import threading
+import torch
+import numpy as np
+
+from torch.utils.data import DataLoader
+from torch.utils.data import sampler
+
+
+class FoldSubsetSampler(sampler.Sampler):
+	"""Samples from a subset of indices that can be swapped between folds
+
+	The sampler is iterated in the main process, so replacing its indices takes effect at the
+	next epoch without touching the (persistent) worker processes.
+	"""
+	def __init__(self, indices = (), shuffle = True, seed = None):
+		"""
+		Args:
+			indices (array): dataset indices to sample from
+			shuffle (boolean): whether to visit the indices in random order
+			seed (int, optional): random seed for the permutation
+		"""
+		self.shuffle = shuffle
+		self.generator = torch.Generator()
+		if seed is not None:
+			self.generator.manual_seed(seed)
+		self.set_indices(indices)
+
+	def set_indices(self, indices):
+		self.indices = torch.as_tensor(np.asarray(indices, dtype = np.int64))
+
+	def __iter__(self):
+		if self.shuffle:
+			order = self.indices[torch.randperm(len(self.indices), generator = self.generator)]
+		else:
+			order = self.indices
+		return iter(order.tolist())
+
+	def __len__(self):
+		return len(self.indices)
+
+
+class ImportanceSampler(FoldSubsetSampler):
+	"""Samples training images in proportion to their running loss, with importance weights
+
+	Every epoch draws fraction * len(indices) images with replacement, with probability mixing the
+	normalized running loss of each image with a uniform floor (mix). Losses are scaled by the
+	importance weight 1 / (len(indices) * p) of the draw, so the expected gradient is the one of a
+	uniform epoch. Every refresh_every epochs (and the first epoch of a fold) is a plain uniform pass
+	over all images that refreshes every stale score.
+
+	Each epoch is planned when its iteration starts and kept in drawn / weights, len() is the length
+	of that plan (of a uniform pass before the first epoch). Batch t of a DataLoader that keeps the
+	sampler order and every draw (see check_loader) holds the draws t * batch_size ... (t + 1) * batch_size,
+	see batch(). Report the losses back with record().
+	"""
+	def __init__(self, indices = (), fraction = 0.5, mix = 0.2, smoothing = 0.5, refresh_every = 5, seed = None):
+		"""
+		Args:
+			indices (array): dataset indices to sample from
+			fraction (float): images drawn per importance epoch, relative to len(indices)
+			mix (float): weight of the uniform distribution in the sampling probabilities, bounds the importance weights by 1 / mix
+			smoothing (float): weight of the newest loss in the running loss of an image
+			refresh_every (int): epochs between uniform passes
+			seed (int, optional): random seed for the draws
+		"""
+		self.fraction = fraction
+		self.mix = mix
+		self.smoothing = smoothing
+		self.refresh_every = refresh_every
+		super(ImportanceSampler, self).__init__(indices, shuffle = True, seed = seed)
+
+	def set_indices(self, indices):
+		### a new fold starts from a new model, the scores of the previous one do not apply
+		super(ImportanceSampler, self).set_indices(indices)
+		self.scores = {}
+		self.epoch = 0
+		self.drawn = None
+		self.weights = torch.zeros(0)
+		self.forward_passes = 0
+
+	def _uniform(self):
+		return self.epoch % self.refresh_every == 0 or len(self.scores) < len(self.indices)
+
+	def __len__(self):
+		if self.drawn is None:
+			return len(self.indices)
+		return len(self.drawn)
+
+	def __iter__(self):
+		n = len(self.indices)
+		if self._uniform():
+			self.drawn = self.indices[torch.randperm(n, generator = self.generator)]
+			self.weights = torch.ones(n)
+		else:
+			scores = torch.tensor([self.scores[i] for i in self.indices.tolist()], dtype = torch.float64)
+			p = (1 - self.mix) * scores / scores.sum().clamp(min = 1e-12) + self.mix / n
+			draws = torch.multinomial(p, int(np.ceil(self.fraction * n)), replacement = True, generator = self.generator)
+			self.drawn = self.indices[draws]
+			self.weights = (1.0 / (n * p[draws])).float()
+		self.epoch += 1
+		self.forward_passes += len(self.drawn)
+		return iter(self.drawn.tolist())
+
+	def check_loader(self, loader):
+		""" raises ValueError unless loader batches the draws of this sampler in order and keeps the last partial batch """
+		if getattr(loader, 'sampler', None) is not self:
+			raise ValueError('The DataLoader does not draw from this ImportanceSampler')
+		if loader.drop_last:
+			raise ValueError('ImportanceSampler.batch needs drop_last=False')
+		if not getattr(loader, 'in_order', True):
+			raise ValueError('ImportanceSampler.batch needs in_order=True')
+
+	def batch(self, start, size):
+		""" dataset indices and importance weights of the draws start .. start + size """
+		if self.drawn is None or start + size > len(self.drawn):
+			raise IndexError('Draws %d .. %d are past the %d draws of the epoch' % (start, start + size, 0 if self.drawn is None else len(self.drawn)))
+		return self.drawn[start:start + size], self.weights[start:start + size]
+
+	def record(self, indices, losses):
+		""" updates the running loss of the images from per-sample losses of the last epoch """
+		for i, loss in zip(np.asarray(indices).tolist(), np.asarray(losses, dtype = np.float64).tolist()):
+			self.scores[i] = loss if i not in self.scores else (1 - self.smoothing) * self.scores[i] + self.smoothing * loss
+
+	def report(self):
+		"""Draws, distinct images and forward passes relative to a uniform epoch, for the last epoch and the fold so far"""
+		n = max(len(self.indices), 1)
+		drawn = self.drawn if self.drawn is not None else self.indices[:0]
+		return {'drawn': len(drawn), 'distinct': len(np.unique(drawn.numpy())), 'relative': len(drawn) / float(n),
+				'cumulative_relative': self.forward_passes / float(n * max(self.epoch, 1))}
+
+
+class TimedLoader(object):
+	"""Iterates a DataLoader and records how long each epoch waited for its first batch
+
+	The first batch wait covers worker startup (when workers are respawned) plus filling the
+	prefetch queue, and is the stall seen at every epoch boundary.
+	"""
+	def __init__(self, loader, name):
+		self.loader = loader
+		self.name = name
+		self.startup_times = []
+
+	def __getattr__(self, attr):
+		return getattr(self.loader, attr)
+
+	def __len__(self):
+		return len(self.loader)
+
+	def __iter__(self):
+		start = time.time()
+		first = True
+		for batch in self.loader:
+			if first:
+				self.startup_times.append(time.time() - start)
+				first = False
+			yield batch
+
+	@property
+	def last_startup(self):
+		return self.startup_times[-1] if self.startup_times else 0.0
+
+
+class FoldLoaders(object):
+	"""Train/val DataLoaders whose worker processes survive across epochs and folds
+
+	Typical use:
+
+		loaders = FoldLoaders(train_dataset, val_dataset, batch_size = 4)
+		for train_idx, test_idx in folds:
+			loaders.set_fold(train_idx, test_idx)
+			train_loop(model, loaders, ...)
+		loaders.close()
+	"""
+	def __init__(self, dataset_train, dataset_val, batch_size, num_workers = 4, pin_memory = None, prefetch_factor = 2, seed = None, collate_fn = None,
+				 importance = None):
+		"""
+		Args:
+			dataset_train: dataset used for training (with augmentation)
+			dataset_val: dataset used for validation
+			batch_size (int): minibatch size
+			num_workers (int): worker processes per loader, kept alive for the lifetime of this object
+			pin_memory (boolean, optional): use page-locked host memory, defaults to True when CUDA is available
+			prefetch_factor (int): batches loaded in advance by each worker
+			seed (int, optional): random seed for the training order
+			collate_fn (callable, optional): merges samples into a minibatch, e.g. resnet_helper.collate_tiles
+			importance (dict, optional): ImportanceSampler arguments, to sample the training images by their running loss
+		"""
+		if pin_memory is None:
+			pin_memory = torch.cuda.is_available()
+
+		train_sampler = ImportanceSampler(seed = seed, **importance) if importance is not None else FoldSubsetSampler(shuffle = True, seed = seed)
+		self.samplers = {'train': train_sampler,
+						 'val': FoldSubsetSampler(shuffle = False)}
+		self.loaders = {}
+		for split, dataset in (('train', dataset_train), ('val', dataset_val)):
+			kwargs = {}
+			if num_workers > 0:
+				kwargs = {'persistent_workers': True, 'prefetch_factor': prefetch_factor}
+			loader = DataLoader(dataset = dataset, batch_size = batch_size, sampler = self.samplers[split],
+								num_workers = num_workers, pin_memory = pin_memory, collate_fn = collate_fn, **kwargs)
+			if isinstance(self.samplers[split], ImportanceSampler):
+				self.samplers[split].check_loader(loader)
+			self.loaders[split] = TimedLoader(loader, split)
+
+	def set_fold(self, train_idx, test_idx):
+		"""Swaps the index sets of both loaders without respawning workers"""
+		self.samplers['train'].set_indices(train_idx)
+		self.samplers['val'].set_indices(test_idx)
+
+	def __getitem__(self, split):
+		return self.loaders[split]
+
+	def startup_report(self):
+		"""Mean / max first batch wait per loader, in seconds"""
+		report = {}
+		for split, loader in self.loaders.items():
+			times = np.asarray(loader.startup_times)
+			if times.size:
+				report[split] = {'mean': float(times.mean()), 'max': float(times.max()), 'epochs': int(times.size)}
+		return report
+
+	def close(self):
+		"""Shuts down the persistent workers now and releases the loaders"""
+		for loader in self.loaders.values():
+			# the live iterator of a persistent_workers DataLoader owns the worker processes, a reference
+			# held elsewhere (e.g. a traceback frame) would otherwise keep them until interpreter exit
+			iterator = getattr(loader.loader, '_iterator', None)
+			if iterator is not None and hasattr(iterator, '_shutdown_workers'):
+				iterator._shutdown_workers()
+			loader.loader._iterator = None
+		self.loaders.clear()
+
+
+class DevicePrefetcher(object):
+	"""Double-buffered input pipeline: converts and transfers batch N+1 while batch N computes
+
+	A background thread pulls batches from the loader, casts images to dtype and copies them
+	to device (on a side CUDA stream with non_blocking copies when available). Pre-cut tile
+	batches (tuples, see resnet_helper.collate_tiles) are transferred as is. After every
+	epoch, report() tells how much of the load + transfer time was hidden behind compute.
+	"""
+	def __init__(self, loader, device, dtype = torch.float32, depth = 1):
+		"""
+		Args:
+			loader: iterable of (x, y) minibatches
+			device: target device
+			dtype: floating point type of the images
+			depth (int): number of batches prepared ahead of the consumer
+		"""
+		self.loader = loader
+		self.device = device
+		self.dtype = dtype
+		self.depth = depth
+		self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+		self.stats = {}
+
+	def __getattr__(self, attr):
+		return getattr(self.loader, attr)
+
+	def __len__(self):
+		return len(self.loader)
+
+	def _convert(self, x, y):
+		non_blocking = self.stream is not None
+		if isinstance(x, (tuple, list)):
+			x = tuple(t.to(device = self.device, non_blocking = non_blocking) for t in x)
+		else:
+			x = x.to(device = self.device, dtype = self.dtype, non_blocking = non_blocking)
+		y = y.to(device = self.device, dtype = torch.long, non_blocking = non_blocking)
+		return x, y
+
+	def _produce(self, out, stop, stats):
+		try:
+			iterator = iter(self.loader)
+			while not stop.is_set():
+				start = time.time()
+				try:
+					x, y = next(iterator)
+				except StopIteration:
+					break
+				loaded = time.time()
+				event = None
+				if self.stream is not None:
+					with torch.cuda.stream(self.stream):
+						x, y = self._convert(x, y)
+						event = torch.cuda.Event()
+						event.record(self.stream)
+				else:
+					x, y = self._convert(x, y)
+				stats['load'] += loaded - start
+				stats['convert'] += time.time() - loaded
+				self._put(out, stop, (x, y, event))
+			self._put(out, stop, None)
+		except Exception as e:
+			self._put(out, stop, e)
+
+	def _put(self, out, stop, item):
+		# gives up once the consumer has stopped iterating
+		while not stop.is_set():
+			try:
+				out.put(item, timeout = 0.1)
+				return
+			except queue.Full:
+				pass
+
+	def __iter__(self):
+		stats = {'load': 0.0, 'convert': 0.0, 'wait': 0.0, 'batches': 0}
+		self.stats = stats
+		out = queue.Queue(maxsize = self.depth)
+		stop = threading.Event()
+		producer = threading.Thread(target = self._produce, args = (out, stop, stats))
+		producer.daemon = True
+		producer.start()
+		try:
+			while True:
+				start = time.time()
+				item = out.get()
+				stats['wait'] += time.time() - start
+				if item is None:
+					break
+				if isinstance(item, Exception):
+					raise item
+				x, y, event = item
+				if event is not None:
+					current = torch.cuda.current_stream(self.device)
+					current.wait_event(event)
+					for t in (x if isinstance(x, tuple) else (x,)) + (y,):
+						t.record_stream(current)
+				stats['batches'] += 1
+				yield x, y
+		finally:
+			stop.set()
+			producer.join()
+
+	def report(self):
+		"""Seconds spent loading, converting and waiting in the last epoch, and the hidden fraction"""
+		stats = dict(self.stats)
+		busy = stats.get('load', 0.0) + stats.get('convert', 0.0)
+		stats['overlap'] = max(0.0, 1.0 - stats.get('wait', 0.0) / busy) if busy > 0 else 0.0
+		return stats
@@ -0,0 +1,247 @@
+from __future__ import print_function, division
+import resource
+import argparse
+import torch
+import torch.nn as nn
+
+import resnet_helper as H
+from resnet import ResNet_Tiling, ResNet_Tiling_maxpool_after
+
+
+def units_per_image(model, image_shape):
+	""" trunk inputs per image: tiles for the tiling models, 1 for whole-image models (ResNet_2fc) """
+	height, width = image_shape[1], image_shape[2]
+	if isinstance(model, ResNet_Tiling):
+		counts = model.spec.counts(height, width)
+		return sum(counts[r] for r in model.res), model.spec.levels[0].tile
+	if isinstance(model, ResNet_Tiling_maxpool_after):
+		num_res = 2 if model.tiling is H.tile_images_2res else 3
+		spec = H.default_spec()
+		counts = spec.counts(height, width)
+		return sum(counts[r] for r in range(num_res)), spec.levels[0].tile
+	return 1, None
+
+
+def _trunk(model, x):
+	### the per-unit part of every model variant
+	if isinstance(model, ResNet_Tiling):
+		return model.trunk(x)
+	if isinstance(model, ResNet_Tiling_maxpool_after):
+		x = model.maxpool(model.relu(model.bn1(model.conv1(x))))
+		x = model.layer4(model.layer3(model.layer2(model.layer1(x))))
+		return model.fc1(model.avgpool(x).view(x.shape[0], -1))
+	return model(x)
+
+
+def activation_profile(model, image_shape = (3, 1536, 2048), dtype = torch.float32, train = True):
+	"""
+	Activation bytes of one trunk input (tile, or whole image) measured with forward hooks
+
+	Returns dict:
+		units: trunk inputs per image
+		unit_input: bytes of one trunk input
+		saved: bytes kept for backward (outputs of the modules downstream of a trainable parameter), 0 if frozen or not train
+		transient: largest input + output of a single module plus the largest residual block input held
+			alongside it, the peak of a pass that keeps nothing
+		features: bytes of the trunk output
+	"""
+	units, tile = units_per_image(model, image_shape)
+	shape = (1, image_shape[0], tile, tile) if tile is not None else (1,) + tuple(image_shape)
+	records = []
+	residuals = [0]
+
+	def block_hook(module, inputs, output):
+		residuals.append(inputs[0].numel() * inputs[0].element_size())
+
+	def hook(module, inputs, output):
+		source = inputs[0] if inputs and isinstance(inputs[0], torch.Tensor) else None
+		in_bytes = source.numel() * source.element_size() if source is not None else 0
+		inplace = source is not None and output.data_ptr() == source.data_ptr()
+		records.append((in_bytes, output.numel() * output.element_size(), output.requires_grad and not inplace))
+
+	handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+	handles += [m.register_forward_hook(block_hook) for m in model.modules() if hasattr(m, 'downsample')]
+	was_training = model.training
+	device = next(model.parameters()).device
+	x = torch.zeros(shape, dtype = dtype, device = device)
+	chunk = getattr(model, 'trunk_chunk', None)
+	try:
+		# eval: BatchNorm over a single input, the shapes are the same
+		model.eval()
+		if chunk is not None:
+			model.trunk_chunk = None
+		with torch.set_grad_enabled(train):
+			out = _trunk(model, x)
+	finally:
+		for handle in handles:
+			handle.remove()
+		model.train(was_training)
+		if chunk is not None:
+			model.trunk_chunk = chunk
+
+	return {'units': units,
+			'unit_input': x.numel() * x.element_size(),
+			'saved': sum(o for _, o, saved in records if saved),
+			'transient': max(i + o for i, o, _ in records) + max(residuals),
+			'features': out.numel() * out.element_size()}
+
+
+def parameter_bytes(model, optimizer_states = 1, train = True):
+	""" parameters, plus when training the gradient and optimizer_states buffers (1 for SGD momentum, 2 for Adam) of the trainable ones """
+	total = sum(p.numel() * p.element_size() for p in model.parameters())
+	if not train:
+		return total
+	trainable = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+	return total + trainable * (1 + optimizer_states)
+
+
+def estimate_bytes(profile, batch_size, image_shape = (3, 1536, 2048), fixed = 0, trunk_chunk = None, element_size = 4):
+	"""
+	Peak memory of one step on batch_size images
+
+	fixed (parameters) + input images (and their resized / padded copies when tiling) + trunk inputs
+	+ saved activations + trunk outputs + the transient peak of the largest trunk pass (all units of
+	the batch, or trunk_chunk of them), with the activation terms scaled by profile['scale'] when a
+	measured step corrected the estimate (see plan)
+	"""
+	units = batch_size * profile['units']
+	chunk = units if trunk_chunk is None else min(trunk_chunk, units)
+	images = batch_size * image_shape[0] * image_shape[1] * image_shape[2] * element_size
+	tiled = images + units * profile['unit_input'] if profile['units'] > 1 else 0
+	activations = images + tiled + units * (profile['saved'] + profile['features']) + chunk * profile['transient']
+	return fixed + int(activations * profile.get('scale', 1.0))
+
+
+def available_memory(device = torch.device('cpu')):
+	""" free bytes on the device (CUDA allocator view), or MemAvailable of the host """
+	if device.type == 'cuda':
+		free, _ = torch.cuda.mem_get_info(device)
+		return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+	with open('/proc/meminfo') as f:
+		for line in f:
+			if line.startswith('MemAvailable:'):
+				return int(line.split()[1]) * 1024
+	raise RuntimeError('Cannot read the available host memory')
+
+
+def plan(model, image_shape = (3, 1536, 2048), dtype = torch.float32, train = True, available = None, margin = 0.8,
+		 max_batch = 256, optimizer_states = 1, measure = False):
+	"""
+	Largest batch size (and trunk chunk) whose estimated peak fits in margin * available memory
+
+	When not even one image fits, ResNet_Tiling runs its trunk in chunks of tiles if that leaves BatchNorm
+	unchanged (inference, or training with freeze_bn), with the largest chunk that fits.
+
+	Args:
+		model: ResNet_Tiling, ResNet_Tiling_maxpool_after or ResNet_2fc, with the requires_grad state used in training
+		image_shape: (3, H, W) of the images the model receives
+		train: plan a training step (backward, gradients, optimizer state), else inference
+		available: memory bytes, defaults to available_memory of the model's device
+		measure: run one step on a single image (measure_step) and scale the activation estimate up
+			when the measured peak is larger
+	Returns:
+		dict with batch_size, trunk_chunk (None for no chunking), estimate, budget and the activation profile
+	Raises:
+		MemoryError if no setting fits
+	"""
+	device = next(model.parameters()).device
+	if available is None:
+		available = available_memory(device)
+	budget = int(available * margin)
+	profile = activation_profile(model, image_shape, dtype, train)
+	fixed = parameter_bytes(model, optimizer_states, train)
+	element_size = torch.zeros(0, dtype = dtype).element_size()
+	estimate = lambda b, chunk = None: estimate_bytes(profile, b, image_shape, fixed, chunk, element_size)
+	if measure:
+		measured = measure_step(model, 1, image_shape, dtype, train)
+		profile['scale'] = max(1.0, measured / float(estimate_bytes(profile, 1, image_shape, 0, None, element_size)))
+
+	batch_size = 0
+	while batch_size < max_batch and estimate(batch_size + 1) <= budget:
+		batch_size += 1
+	trunk_chunk = None
+	if batch_size == 0 and isinstance(model, ResNet_Tiling) and not (train and not model.freeze_bn):
+		trunk_chunk = profile['units']
+		while trunk_chunk > 1 and estimate(1, trunk_chunk) > budget:
+			trunk_chunk //= 2
+		if estimate(1, trunk_chunk) <= budget:
+			batch_size = 1
+	if batch_size == 0:
+		raise MemoryError('One image needs an estimated %.2f GB, %.2f GB are available' % (estimate(1) / 2.0**30, budget / 2.0**30))
+	return {'batch_size': batch_size, 'trunk_chunk': trunk_chunk, 'estimate': estimate(batch_size, trunk_chunk),
+			'budget': budget, 'profile': profile}
+
+
+def measure_step(model, batch_size, image_shape = (3, 1536, 2048), dtype = torch.float32, train = True):
+	"""
+	Measured peak bytes of one forward (and backward) step on random images, to validate the estimate
+
+	CUDA uses the allocator's peak; on the host the growth of the peak resident set is measured, which
+	only sees allocations past the previous peak of the process (run it first).
+	"""
+	device = next(model.parameters()).device
+	was_training = model.training
+	model.train(train)
+	if device.type == 'cuda':
+		torch.cuda.synchronize(device)
+		torch.cuda.reset_peak_memory_stats(device)
+		start = torch.cuda.memory_allocated(device)
+	else:
+		start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	x = torch.rand((batch_size,) + tuple(image_shape), dtype = dtype, device = device)
+	with torch.set_grad_enabled(train):
+		out = model(x)
+		if train and out.requires_grad:
+			out.float().sum().backward()
+	if device.type == 'cuda':
+		torch.cuda.synchronize(device)
+		peak = torch.cuda.max_memory_allocated(device) - start
+	else:
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - start
+	model.zero_grad()
+	model.train(was_training)
+	return peak
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Batch size / trunk chunk planning for the available memory')
+	parser.add_argument('--model', default = 'tiling', choices = ['tiling', 'tiling_pool_after', '2fc'])
+	parser.add_argument('--res', type = int, nargs = '+', default = [0, 1, 2])
+	parser.add_argument('--unfreeze', nargs = '*', default = [])
+	parser.add_argument('--img_dir', default = None, help = 'dataset directory, plans for the size of its images')
+	parser.add_argument('--height', type = int, default = 1536)
+	parser.add_argument('--width', type = int, default = 2048)
+	parser.add_argument('--half', action = 'store_true')
+	parser.add_argument('--inference', action = 'store_true')
+	parser.add_argument('--measure', action = 'store_true', help = 'run one step at the planned batch size')
+	args = parser.parse_args()
+	if args.img_dir is not None:
+		from PathologyDataset import PathologyDataset
+		args.height, args.width = PathologyDataset(args.img_dir).image_size()
+
+	import resnet
+	device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+	dtype = torch.float16 if args.half else torch.float32
+	if args.model == '2fc':
+		model = resnet.resnet50_fc(num_classes = 4)
+	elif args.model == 'tiling_pool_after':
+		# tiles the first 2 or 3 resolutions, given by their count
+		if args.res not in ([0, 1], [0, 1, 2]):
+			raise ValueError('tiling_pool_after tiles resolutions [0, 1] or [0, 1, 2], got %s' % args.res)
+		model = resnet.resnet50_tiling_1fc(pool_after = True, num_classes = 4, num_res = len(args.res), unfreeze = args.unfreeze)
+	else:
+		model = resnet.resnet50_tiling_1fc(num_classes = 4, res = args.res, unfreeze = args.unfreeze)
+	model = model.to(device = device, dtype = dtype)
+
+	result = plan(model, (3, args.height, args.width), dtype, train = not args.inference)
+	print('batch size %d, trunk chunk %s, estimated peak %.2f GB of %.2f GB' % (result['batch_size'], result['trunk_chunk'],
+		  result['estimate'] / 2.0**30, result['budget'] / 2.0**30))
+	if args.measure:
+		if result['trunk_chunk'] is not None:
+			model.trunk_chunk = result['trunk_chunk']
+		peak = measure_step(model, result['batch_size'], (3, args.height, args.width), dtype, train = not args.inference)
+		print('measured peak %.2f GB' % (peak / 2.0**30))
+
+
+if __name__ == '__main__':
+	main()
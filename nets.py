@@ -6,11 +6,8 @@ import numpy as np
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.data import sampler
 from torch.utils.data import random_split
-from torchvision import transforms, utils, models
 from resnet import resnet50_fc, resnet50_tiling_1fc, resnet50_tiling_2fc
 
-import pdb
-
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -55,6 +52,7 @@ class TwoLayerFC(nn.Module):
         return scores
 
 def resnet50(num_classes):
+  from torchvision import models
   model = models.resnet50(pretrained=True)
   num_ftrs = model.fc.in_features
     #I recommend training with these layers unfrozen for a couple of epochs after the initial frozen training
@@ -68,10 +66,23 @@ def resnet50_train(num_classes):
   model = resnet50_fc(pretrained=True, num_classes = 4)
   return model
 
-def resnet50_train_tiling(num_classes=4, res = [0,1,2], pool_after = False):
-  model = resnet50_tiling_1fc(pretrained=True, pool_after = pool_after, num_classes = 4, res = res)
+def resnet50_train_tiling(num_classes=4, res = [0,1,2], pool_after = False, spec = None, pooling = 'max', pooling_args = {}, unfreeze = [], recompute_argmax = False, freeze_bn = False):
+  if pool_after:
+    model = resnet50_tiling_1fc(pretrained=True, pool_after = pool_after, num_classes = 4, res = res, unfreeze = unfreeze)
+  else:
+    model = resnet50_tiling_1fc(pretrained=True, pool_after = pool_after, num_classes = 4, res = res, spec = spec, pooling = pooling, pooling_args = pooling_args,
+                                unfreeze = unfreeze, recompute_argmax = recompute_argmax, freeze_bn = freeze_bn)
   return model
 
 def resnet50_train_tiling2(num_classes=4, num_res = 3, tile_after = True):
   model = resnet50_tiling_2fc(pretrained=True, num_classes = 4, num_res = num_res, tile_after = tile_after)
-  return model
\ No newline at end of file
+  return model
+
+def load_tiling_checkpoint(filename, num_classes=4, res = [0,1,2], pool_after = False, map_location = 'cpu', spec = None, pooling = 'max', pooling_args = {}):
+  """Builds the tiling model and loads a checkpoint saved by train_net.train_network"""
+  if pool_after:
+    model = resnet50_tiling_1fc(pretrained=False, pool_after = pool_after, num_classes = num_classes, res = res)
+  else:
+    model = resnet50_tiling_1fc(pretrained=False, pool_after = pool_after, num_classes = num_classes, res = res, spec = spec, pooling = pooling, pooling_args = pooling_args)
+  model.load_state_dict(torch.load(filename, map_location = map_location))
+  return model
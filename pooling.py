@@ -0,0 +1,143 @@
+import torch
+import torch.nn as nn
+
+
+def tile_segments(counts, res, num_images, device = None):
+	"""
+	Segment id (image * len(res) + position in res) of every tile of whole images tiled by tile_images
+
+	Args:
+		counts: tiles per image of every level, e.g. TilingSpec.counts(H, W)
+		res: list of levels used in tiling
+		num_images: number of images in the minibatch
+	Returns:
+		int64 Tensor of shape [num_images*tiles_per_image]
+	"""
+	per_image = torch.cat([torch.full((counts[r],), i, dtype = torch.long, device = device) for i, r in enumerate(res)])
+	offsets = torch.arange(num_images, device = device).repeat_interleave(per_image.numel()) * len(res)
+	return per_image.repeat(num_images) + offsets
+
+
+def _expand(segments, x):
+	return segments.view(-1, *([1] * (x.dim() - 1))).expand_as(x)
+
+
+def segment_count(segments, num_segments):
+	return torch.bincount(segments, minlength = num_segments)
+
+
+def segment_max(x, segments, num_segments):
+	""" per-segment max of x [num_tiles, ...] -> [num_segments, ...] """
+	out = x.new_zeros((num_segments,) + x.shape[1:])
+	return out.scatter_reduce(0, _expand(segments, x), x, reduce = 'amax', include_self = False)
+
+
+def segment_argmax(x, segments, num_segments):
+	""" index into x of the (first) max of every segment and channel, [num_segments, ...] """
+	m = segment_max(x, segments, num_segments)
+	ids = torch.arange(x.shape[0], device = x.device).view(-1, *([1] * (x.dim() - 1))).expand_as(x)
+	candidates = torch.where(x == m[segments], ids, torch.full_like(ids, x.shape[0]))
+	out = torch.full(m.shape, x.shape[0], dtype = torch.long, device = x.device)
+	return out.scatter_reduce(0, _expand(segments, x), candidates, reduce = 'amin', include_self = True)
+
+
+def segment_sum(x, segments, num_segments):
+	out = x.new_zeros((num_segments,) + x.shape[1:])
+	return out.index_add(0, segments, x)
+
+
+def segment_ranks(x, segments, num_segments):
+	"""
+	Rank of every value of x [num_tiles, C] within its segment and channel, 0 is the largest
+
+	Two stable sorts (by value, then by segment) group the tiles by segment in descending
+	order, so no per-segment loop or padding is needed.
+	"""
+	order = torch.sort(x, dim = 0, descending = True, stable = True)[1]
+	by_segment = torch.sort(segments[order], dim = 0, stable = True)[1]
+	order = order.gather(0, by_segment)
+	counts = segment_count(segments, num_segments)
+	starts = torch.cumsum(counts, 0) - counts
+	position = torch.arange(x.shape[0], device = x.device).unsqueeze(1).expand_as(order)
+	ranks = torch.empty_like(order)
+	ranks.scatter_(0, order, position - starts[segments[order]])
+	return ranks
+
+
+def segment_topk_mean(x, segments, num_segments, k):
+	""" per-segment, per-channel mean of the k largest values (all values if the segment is smaller) """
+	keep = (segment_ranks(x.detach(), segments, num_segments) < k).to(x.dtype)
+	total = segment_sum(x * keep, segments, num_segments)
+	counts = segment_count(segments, num_segments).clamp(min = 1, max = k).to(x.dtype)
+	return total / counts.view(-1, *([1] * (x.dim() - 1)))
+
+
+def segment_logsumexp(x, segments, num_segments, r = 1.0):
+	""" log-sum-exp pooling, (1/r) log(mean(exp(r x))), between mean (r -> 0) and max (r -> inf) """
+	m = segment_max(x, segments, num_segments).detach()
+	total = segment_sum(torch.exp(r * (x - m[segments])), segments, num_segments)
+	counts = segment_count(segments, num_segments).clamp(min = 1).to(x.dtype)
+	return m + torch.log(total / counts.view(-1, *([1] * (x.dim() - 1)))) / r
+
+
+def segment_softmax(scores, segments, num_segments):
+	""" softmax of scores [num_tiles] within each segment """
+	m = segment_max(scores, segments, num_segments).detach()
+	e = torch.exp(scores - m[segments])
+	return e / segment_sum(e, segments, num_segments)[segments]
+
+
+def top_tiles(weights, segments, num_segments, k):
+	""" indices of the k highest weighted tiles of every segment, e.g. to restrict fine level computation """
+	ranks = segment_ranks(weights.view(-1, 1), segments, num_segments).view(-1)
+	return (ranks < k).nonzero().view(-1)
+
+
+class GatedAttentionPool(nn.Module):
+	""" Gated attention MIL pooling (Ilse et al. 2018), a = w^T (tanh(V h) * sigmoid(U h)) """
+
+	def __init__(self, dim, hidden = 128):
+		super(GatedAttentionPool, self).__init__()
+		self.attention_V = nn.Linear(dim, hidden)
+		self.attention_U = nn.Linear(dim, hidden)
+		self.attention_w = nn.Linear(hidden, 1)
+		self.weights = None
+
+	def forward(self, x, segments, num_segments):
+		scores = self.attention_w(torch.tanh(self.attention_V(x)) * torch.sigmoid(self.attention_U(x))).view(-1)
+		weights = segment_softmax(scores, segments, num_segments)
+		# kept for inspection / tile selection after the forward pass
+		self.weights = weights.detach()
+		return segment_sum(x * weights.unsqueeze(1), segments, num_segments)
+
+
+class TilePooling(nn.Module):
+	"""
+	Pools tile features [num_tiles, dim] into [num_segments, dim]
+
+	modes: 'max', 'topk' (mean of the k largest), 'lse' (log-sum-exp with sharpness r),
+	'attention' (gated attention, weights available as .weights after forward)
+	"""
+	def __init__(self, mode = 'max', dim = 2048, k = 8, r = 5.0, hidden = 128):
+		super(TilePooling, self).__init__()
+		if mode not in ['max', 'topk', 'lse', 'attention']:
+			raise ValueError('Unsupported pooling: ' + mode)
+		self.mode = mode
+		self.k = k
+		self.r = r
+		if mode == 'attention':
+			self.attention = GatedAttentionPool(dim, hidden)
+
+	@property
+	def weights(self):
+		return self.attention.weights if self.mode == 'attention' else None
+
+	def forward(self, x, segments, num_segments):
+		x = x.view(x.shape[0], -1)
+		if self.mode == 'max':
+			return segment_max(x, segments, num_segments)
+		elif self.mode == 'topk':
+			return segment_topk_mean(x, segments, num_segments, self.k)
+		elif self.mode == 'lse':
+			return segment_logsumexp(x, segments, num_segments, self.r)
+		return self.attention(x, segments, num_segments)
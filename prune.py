@@ -0,0 +1,287 @@
+from __future__ import print_function, division
+import os
+import json
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+from torch.utils.data import DataLoader
+
+import resnet_helper as H
+from cross_validation import k_folds_2
+from distill import fit_head, trunk_throughput
+from sweep import default_params
+
+
+def _conv(conv, out_keep = None, in_keep = None):
+	""" copy of a Conv2d holding only the kept output / input channels """
+	weight = conv.weight.data
+	if out_keep is not None:
+		weight = weight[out_keep]
+	if in_keep is not None:
+		weight = weight[:, in_keep]
+	pruned = nn.Conv2d(weight.shape[1], weight.shape[0], kernel_size = conv.kernel_size, stride = conv.stride,
+					   padding = conv.padding, dilation = conv.dilation, bias = conv.bias is not None)
+	pruned.weight.data = weight.clone()
+	if conv.bias is not None:
+		pruned.bias.data = (conv.bias.data if out_keep is None else conv.bias.data[out_keep]).clone()
+	pruned.weight.requires_grad = conv.weight.requires_grad
+	pruned.train(conv.training)
+	return pruned
+
+
+def _bn(bn, keep):
+	# same settings, statistics and train / eval mode as the original, for the kept channels
+	pruned = nn.BatchNorm2d(len(keep), eps = bn.eps, momentum = bn.momentum)
+	pruned.weight.data = bn.weight.data[keep].clone()
+	pruned.bias.data = bn.bias.data[keep].clone()
+	pruned.running_mean = bn.running_mean[keep].clone()
+	pruned.running_var = bn.running_var[keep].clone()
+	pruned.num_batches_tracked = bn.num_batches_tracked.clone()
+	pruned.weight.requires_grad = bn.weight.requires_grad
+	pruned.bias.requires_grad = bn.bias.requires_grad
+	pruned.train(bn.training)
+	return pruned
+
+
+def _linear_in(linear, keep):
+	pruned = nn.Linear(len(keep), linear.out_features)
+	pruned.weight.data = linear.weight.data[:, keep].clone()
+	pruned.bias.data = linear.bias.data.clone()
+	pruned.weight.requires_grad = linear.weight.requires_grad
+	pruned.bias.requires_grad = linear.bias.requires_grad
+	pruned.train(linear.training)
+	return pruned
+
+
+def _blocks(model, layers):
+	for layer in layers:
+		for i, block in enumerate(getattr(model, layer)):
+			yield '%s.%d' % (layer, i), block
+
+
+def apply_pruning(model, plan):
+	"""
+	Physically removes trunk channels of a ResNet_Tiling (Bottleneck blocks) in place
+
+	Args:
+		plan: dict of
+			'<layer>.<block>': {'mid1': kept conv1 outputs, 'mid2': kept conv2 outputs} for any block
+			'output': kept channels of the trunk output (last block of layer4, fc1 and pooling follow)
+	Returns:
+		the model, with smaller conv, bn and fc1 weights
+	"""
+	for name, keep in plan.items():
+		if name == 'output':
+			continue
+		layer, index = name.split('.')
+		block = getattr(model, layer)[int(index)]
+		mid1 = torch.as_tensor(keep['mid1'], dtype = torch.long)
+		mid2 = torch.as_tensor(keep['mid2'], dtype = torch.long)
+		block.conv1 = _conv(block.conv1, out_keep = mid1)
+		block.bn1 = _bn(block.bn1, mid1)
+		block.conv2 = _conv(block.conv2, out_keep = mid2, in_keep = mid1)
+		block.bn2 = _bn(block.bn2, mid2)
+		block.conv3 = _conv(block.conv3, in_keep = mid2)
+
+	if 'output' in plan:
+		keep = torch.as_tensor(plan['output'], dtype = torch.long)
+		# only the last block is cut, earlier blocks still need every channel of the residual stream
+		block = model.layer4[-1]
+		block.conv3 = _conv(block.conv3, out_keep = keep)
+		block.bn3 = _bn(block.bn3, keep)
+		block.register_buffer('output_channels', keep.clone())
+
+		dim = model.feature_dim
+		columns = torch.cat([keep + r * dim for r in range(len(model.res))])
+		model.fc1 = _linear_in(model.fc1, columns)
+		if hasattr(model, 'pool') and hasattr(model.pool, 'attention'):
+			model.pool.attention.attention_V = _linear_in(model.pool.attention.attention_V, keep)
+			model.pool.attention.attention_U = _linear_in(model.pool.attention.attention_U, keep)
+		model.feature_dim = len(keep)
+	return model
+
+
+def channel_importance(model, dataset, indices, layers = ('layer3', 'layer4'), batch_size = 1, num_workers = 4,
+					   device = torch.device('cpu')):
+	"""
+	Ranks trunk channels by their contribution to the fc1 logits on training images
+
+	Output channels: mean over images of sum_{level, class} |fc1.weight[class, level, c] * feature[level, c]|.
+	Bottleneck mid channels: first order Taylor estimate mean |activation * d logit / d activation|,
+	with the logit of the labelled class.
+
+	Args:
+		model: trained ResNet_Tiling
+		dataset: TiledPathologyDataset (use fine_tiles to bound the memory of the backward pass)
+		indices: training images of the fold(s)
+	Returns:
+		output scores [feature_dim], dict of block name -> {'mid1': scores, 'mid2': scores}
+	"""
+	model = model.to(device = device).eval()
+	activations = []
+	hooks = []
+	for name, block in _blocks(model, layers):
+		for conv, key in [(block.conv2, 'mid1'), (block.conv3, 'mid2')]:
+			def hook(module, inputs, name = name, key = key):
+				inputs[0].retain_grad()
+				activations.append((name, key, inputs[0]))
+			hooks.append(conv.register_forward_pre_hook(hook))
+	pooled = []
+	hooks.append(model.fc1.register_forward_pre_hook(lambda module, inputs: pooled.append(inputs[0].detach())))
+
+	# gradients only need to reach the pruned layers
+	first = getattr(model, layers[0])
+	trainable = [p.requires_grad for p in first.parameters()]
+	for p in first.parameters():
+		p.requires_grad = True
+
+	loader = DataLoader(torch.utils.data.Subset(dataset, list(indices)), batch_size = batch_size, shuffle = False,
+						num_workers = num_workers, collate_fn = H.collate_tiles)
+	mid = {}
+	output = torch.zeros(model.feature_dim, dtype = torch.float64)
+	weight = model.fc1.weight.detach().cpu().view(model.fc1.out_features, len(model.res), -1).abs()
+	count = 0
+	try:
+		for x, labels in loader:
+			del activations[:]
+			x = tuple(t.to(device = device) for t in x)
+			scores = model(x)
+			scores.gather(1, labels.to(device = device).view(-1, 1)).sum().backward()
+			for name, key, a in activations:
+				contribution = (a * a.grad).abs().sum((0, 2, 3)).detach().cpu().double()
+				scores_block = mid.setdefault(name, {})
+				scores_block[key] = scores_block.get(key, 0) + contribution
+			features = pooled.pop().cpu().view(-1, len(model.res), model.feature_dim).abs()
+			output += torch.einsum('nrc,krc->c', features, weight).double()
+			count += features.shape[0]
+			model.zero_grad()
+	finally:
+		for h in hooks:
+			h.remove()
+		for p, t in zip(first.parameters(), trainable):
+			p.requires_grad = t
+			p.grad = None
+
+	mid = dict((name, dict((key, (v / count).numpy()) for key, v in keys.items())) for name, keys in mid.items())
+	return (output / count).numpy(), mid
+
+
+def _top(scores, ratio, multiple = 8):
+	""" indices (ascending) of the highest scores, keeping a multiple of `multiple` channels """
+	keep = int(round(len(scores) * (1 - ratio) / multiple)) * multiple
+	keep = min(len(scores), max(multiple, keep))
+	return np.sort(np.argsort(-scores, kind = 'stable')[:keep])
+
+
+def make_plan(output_scores, mid_scores, ratio, output_ratio = None, multiple = 8):
+	"""
+	Pruning plan removing `ratio` of the mid channels of every scored block and `output_ratio`
+	(default ratio) of the trunk output channels, see apply_pruning
+	"""
+	output_ratio = ratio if output_ratio is None else output_ratio
+	plan = {}
+	for name, keys in mid_scores.items():
+		plan[name] = dict((key, _top(scores, ratio, multiple).tolist()) for key, scores in keys.items())
+	if output_ratio > 0:
+		plan['output'] = _top(output_scores, output_ratio, multiple).tolist()
+	return plan
+
+
+def pooled_features(model, dataset, batch_size = 1, num_workers = 4, device = torch.device('cpu')):
+	""" fc1 inputs [num_images, len(res)*feature_dim] of every image of a TiledPathologyDataset """
+	loader = DataLoader(dataset, batch_size = batch_size, shuffle = False, num_workers = num_workers, collate_fn = H.collate_tiles)
+	model = model.to(device = device).eval()
+	features = []
+	with torch.no_grad():
+		for (tiles, levels, image_index), _ in loader:
+			num_images = int(image_index[-1]) + 1
+			x = model.tile_features((tiles.to(device = device), levels, image_index))
+			features.append(H.max_tile_segments(x, levels.to(device = device), image_index.to(device = device), num_images, len(model.res)).cpu())
+	return torch.cat(features, 0)
+
+
+def count_parameters(model):
+	return sum(p.numel() for p in model.parameters())
+
+
+def prune_curve(load_model, dataset, eval_dataset, ratios, n_splits = 10, folds = None, importance_images = 32,
+				epochs = 100, params = None, batch_size = 1, num_workers = 4, device = torch.device('cpu'), seed = 7):
+	"""
+	Accuracy / throughput curve of pruned trunks
+
+	Channels are ranked inside every k_folds_2 fold on training images of that fold only, then for every
+	ratio each fold's trunk is pruned with its own ranking and fc1 retrained on the fold. The kept channel
+	counts do not depend on the ranking, so parameters and trunk throughput are the same in every fold.
+
+	Args:
+		load_model: callable returning a fresh trained ResNet_Tiling
+		dataset: TiledPathologyDataset for the importance pass (fine_tiles to bound memory)
+		eval_dataset: TiledPathologyDataset with every tile, in the label order of the folds
+		ratios: fractions of channels removed, e.g. [0, 0.25, 0.5]
+	Returns:
+		list of dicts per ratio: ratio, params, tiles_per_s, fold accuracy, mean accuracy, plan of every fold
+	"""
+	params = dict(default_params, **(params or {}))
+	labels = np.asarray(eval_dataset.img_labels, dtype = np.int64)
+	splits = list(k_folds_2(n_splits, labels = labels, seed = seed))[:folds or n_splits]
+	rng = np.random.RandomState(seed)
+	scores = []
+	for fold, (train_idx, _) in enumerate(splits):
+		importance = rng.choice(train_idx, min(importance_images, len(train_idx)), replace = False)
+		print('Ranking channels of fold %d on %d training images' % (fold, len(importance)))
+		scores.append(channel_importance(load_model(), dataset, importance, batch_size = batch_size,
+										 num_workers = num_workers, device = device))
+
+	curve = []
+	for ratio in ratios:
+		plans, accuracy, features = [], [], None
+		for fold, (train_idx, test_idx) in enumerate(splits):
+			plan = make_plan(scores[fold][0], scores[fold][1], ratio) if ratio > 0 else {}
+			# unpruned, every fold has the same features
+			if features is None or plan:
+				model = load_model()
+				apply_pruning(model, plan)
+				features = pooled_features(model, eval_dataset, batch_size, num_workers, device)
+			accuracy.append(fit_head(features, labels, train_idx, test_idx, params, epochs, seed = fold))
+			plans.append(plan)
+		point = {'ratio': ratio, 'params': count_parameters(model), 'tiles_per_s': trunk_throughput(model, device = device),
+				 'fold_accuracy': accuracy, 'accuracy': float(np.mean(accuracy)), 'plans': plans}
+		print('Pruned %.2f: %d parameters, %.1f tiles/s, accuracy %.4f' % (ratio, point['params'], point['tiles_per_s'], point['accuracy']))
+		curve.append(point)
+	return curve
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Channel pruning of the frozen trunk guided by fc1')
+	parser.add_argument('--checkpoint', required = True, help = 'trained ResNet_Tiling state_dict (train_net.py model_<fold>.pt)')
+	parser.add_argument('--img_dir', required = True)
+	parser.add_argument('--out', default = 'prune.json')
+	parser.add_argument('--res', type = int, nargs = '+', default = [0, 1, 2])
+	parser.add_argument('--ratios', type = float, nargs = '+', default = [0, 0.25, 0.5, 0.75])
+	parser.add_argument('--k', type = int, default = 10)
+	parser.add_argument('--folds', type = int, default = None)
+	parser.add_argument('--importance_images', type = int, default = 32)
+	parser.add_argument('--fine_tiles', type = int, default = 32, help = 'finest level tiles per image in the importance pass')
+	parser.add_argument('--epochs', type = int, default = 100)
+	parser.add_argument('--num_workers', type = int, default = 4)
+	args = parser.parse_args()
+
+	import nets
+	import transformations
+	from PathologyDataset import TiledPathologyDataset
+
+	device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+	load_model = lambda: nets.load_tiling_checkpoint(args.checkpoint, res = args.res)
+	dataset = TiledPathologyDataset(img_dir = args.img_dir, transform = transformations.tiling_val_uint8(), shuffle = False,
+									res = args.res, fine_tiles = args.fine_tiles)
+	eval_dataset = TiledPathologyDataset(img_dir = args.img_dir, transform = transformations.tiling_val_uint8(), shuffle = False, res = args.res)
+	curve = prune_curve(load_model, dataset, eval_dataset, args.ratios, args.k, args.folds, args.importance_images,
+						args.epochs, {'res': args.res}, num_workers = args.num_workers, device = device)
+	with open(args.out, 'w') as f:
+		json.dump(curve, f, indent = 1)
+
+
+if __name__ == '__main__':
+	main()
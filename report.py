@@ -0,0 +1,223 @@
+from __future__ import print_function, division
+import os
+import re
+import json
+import argparse
+import numpy as np
+
+import results as R
+
+
+def _fold_files(run_dir):
+	"""(fold, path, format) of the result file of every fold of a run, one per fold
+
+	A fold written in several formats (e.g. a legacy predict txt next to the .cols of a rerun in
+	place) uses the newest format: cols, then csv, then txt.
+	"""
+	priority = {'cols': 0, 'csv': 1, 'txt': 2}
+	found = {}
+	for directory in [run_dir, os.path.join(run_dir, 'predict')]:
+		if not os.path.isdir(directory):
+			continue
+		for name in os.listdir(directory):
+			for pattern, fmt in [(r'results_(\d+)\.cols$', 'cols'), (r'results_(\d+)\.csv$', 'csv'), (r'predict(\d+)\.txt$', 'txt')]:
+				match = re.match(pattern, name)
+				if match:
+					fold = int(match.group(1))
+					if fold not in found or priority[fmt] < priority[found[fold][1]]:
+						found[fold] = (os.path.join(directory, name), fmt)
+	return [(fold, path, fmt) for fold, (path, fmt) in sorted(found.items())]
+
+
+def load_run(run_dir, num_classes = 4):
+	"""
+	Loads all fold results of a run in bulk
+
+	Reads results_<fold>.cols (results.ResultsWriter), legacy results_<fold>.csv or
+	predict/predict<fold>.txt (tab separated: id, p0..p3, pred, label, eval).
+
+	Returns:
+		probs [N, num_classes], labels [N], folds [N]
+	"""
+	import pandas as pd
+	probs, labels, folds = [], [], []
+	for fold, path, fmt in _fold_files(run_dir):
+		if fmt == 'cols':
+			r = R.read_results(path)
+			p = np.stack([r['p%d' % c] for c in range(num_classes)], 1)
+			y = r['label']
+		elif fmt == 'csv':
+			frame = pd.read_csv(path)
+			p = frame[['p%d' % c for c in range(num_classes)]].values
+			y = frame['label'].values
+		else:
+			frame = pd.read_csv(path, sep = '\t', header = None)
+			p = frame.iloc[:, 1:1 + num_classes].values
+			# prediction comes before the label in these files
+			y = frame.iloc[:, 2 + num_classes].values
+		probs.append(np.asarray(p, dtype = np.float64))
+		labels.append(np.asarray(y, dtype = np.int64))
+		folds.append(np.full(len(y), fold, dtype = np.int64))
+
+	if not probs:
+		raise ValueError('No result files found in ' + run_dir)
+	return np.concatenate(probs), np.concatenate(labels), np.concatenate(folds)
+
+
+def confusion_matrix(labels, preds, num_classes):
+	""" [num_classes, num_classes] counts, rows are labels and columns predictions """
+	return np.bincount(labels * num_classes + preds, minlength = num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def precision_recall(confusion):
+	""" per-class precision, recall and f1 from a confusion matrix """
+	tp = np.diag(confusion).astype(np.float64)
+	precision = tp / np.maximum(confusion.sum(0), 1)
+	recall = tp / np.maximum(confusion.sum(1), 1)
+	f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+	return precision, recall, f1
+
+
+def _average_ranks(x):
+	# 1-based ranks, tied values share their average rank
+	order = np.argsort(x, kind = 'mergesort')
+	sorted_x = x[order]
+	_, inverse, counts = np.unique(sorted_x, return_inverse = True, return_counts = True)
+	ends = np.cumsum(counts)
+	average = ends - (counts - 1) / 2.0
+	ranks = np.empty(len(x), dtype = np.float64)
+	ranks[order] = average[inverse]
+	return ranks
+
+
+def roc_auc(scores, positive):
+	""" area under the ROC curve from the Mann-Whitney U statistic, handling ties """
+	n_pos = positive.sum()
+	n_neg = len(positive) - n_pos
+	if n_pos == 0 or n_neg == 0:
+		return float('nan')
+	ranks = _average_ranks(scores)
+	return float((ranks[positive].sum() - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
+
+
+def one_vs_rest_auc(probs, labels):
+	return np.array([roc_auc(probs[:, c], labels == c) for c in range(probs.shape[1])])
+
+
+def calibration(probs, labels, bins = 10):
+	"""
+	Reliability of the top-class probability
+
+	Returns:
+		ece, and per bin: count, mean confidence, accuracy
+	"""
+	confidence = probs.max(1)
+	correct = (probs.argmax(1) == labels).astype(np.float64)
+	which = np.minimum((confidence * bins).astype(np.int64), bins - 1)
+	count = np.bincount(which, minlength = bins).astype(np.float64)
+	mean_confidence = np.bincount(which, confidence, minlength = bins) / np.maximum(count, 1)
+	accuracy = np.bincount(which, correct, minlength = bins) / np.maximum(count, 1)
+	ece = float(np.sum(count / len(labels) * np.abs(accuracy - mean_confidence)))
+	return ece, count, mean_confidence, accuracy
+
+
+def bootstrap(probs, labels, num_samples = 1000, alpha = 0.05, block = 100, seed = 0):
+	"""
+	Percentile bootstrap confidence intervals of accuracy, macro recall and macro one-vs-rest AUC
+
+	Resamples are evaluated block rows at a time as [block, N] index matrices.
+
+	Returns:
+		dict of metric -> (low, high)
+	"""
+	rng = np.random.RandomState(seed)
+	n, num_classes = probs.shape
+	preds = probs.argmax(1)
+	correct = preds == labels
+	stats = {'accuracy': [], 'macro_recall': [], 'macro_auc': []}
+
+	for start in range(0, num_samples, block):
+		b = min(block, num_samples - start)
+		idx = rng.randint(0, n, size = (b, n))
+		stats['accuracy'].append(correct[idx].mean(1))
+
+		rows = np.repeat(np.arange(b), n)
+		y = labels[idx]
+		hits = np.bincount(rows * num_classes + y.ravel(), correct[idx].ravel(), minlength = b * num_classes).reshape(b, num_classes)
+		support = np.bincount(rows * num_classes + y.ravel(), minlength = b * num_classes).reshape(b, num_classes)
+		stats['macro_recall'].append(np.nanmean(np.where(support > 0, hits / np.maximum(support, 1), np.nan), 1))
+
+		aucs = np.empty((b, num_classes))
+		for c in range(num_classes):
+			scores = probs[idx, c]
+			# ranks along each resample (ties broken by order, probabilities rarely tie)
+			ranks = np.empty_like(scores)
+			np.put_along_axis(ranks, np.argsort(scores, axis = 1), np.arange(1, n + 1, dtype = np.float64)[None, :], axis = 1)
+			positive = y == c
+			n_pos = positive.sum(1).astype(np.float64)
+			n_neg = n - n_pos
+			u = (ranks * positive).sum(1) - n_pos * (n_pos + 1) / 2.0
+			with np.errstate(invalid = 'ignore', divide = 'ignore'):
+				aucs[:, c] = np.where((n_pos > 0) & (n_neg > 0), u / (n_pos * n_neg), np.nan)
+		stats['macro_auc'].append(np.nanmean(aucs, 1))
+
+	intervals = {}
+	for name, values in stats.items():
+		values = np.concatenate(values)
+		intervals[name] = (float(np.nanpercentile(values, 100 * alpha / 2)), float(np.nanpercentile(values, 100 * (1 - alpha / 2))))
+	return intervals
+
+
+def summarize(probs, labels, folds, num_bootstrap = 1000, bins = 10, seed = 0):
+	""" all metrics of one run as a json-serializable dict """
+	num_classes = probs.shape[1]
+	preds = probs.argmax(1)
+	correct = preds == labels
+	confusion = confusion_matrix(labels, preds, num_classes)
+	precision, recall, f1 = precision_recall(confusion)
+	auc = one_vs_rest_auc(probs, labels)
+	ece, count, mean_confidence, accuracy = calibration(probs, labels, bins)
+
+	fold_ids, fold_inverse = np.unique(folds, return_inverse = True)
+	fold_acc = np.bincount(fold_inverse, correct) / np.bincount(fold_inverse)
+
+	summary = {
+		'samples': int(len(labels)),
+		'accuracy': float(correct.mean()),
+		'fold_accuracy': dict((str(f), float(a)) for f, a in zip(fold_ids, fold_acc)),
+		'mean_fold_accuracy': float(fold_acc.mean()),
+		'confusion': confusion.tolist(),
+		'precision': precision.tolist(),
+		'recall': recall.tolist(),
+		'f1': f1.tolist(),
+		'auc': auc.tolist(),
+		'macro_auc': float(np.nanmean(auc)),
+		'ece': ece,
+		'calibration': {'count': count.tolist(), 'confidence': mean_confidence.tolist(), 'accuracy': accuracy.tolist()},
+	}
+	if num_bootstrap > 0:
+		summary['ci95'] = bootstrap(probs, labels, num_bootstrap, seed = seed)
+	return summary
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Cross-fold metrics over prediction files')
+	parser.add_argument('runs', nargs = '+', help = 'run directories holding results_<fold> / predict<fold> files')
+	parser.add_argument('--out', default = 'summary.json')
+	parser.add_argument('--num_classes', type = int, default = 4)
+	parser.add_argument('--bootstrap', type = int, default = 1000)
+	parser.add_argument('--bins', type = int, default = 10)
+	args = parser.parse_args()
+
+	summaries = {}
+	for run in args.runs:
+		probs, labels, folds = load_run(run, args.num_classes)
+		summaries[run] = summarize(probs, labels, folds, args.bootstrap, args.bins)
+		print('%s: accuracy %.4f, macro AUC %.4f, ECE %.4f' % (run, summaries[run]['accuracy'], summaries[run]['macro_auc'], summaries[run]['ece']))
+
+	with open(args.out, 'w') as f:
+		json.dump(summaries, f, indent = 1)
+
+
+if __name__ == '__main__':
+	main()
@@ -4,7 +4,7 @@ import torch.nn.functional as F
 import math
 import torch.utils.model_zoo as model_zoo
 import resnet_helper as H
-import pdb
+import pooling as P
 
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
@@ -90,6 +90,9 @@ class Bottleneck(nn.Module):
 
         if self.downsample is not None:
             residual = self.downsample(x)
+        if hasattr(self, 'output_channels'):
+            # output channels removed by prune.py, keep the matching residual channels
+            residual = residual.index_select(1, self.output_channels)
 
         out += residual
         out = self.relu(out)
@@ -381,23 +384,44 @@ class ResNet_Tiling_2fc(nn.Module):
 class ResNet_Tiling(nn.Module):
 	### ResNet with Tiling and 1 fc layer
 
-	def __init__(self, block, layers, num_classes=1000, res = [0,1,2]):
-		self.inplanes = 64
+	def __init__(self, block, layers, num_classes=1000, res = [0,1,2], spec = None, pooling = 'max', pooling_args = {},
+				 width = 64, feature_dim = None, recompute_argmax = False, freeze_bn = False):
+		### pooling: 'max' (max_tile), 'topk', 'lse' or 'attention', see pooling.TilePooling
+		### width: channels of conv1 / layer1 (64 for the standard trunks), narrower trunks for distilled students
+		### feature_dim: adds a 1x1 projection of the trunk output to feature_dim channels (e.g. 2048 to match a ResNet-50 teacher)
+		### recompute_argmax: when training through an unfrozen trunk with max pooling, run all tiles without grad and
+		### recompute only the max tiles with grad (same gradients, activations kept for the winning tiles only),
+		### only active while every BatchNorm uses its running statistics (freeze_bn), otherwise the full pass runs
+		### freeze_bn: keep every BatchNorm in eval mode in training (running statistics, no updates of the buffers)
+		self.inplanes = width
 		super(ResNet_Tiling, self).__init__()
-		self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
+		self.conv1 = nn.Conv2d(3, width, kernel_size=7, stride=2, padding=3,
 							   bias=False)
-		self.bn1 = nn.BatchNorm2d(64)
+		self.bn1 = nn.BatchNorm2d(width)
 		self.relu = nn.ReLU(inplace=True)
 		self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-		self.layer1 = self._make_layer(block, 64, layers[0])
-		self.layer2 = self._make_layer(block, 128, layers[1], stride=2)
-		self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
-		self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
+		self.layer1 = self._make_layer(block, width, layers[0])
+		self.layer2 = self._make_layer(block, width * 2, layers[1], stride=2)
+		self.layer3 = self._make_layer(block, width * 4, layers[2], stride=2)
+		self.layer4 = self._make_layer(block, width * 8, layers[3], stride=2)
 		self.avgpool = nn.AvgPool2d(7, stride=1)
-		self.fc1 = nn.Linear(512 * block.expansion * len(res), num_classes)
+		self.feature_dim = width * 8 * block.expansion
+		if feature_dim is not None:
+			self.project = nn.Conv2d(self.feature_dim, feature_dim, kernel_size=1)
+			self.feature_dim = feature_dim
+		self.fc1 = nn.Linear(self.feature_dim * len(res), num_classes)
 		self.res = res
+		self.spec = spec if spec is not None else H.default_spec()
 		self.global_maxpool = H.max_tile
 		self.tiling = H.tile_images
+		self.pooling = pooling
+		self.recompute_argmax = recompute_argmax
+		self.freeze_bn = freeze_bn
+		self.recomputed = None
+		# tiles per trunk pass when the batch statistics are not used (eval, or freeze_bn), None runs all tiles at once
+		self.trunk_chunk = None
+		if pooling != 'max':
+			self.pool = P.TilePooling(pooling, self.feature_dim, **pooling_args)
 
 		for m in self.modules():
 			if isinstance(m, nn.Conv2d):
@@ -426,10 +450,42 @@ class ResNet_Tiling(nn.Module):
 
 		return nn.Sequential(*layers)
 
-	def forward(self, x):
-		num_images = x.shape[0]
-		x = self.tiling(x, self.res)
-		# x = batch_image_normalize(x, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+	def train(self, mode=True):
+		super(ResNet_Tiling, self).train(mode)
+		if self.freeze_bn:
+			for m in self.modules():
+				if isinstance(m, nn.BatchNorm2d):
+					m.eval()
+		return self
+
+	def _batch_statistics(self):
+		### whether some BatchNorm normalizes with (and updates from) the statistics of the current batch
+		return any(m.training for m in self.modules() if isinstance(m, nn.BatchNorm2d))
+
+	def _recompute(self):
+		# batch statistics would differ between the full and the recomputed pass, the recompute needs frozen BatchNorm
+		return (self.recompute_argmax and self.pooling == 'max' and self.training and torch.is_grad_enabled()
+				and not self._batch_statistics())
+
+	def recompute_max(self, x, segments, num_segments):
+		### max pooling of trunk(x) [num_segments,feature_dim] whose graph only holds the winning tiles
+		with torch.no_grad():
+			features = self.trunk(x).view(x.shape[0], -1)
+			index = P.segment_argmax(features, segments, num_segments)
+		del features
+		winners, position = torch.unique(index, return_inverse=True)
+		self.recomputed = (winners.numel(), x.shape[0])
+		features = self.trunk(x[winners]).view(winners.numel(), -1)
+		return features.gather(0, position)
+
+	def trunk(self, x):
+		### conv1..avgpool (and projection) on a batch of tiles, returns [num_tiles,feature_dim,1,1]
+		### in chunks of trunk_chunk tiles when that does not change BatchNorm (see memory_planner.py)
+		if self.trunk_chunk and x.shape[0] > self.trunk_chunk and not self._batch_statistics():
+			return torch.cat([self._trunk(chunk) for chunk in x.split(self.trunk_chunk)], 0)
+		return self._trunk(x)
+
+	def _trunk(self, x):
 		x = self.conv1(x)
 		x = self.bn1(x)
 		x = self.relu(x)
@@ -441,13 +497,82 @@ class ResNet_Tiling(nn.Module):
 		x = self.layer4(x)
 
 		x = self.avgpool(x)
+		if hasattr(self, 'project'):
+			x = self.project(x)
+		return x
 
-		x = self.global_maxpool(x, num_images, self.res)
-		x = x.view(x.size(0), -1)
+	trunk_stages = ['maxpool', 'layer1', 'layer2', 'layer3', 'layer4']
+
+	def trunk_until(self, x, stage):
+		### conv1..stage (inclusive) on a batch of tiles, e.g. 'layer3' gives [num_tiles,256*expansion,14,14]
+		x = self.maxpool(self.relu(self.bn1(self.conv1(x))))
+		for name in self.trunk_stages[1:self.trunk_stages.index(stage) + 1]:
+			x = getattr(self, name)(x)
+		return x
+
+	def trunk_from(self, x, stage):
+		### rest of the trunk on the output of stage (see trunk_until), returns [num_tiles,feature_dim,1,1]
+		for name in self.trunk_stages[self.trunk_stages.index(stage) + 1:]:
+			x = getattr(self, name)(x)
+		x = self.avgpool(x)
+		if hasattr(self, 'project'):
+			x = self.project(x)
+		return x
+
+	def tile_features(self, x):
+		### per-tile features for whole images or pre-cut tiles, returns [num_tiles,feature_dim]
+		if isinstance(x, (tuple, list)):
+			x = H.normalize_tiles_uint8(x[0], dtype=self.conv1.weight.dtype)
+		else:
+			x = self.tiling(x, self.res, self.spec)
+		x = self.trunk(x)
+		return x.view(x.size(0), -1)
+
+	def forward(self, x):
+		if isinstance(x, (tuple, list)):
+			return self.forward_tiles(*x)
+		num_images = x.shape[0]
+		counts = self.spec.counts(x.shape[2], x.shape[3])
+		x = self.tiling(x, self.res, self.spec)
+		# x = batch_image_normalize(x, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+		if self._recompute():
+			segments = P.tile_segments(counts, self.res, num_images, device=x.device)
+			x = self.recompute_max(x, segments, num_images * len(self.res))
+			return self.fc1(x.view(num_images, -1))
+		x = self.trunk(x)
+
+		if self.pooling == 'max':
+			x = self.global_maxpool(x, num_images, self.res, counts)
+		else:
+			segments = P.tile_segments(counts, self.res, num_images, device=x.device)
+			x = self.pool(x, segments, num_images * len(self.res))
+		x = x.view(num_images, -1)
 		x = self.fc1(x)
 		
 		return x
 
+	def forward_tiles(self, tiles, levels, image_index):
+		### forward on pre-cut uint8 tiles (see PathologyDataset.TiledPathologyDataset)
+		### tiles of one image must stay together, so this is not split by nn.DataParallel
+		num_images = int(image_index[-1]) + 1
+		x = H.normalize_tiles_uint8(tiles, dtype=self.conv1.weight.dtype)
+		if self._recompute():
+			x = self.recompute_max(x, image_index * len(self.res) + levels, num_images * len(self.res))
+			return self.fc1(x.view(num_images, -1))
+		x = self.trunk(x)
+		return self.head(x, levels, image_index, num_images)
+
+	def head(self, x, levels, image_index, num_images):
+		### pooling and fc1 on tile features [num_tiles,feature_dim(,1,1)], e.g. from tile_features
+		if self.pooling == 'max':
+			x = H.max_tile_segments(x, levels, image_index, num_images, len(self.res))
+		else:
+			x = self.pool(x, image_index * len(self.res) + levels, num_images * len(self.res))
+		x = x.view(num_images, -1)
+		x = self.fc1(x)
+
+		return x
+
 
 
 class ResNet_Tiling_maxpool_after(nn.Module):
@@ -606,10 +731,11 @@ def resnet50_tiling_2fc(pretrained=False, **kwargs):
 	model.fc2.bias.requires_grad = True
 	return model
 
-def resnet50_tiling_1fc(pretrained=False, pool_after=False, **kwargs):
+def resnet50_tiling_1fc(pretrained=False, pool_after=False, unfreeze=[], **kwargs):
 	"""Constructs a ResNet-50 model.
 	Args:
 		pretrained (bool): If True, returns a model pre-trained on ImageNet
+		unfreeze (list): trunk modules trained with fc1, e.g. ['layer4'] (see recompute_argmax)
 	"""
 	if pool_after:
 		model = ResNet_Tiling_maxpool_after(Bottleneck, [3, 4, 6, 3], **kwargs)
@@ -632,6 +758,28 @@ def resnet50_tiling_1fc(pretrained=False, pool_after=False, **kwargs):
 	### Set fc layers to be trainabale
 	model.fc1.weight.requires_grad = True
 	model.fc1.bias.requires_grad = True
+
+	### Set attention pooling to be trainable
+	if hasattr(model, 'pool'):
+		for param in model.pool.parameters():
+			param.requires_grad = True
+
+	### Set unfrozen trunk layers to be trainable
+	for name in unfreeze:
+		for param in getattr(model, name).parameters():
+			param.requires_grad = True
+	return model
+
+
+def resnet18_tiling_student(pretrained=False, width=64, feature_dim=2048, **kwargs):
+	"""Constructs a ResNet-18 tiling model projecting to the ResNet-50 feature size, as a distillation student.
+	Args:
+		pretrained (bool): If True, initializes the trunk from ImageNet (only for width 64)
+		width (int): channels of conv1 / layer1, 32 gives a narrower and ~4x cheaper trunk
+	"""
+	model = ResNet_Tiling(BasicBlock, [2, 2, 2, 2], width=width, feature_dim=feature_dim, **kwargs)
+	if pretrained and width == 64:
+		model.load_state_dict(model_zoo.load_url(model_urls['resnet18']), strict = False)
 	return model
 
 
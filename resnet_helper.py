@@ -4,8 +4,6 @@ import torch.nn.functional as F
 import math
 import numpy as np
 
-import pdb
-
 def batch_image_normalize(images,  mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
 	""" Normalization of each tile instead of global image - not currently used"""
 	batchsize, h, w = images.shape[0], images.shape[2], images.shape[3]
@@ -60,33 +58,175 @@ def tile_images_2res(images):
   
 	return torch.cat(im_list,0)
 
-def tile_images(images, res):
-	""" Tile image in a feature pyramid like setup - 2 resolutions """
-	if images.shape[2] != 1536 or images.shape[3] != 2048:
-		raise ValueError('Image to be tiled was not 1536x2048, instead it was: '
-					 + images.shape[2] + 'x' + images.shape[3])
-		
+class TileLevel(object):
+	""" Geometry of one tiling resolution """
+	def __init__(self, scale=1.0, size=None, tile=224, stride=112, pad='fit', whole=False):
+		"""
+		Args: 
+			scale: resize factor applied to the input image (ignored if size is given)
+			size: (height, width) the input image is resized to, None to use scale
+			tile: tile size
+			stride: tile stride
+			pad: 'fit' pads top and right just enough for the stride grid to cover the image,
+				'none' drops the remainder, or an explicit (left, right, top, bottom) tuple
+			whole: resize the whole image to a single tile x tile tile
+		"""
+		self.scale = scale
+		self.size = size
+		self.tile = tile
+		self.stride = stride
+		self.pad = pad
+		self.whole = whole
+
+	def resized(self, height, width):
+		if self.whole:
+			return self.tile, self.tile
+		if self.size is not None:
+			return tuple(self.size)
+		return int(round(height * self.scale)), int(round(width * self.scale))
+
+	def padding(self, height, width):
+		""" (left, right, top, bottom) padding of the resized image """
+		if self.whole or self.pad == 'none':
+			return (0, 0, 0, 0)
+		if self.pad != 'fit':
+			return tuple(self.pad)
+		h, w = self.resized(height, width)
+		fit = lambda n: self.tile - n if n < self.tile else -(n - self.tile) % self.stride
+		return (0, fit(w), fit(h), 0)
+
+	def grid(self, height, width):
+		""" rows and cols of tiles """
+		h, w = self.resized(height, width)
+		left, right, top, bottom = self.padding(height, width)
+		return (h + top + bottom - self.tile) // self.stride + 1, (w + left + right - self.tile) // self.stride + 1
+
+	def __repr__(self):
+		return 'TileLevel(scale=%r, size=%r, tile=%r, stride=%r, pad=%r, whole=%r)' % (self.scale, self.size, self.tile, self.stride, self.pad, self.whole)
+
+
+tile_table_dtype = np.dtype([('level', np.int8), ('row', np.int16), ('col', np.int16),
+							 ('y0', np.float32), ('x0', np.float32), ('y1', np.float32), ('x1', np.float32)])
+
+class TilingSpec(object):
+	"""
+	Tiling geometry of all resolutions, and the tile index table derived from it
+
+	The table lists every tile of an image in tiling order (level, row, col and source box in
+	input pixels, clipped to the image) and is computed once per input size.
+	"""
+	def __init__(self, levels):
+		self.levels = list(levels)
+		self._tables = {}
+
+	def table(self, height, width):
+		key = (height, width)
+		if key not in self._tables:
+			parts = []
+			for l, level in enumerate(self.levels):
+				rows, cols = level.grid(height, width)
+				h, w = level.resized(height, width)
+				left, right, top, bottom = level.padding(height, width)
+				part = np.zeros(rows * cols, dtype=tile_table_dtype)
+				part['level'] = l
+				part['row'], part['col'] = np.divmod(np.arange(rows * cols), cols)
+				# tile box in the padded resized image, mapped back to input pixels
+				sy, sx = height / float(h), width / float(w)
+				part['y0'] = np.clip((part['row'] * level.stride - top) * sy, 0, height)
+				part['x0'] = np.clip((part['col'] * level.stride - left) * sx, 0, width)
+				part['y1'] = np.clip((part['row'] * level.stride - top + level.tile) * sy, 0, height)
+				part['x1'] = np.clip((part['col'] * level.stride - left + level.tile) * sx, 0, width)
+				parts.append(part)
+			self._tables[key] = np.concatenate(parts)
+		return self._tables[key]
+
+	def counts(self, height, width):
+		""" number of tiles of every level """
+		return np.bincount(self.table(height, width)['level'], minlength=len(self.levels)).tolist()
+
+	def tile_table(self, res, height, width):
+		""" table rows of the levels in res, in the order tile_images produces them """
+		table = self.table(height, width)
+		return np.concatenate([table[table['level'] == r] for r in res])
+
+	def tile(self, image, r):
+		"""
+		Tiles one image at level r
+
+		Args: 
+			image: Tensor of shape [1,3,H,W]
+		Returns: 
+			Tensor of shape [rows*cols,3,tile,tile]
+		"""
+		level = self.levels[r]
+		height, width = image.shape[2], image.shape[3]
+		size = level.resized(height, width)
+		if size != (height, width):
+			image = F.interpolate(image, list(size), mode = 'bilinear')
+		pad = level.padding(height, width)
+		if any(pad):
+			image = F.pad(image, pad, mode = "constant")
+		rows, cols = level.grid(height, width)
+		t, s = level.tile, level.stride
+		image = image[:, :, :(rows - 1) * s + t, :(cols - 1) * s + t]
+		tiles = image.unfold(2, t, s).unfold(3, t, s)
+		return tiles.permute(0, 2, 3, 1, 4, 5).reshape(-1, image.shape[1], t, t)
+
+	def __repr__(self):
+		return 'TilingSpec(%r)' % self.levels
+
+
+def default_spec():
+	""" the original geometry: 224x224 whole image, 384x512 and full resolution tiled 224/112 """
+	return TilingSpec([TileLevel(tile=224, whole=True),
+					   TileLevel(scale=0.25, tile=224, stride=112, pad='fit'),
+					   TileLevel(scale=1.0, tile=224, stride=112, pad='fit')])
+
+def heatmap(spec, values, level, height, width, out_shape=None):
+	"""
+	Paints per-tile values of one level into an image aligned map, overlapping tiles keep the max
+
+	Args: 
+		spec: TilingSpec used for tiling
+		values: [rows*cols] value of every tile of the level, in tiling order
+		level: tiling level
+		height, width: input image size
+		out_shape: (h, w) of the map, defaults to the input size
+	Returns: 
+		numpy array of shape out_shape
+	"""
+	table = spec.table(height, width)
+	table = table[table['level'] == level]
+	oh, ow = out_shape if out_shape is not None else (height, width)
+	sy, sx = oh / float(height), ow / float(width)
+	out = np.full((oh, ow), -np.inf, dtype=np.float32)
+	for t, v in zip(table, np.asarray(values, dtype=np.float32)):
+		y0, y1 = int(np.floor(t['y0'] * sy)), int(np.ceil(t['y1'] * sy))
+		x0, x1 = int(np.floor(t['x0'] * sx)), int(np.ceil(t['x1'] * sx))
+		np.maximum(out[y0:y1, x0:x1], v, out=out[y0:y1, x0:x1])
+	return out
+
+def tile_images(images, res, spec=None):
+	"""
+	Tile image in a feature pyramid like setup
+
+	Args: 
+		images: Tensor of shape [num_images,3,H,W]
+		res: list of levels of spec used in tiling
+		spec: TilingSpec, defaults to default_spec()
+	Returns: 
+		Tensor of shape [num_images*tiles_per_image,3,tile,tile], tiles of each image grouped by level in res order
+	"""
+	if spec is None:
+		spec = default_spec()
+
 	num_images = images.shape[0]
 	im_list = list(torch.chunk(images,num_images,0))
 
-	f_dict = {'0': '_tile_base(im)', '1': '_tile_res1(im)', '2': '_tile_res2(im)' }
-
 	del images
 	counter=0
 	for im in im_list:
-		tiles = eval(f_dict[str(res[0])])
-		if tiles.shape[0] == 1:
-			im_list[counter] = tiles
-		else:
-			im_list[counter] = torch.cat(tiles, 0)
-		
-		for r in res[1:]:
-			tiles = eval(f_dict[str(r)])
-			im_list[counter] = torch.cat([im_list[counter], tiles], 0)
-
-		# for i in res:
-		# 	tiles = eval(f_dict[str(i)])
-		# im_list[counter] = torch.cat(tiles,0)
+		im_list[counter] = torch.cat([spec.tile(im, r) for r in res], 0)
 		counter+=1
   
 	return torch.cat(im_list,0)
@@ -233,7 +373,7 @@ def _max_tile_global_avg(results, num_images, res):
 	
 	return torch.cat(list_images,0)
 
-def max_tile(results, num_images, res):
+def max_tile(results, num_images, res, counts=[1, 12, 234]):
 	"""
 	Finds the max features for the different resolutions
 
@@ -241,15 +381,12 @@ def max_tile(results, num_images, res):
 		results: tile features, [num_images*(18*13+4*3),1,1,2048]
 		num_images: number of images in the minibatch
 		res: list of resolutions used in tiling, 0 is coarse (1 tile), 1 is medium (12 tiles), 2 is fine (234 tiles)
+		counts: tiles per image of every level, e.g. TilingSpec.counts(H, W)
 	
 	Returns: 
-		[num_images,1,1,len(res)*2048]
+		[num_images,len(res)*2048,1,1]
 	"""
-	if len(res) > 3:
-		raise ValueError('Chose more than 3 resolutions.')
-
-	res_size = [1, 12, 234]
-	chunks = [res_size[i] for i in res]
+	chunks = [counts[i] for i in res]
 	list_images = list(torch.chunk(results, num_images,0))
 	del results
 	counter=0
@@ -262,6 +399,69 @@ def max_tile(results, num_images, res):
 
 	return torch.cat(list_images,0)
 
+def tile_image_uint8(image, res, mean=[0.485, 0.456, 0.406], spec=None):
+	"""
+	Tiles a single uint8 image with the same geometry as tile_images, for use in DataLoader workers
+
+	Padding uses the mean colour so that the tiles match zero padding of a normalized image.
+
+	Args: 
+		image: uint8 Tensor of shape [3, H, W]
+		res: list of levels of spec used in tiling
+		spec: TilingSpec, defaults to default_spec()
+	
+	Returns: 
+		tiles: uint8 Tensor of shape [num_tiles, 3, tile, tile]
+		levels: int64 Tensor of shape [num_tiles], position in res of the resolution of each tile
+	"""
+	if spec is None:
+		spec = default_spec()
+	mean = torch.tensor(mean).view(1,3,1,1) * 255
+	counts = spec.counts(image.shape[1], image.shape[2])
+	image = image.unsqueeze(0).float() - mean
+	tiles = tile_images(image, res, spec) + mean
+	tiles = tiles.round_().clamp_(0, 255).to(torch.uint8)
+
+	levels = torch.cat([torch.full((counts[r],), i, dtype=torch.long) for i, r in enumerate(res)])
+	return tiles, levels
+
+def normalize_tiles_uint8(tiles, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], dtype=torch.float32):
+	""" Converts uint8 tiles to normalized float tiles on their current device """
+	return batch_image_normalize(tiles.to(dtype).div_(255), mean, std)
+
+def collate_tiles(batch):
+	"""
+	Collates (tiles, levels, label) samples into one flat tile batch
+
+	Returns: 
+		(tiles, levels, image_index), labels where image_index maps every tile to its image in the minibatch
+	"""
+	tiles, levels, labels = zip(*batch)
+	image_index = torch.cat([torch.full((t.shape[0],), i, dtype=torch.long) for i, t in enumerate(tiles)])
+	return (torch.cat(tiles, 0), torch.cat(levels, 0), image_index), torch.as_tensor(labels)
+
+def max_tile_segments(results, levels, image_index, num_images, num_res):
+	"""
+	Finds the max features for the different resolutions, for tiles given with a tile-to-image index
+
+	Equivalent to max_tile, but images may contribute any number of tiles per resolution.
+
+	Args: 
+		results: tile features, [num_tiles,2048,1,1]
+		levels: position in res of the resolution of each tile, [num_tiles]
+		image_index: image of each tile in the minibatch, [num_tiles]
+		num_images: number of images in the minibatch
+		num_res: number of resolutions
+	
+	Returns: 
+		[num_images,num_res*2048]
+	"""
+	results = results.view(results.shape[0], -1)
+	segments = (image_index * num_res + levels).unsqueeze(1).expand_as(results)
+	pooled = results.new_zeros((num_images * num_res, results.shape[1]))
+	pooled = pooled.scatter_reduce(0, segments, results, reduce='amax', include_self=False)
+	return pooled.view(num_images, -1)
+
 def _max_tile_2res(results, num_images):
 	"""
 	Finds the max features for the different resolutions
@@ -311,6 +511,7 @@ def tile_res2_test(image):
 	return torch.cat(channels,1)
 
 def tiling_test():
+	import pdb
 	import numpy as np
 	images = np.arange(600,dtype=np.float64).reshape((2,3,10,10))
 	pdb.set_trace()
@@ -0,0 +1,132 @@
+from __future__ import print_function, division
+import os
+import re
+import json
+import numpy as np
+
+
+class ResultsWriter(object):
+	"""Streams evaluation results to an append-only columnar directory
+
+	Every column is a raw little-endian file, appended and flushed once per batch, so memory
+	stays flat and a crash loses at most the batch being written. Image ids are stored as a
+	UTF-8 byte column plus int64 end offsets.
+
+	Layout of the directory:
+		schema.json: column names and dtypes
+		<column>.bin: values of one column
+		image_id.bin / image_id.off: id bytes and end offset of every id
+	"""
+	def __init__(self, path, num_classes):
+		"""
+		Args:
+			path: results directory, e.g. results_0.cols (replaced if it exists)
+			num_classes: number of probability columns p0..p{num_classes-1}
+		"""
+		if not os.path.exists(path):
+			os.makedirs(path)
+		self.path = path
+		self.columns = [('p%d' % c, '<f4') for c in range(num_classes)] + [('label', '<i2'), ('pred', '<i2'), ('eval', '|b1')]
+		with open(os.path.join(path, 'schema.json'), 'w') as f:
+			json.dump({'columns': self.columns, 'num_classes': num_classes}, f)
+
+		self.files = {}
+		for name, _ in self.columns:
+			self.files[name] = open(os.path.join(path, name + '.bin'), 'wb')
+		self.files['image_id'] = open(os.path.join(path, 'image_id.bin'), 'wb')
+		self.files['image_id_offsets'] = open(os.path.join(path, 'image_id.off'), 'wb')
+		self.id_bytes = 0
+		self.rows = 0
+
+	def append(self, probs, labels, preds, image_ids = None):
+		"""
+		Args:
+			probs: [batch, num_classes] class probabilities
+			labels: [batch] ground truth
+			preds: [batch] predicted class
+			image_ids: [batch] image ids, optional
+		"""
+		probs = np.asarray(probs, dtype = np.float32)
+		labels = np.asarray(labels)
+		preds = np.asarray(preds)
+		if image_ids is None:
+			image_ids = [''] * len(labels)
+		encoded = [str(i).encode('utf-8') for i in image_ids]
+		offsets = self.id_bytes + np.cumsum([len(e) for e in encoded], dtype = np.int64)
+
+		# ids first, so the offsets never point past written bytes
+		self.files['image_id'].write(b''.join(encoded))
+		self.files['image_id_offsets'].write(offsets.astype('<i8').tobytes())
+		values = {'label': labels, 'pred': preds, 'eval': preds == labels}
+		for c in range(probs.shape[1]):
+			values['p%d' % c] = probs[:, c]
+		for name, dtype in self.columns:
+			self.files[name].write(np.asarray(values[name]).astype(dtype).tobytes())
+		for f in self.files.values():
+			f.flush()
+
+		self.id_bytes = int(offsets[-1]) if len(offsets) else self.id_bytes
+		self.rows += len(labels)
+
+	def close(self):
+		for f in self.files.values():
+			f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def read_results(path):
+	"""
+	Reads a results directory written by ResultsWriter, dropping a partially written last batch
+
+	Returns:
+		dict of column name -> numpy array, including image_id
+	"""
+	with open(os.path.join(path, 'schema.json')) as f:
+		columns = [tuple(c) for c in json.load(f)['columns']]
+	offsets = np.fromfile(os.path.join(path, 'image_id.off'), dtype = '<i8')
+	id_bytes = np.fromfile(os.path.join(path, 'image_id.bin'), dtype = np.uint8)
+
+	raw = {}
+	rows = len(offsets)
+	for name, dtype in columns:
+		raw[name] = np.memmap(os.path.join(path, name + '.bin'), dtype = dtype, mode = 'r') if os.path.getsize(os.path.join(path, name + '.bin')) else np.zeros(0, dtype)
+		rows = min(rows, len(raw[name]))
+	rows = min(rows, int(np.searchsorted(offsets, id_bytes.size, side = 'right')))
+
+	results = dict((name, np.array(raw[name][:rows])) for name, _ in columns)
+	starts = np.concatenate([[0], offsets[:rows - 1]]) if rows else offsets[:0]
+	blob = id_bytes.tobytes()
+	results['image_id'] = np.array([blob[s:e].decode('utf-8') for s, e in zip(starts, offsets[:rows])], dtype = object)
+	return results
+
+
+def load_fold_results(results_dir, as_frame = True):
+	"""
+	Merges the results of all folds of a run (results_<fold>.cols) and adds a fold column
+
+	Returns:
+		pandas DataFrame, or a dict of numpy arrays if as_frame is False
+	"""
+	folds = []
+	for name in os.listdir(results_dir):
+		match = re.match(r'results_(\d+)\.cols$', name)
+		if match:
+			folds.append((int(match.group(1)), os.path.join(results_dir, name)))
+
+	merged = {}
+	for fold, path in sorted(folds):
+		results = read_results(path)
+		results['fold'] = np.full(len(results['label']), fold, dtype = np.int16)
+		for name, values in results.items():
+			merged.setdefault(name, []).append(values)
+	merged = dict((name, np.concatenate(values)) for name, values in merged.items())
+
+	if as_frame:
+		import pandas as pd
+		return pd.DataFrame(merged)
+	return merged
@@ -0,0 +1,226 @@
+from __future__ import print_function, division
+import io
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+from torch.utils.data import IterableDataset, get_worker_info
+from PIL import Image
+
+import resnet_helper as H
+import decode
+from PathologyDataset import read_manifest, _default_transform
+
+
+def shard_name(shard):
+	return 'shard-%05d.bin' % shard
+
+
+def pack_shards(img_dir, out_dir, csv_file = 'microscopy_ground_truth.csv', shard_bytes = 1 << 30):
+	"""
+	Packs the images of a dataset directory into large shard files for sequential reads
+
+	The encoded file bytes are copied as they are (no re-encoding). Layout of out_dir:
+		shard-<n>.bin: concatenated image files, about shard_bytes each
+		index.npz: id, label, shard, offset and length of every image, in csv order
+
+	Args:
+		img_dir: dataset directory, images at <img_dir>/<class>/<file>
+		shard_bytes: target shard size, a shard is closed at the first image past it
+	Returns:
+		number of shards
+	"""
+	ids, labels = read_manifest(os.path.join(img_dir, csv_file))
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	shards = np.zeros(len(ids), dtype = np.int32)
+	offsets = np.zeros(len(ids), dtype = np.int64)
+	lengths = np.zeros(len(ids), dtype = np.int64)
+
+	shard, offset = 0, 0
+	out = open(os.path.join(out_dir, shard_name(shard)), 'wb')
+	for i in range(len(ids)):
+		if offset >= shard_bytes:
+			out.close()
+			shard, offset = shard + 1, 0
+			out = open(os.path.join(out_dir, shard_name(shard)), 'wb')
+		with open(os.path.join(img_dir, ids[i]), 'rb') as f:
+			data = f.read()
+		out.write(data)
+		shards[i], offsets[i], lengths[i] = shard, offset, len(data)
+		offset += len(data)
+	out.close()
+
+	np.savez(os.path.join(out_dir, 'index.npz'), ids = np.asarray(ids), labels = np.asarray(labels),
+			 shards = shards, offsets = offsets, lengths = lengths)
+	return shard + 1
+
+
+def worker_split():
+	""" (position, count) of this DataLoader worker among the workers of all distributed ranks """
+	rank, world_size = 0, 1
+	if torch.distributed.is_available() and torch.distributed.is_initialized():
+		rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+	info = get_worker_info()
+	worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+	return rank * num_workers + worker, world_size * num_workers
+
+
+class ShardedDataset(IterableDataset):
+	"""Streaming pathology dataset over packed shards (see pack_shards)
+
+	Every shard is read front to back in read_size chunks. Shards are split between the DataLoader
+	workers and the distributed ranks, and their order is reshuffled every epoch. Samples are
+	shuffled within a bounded buffer of encoded images, so memory does not grow with the dataset.
+	"""
+	def __init__(self, shard_dir, transform = None, shuffle_buffer = 256, seed = 7, indices = None, read_size = 64 << 20,
+				 decode_size = None):
+		"""
+		Args:
+			shard_dir: directory written by pack_shards
+			transform (callable, optional): applied to the PIL image, defaults to transforms.ToTensor()
+			shuffle_buffer (int): samples held for shuffling, 0 streams in shard order (shards are not reordered either)
+			seed (int): random seed, combined with the epoch (set_epoch)
+			indices (array, optional): csv rows to use (e.g. the train rows of a fold), None uses all
+			read_size (int): bytes per sequential read
+			decode_size (tuple, optional): (height, width) to decode the images to, see decode.open_image
+		"""
+		index = np.load(os.path.join(shard_dir, 'index.npz'))
+		self.shard_dir = shard_dir
+		self.img_ids = index['ids']
+		self.img_labels = index['labels']
+		self.shards = index['shards']
+		self.offsets = index['offsets']
+		self.lengths = index['lengths']
+		self.indices = np.arange(len(self.img_labels)) if indices is None else np.sort(np.asarray(indices))
+		self.transform = transform if transform is not None else _default_transform('ToTensor')
+		self.shuffle_buffer = shuffle_buffer
+		self.seed = seed
+		self.read_size = read_size
+		self.decode_size = decode_size
+		self.epoch = 0
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def __len__(self):
+		return len(self.indices)
+
+	def _records(self, shard, rows):
+		""" (row, encoded bytes) of rows (sorted by offset) of one shard, with sequential reads """
+		filename = os.path.join(self.shard_dir, shard_name(shard))
+		with open(filename, 'rb', buffering = 0) as f:
+			chunk, start = b'', 0
+			for row in rows:
+				begin, end = self.offsets[row], self.offsets[row] + self.lengths[row]
+				if begin >= start + len(chunk):
+					# gaps (rows of other folds) of at least a chunk are skipped, smaller ones are read through
+					gap = begin - start - len(chunk)
+					if gap >= self.read_size:
+						f.seek(begin)
+					elif gap:
+						f.read(gap)
+					chunk, start = b'', begin
+				while start + len(chunk) < end:
+					data = f.read(max(self.read_size, end - start - len(chunk)))
+					if not data:
+						raise IOError('%s is truncated at offset %d, row %d needs bytes %d to %d' % (filename, start + len(chunk), row, begin, end))
+					chunk = chunk[begin - start:] + data
+					start = begin
+				yield row, chunk[begin - start:end - start]
+
+	def _sample(self, row, data):
+		img = decode.open_image(io.BytesIO(data), self.decode_size) if self.decode_size is not None else Image.open(io.BytesIO(data))
+		if self.transform:
+			img = self.transform(img)
+		return img, self.img_labels[row]
+
+	def __iter__(self):
+		position, count = worker_split()
+		rng = np.random.RandomState(self.seed + self.epoch)
+		shards = np.unique(self.shards[self.indices])
+		if self.shuffle_buffer:
+			shards = shards[rng.permutation(len(shards))]
+		# each worker draws from its own stream, seeded apart from the shard order shared by all workers
+		rng = np.random.RandomState([self.seed, self.epoch, position])
+
+		buffer = []
+		for shard in shards[position::count]:
+			rows = self.indices[self.shards[self.indices] == shard]
+			rows = rows[np.argsort(self.offsets[rows], kind = 'stable')]
+			for record in self._records(shard, rows):
+				if len(buffer) < self.shuffle_buffer:
+					buffer.append(record)
+					continue
+				if self.shuffle_buffer:
+					j = rng.randint(len(buffer))
+					buffer[j], record = record, buffer[j]
+				yield self._sample(*record)
+		rng.shuffle(buffer)
+		for record in buffer:
+			yield self._sample(*record)
+
+
+class TiledShardedDataset(ShardedDataset):
+	"""Streaming dataset over packed shards yielding pre-cut uint8 tiles, for resnet_helper.collate_tiles"""
+	def __init__(self, shard_dir, transform = None, res = [0,1,2], spec = None, **kwargs):
+		"""
+		Args:
+			transform (callable, optional): must return a uint8 tensor, defaults to transforms.PILToTensor()
+			res (list): resolutions used in tiling
+			spec (TilingSpec, optional): tiling geometry, defaults to resnet_helper.default_spec()
+		"""
+		if transform is None:
+			transform = _default_transform('PILToTensor')
+		super(TiledShardedDataset, self).__init__(shard_dir, transform = transform, **kwargs)
+		self.res = res
+		self.spec = spec if spec is not None else H.default_spec()
+
+	def _sample(self, row, data):
+		img, label = super(TiledShardedDataset, self)._sample(row, data)
+		tiles, levels = H.tile_image_uint8(img, self.res, spec = self.spec)
+		return tiles, levels, label
+
+
+def read_throughput(shard_dir, read_size = 64 << 20):
+	"""
+	MB/s of streaming every record of every shard (no decoding), and of plainly reading the shard files
+
+	Run on a cold page cache (e.g. after dropping caches) for the disk / network bandwidth.
+	"""
+	dataset = ShardedDataset(shard_dir, shuffle_buffer = 0, read_size = read_size)
+	start = time.time()
+	total = 0
+	for shard in np.unique(dataset.shards):
+		for _, data in dataset._records(shard, np.flatnonzero(dataset.shards == shard)):
+			total += len(data)
+	records = total / (1 << 20) / (time.time() - start)
+
+	start = time.time()
+	total = 0
+	for shard in np.unique(dataset.shards):
+		with open(os.path.join(shard_dir, shard_name(shard)), 'rb', buffering = 0) as f:
+			for chunk in iter(lambda: f.read(read_size), b''):
+				total += len(chunk)
+	raw = total / (1 << 20) / (time.time() - start)
+	return records, raw
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Packs a dataset directory into sequential-read shards')
+	parser.add_argument('img_dir')
+	parser.add_argument('out_dir')
+	parser.add_argument('--shard_mb', type = float, default = 1024)
+	parser.add_argument('--benchmark', action = 'store_true', help = 'report the read throughput of the shards')
+	args = parser.parse_args()
+
+	if not os.path.exists(os.path.join(args.out_dir, 'index.npz')):
+		print('packed %d shards' % pack_shards(args.img_dir, args.out_dir, shard_bytes = int(args.shard_mb * (1 << 20))))
+	if args.benchmark:
+		print('records %.1f MB/s, raw reads %.1f MB/s' % read_throughput(args.out_dir))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,253 @@
+from __future__ import print_function, division
+import os
+import json
+import time
+import sqlite3
+import argparse
+import itertools
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.nn.functional as F
+
+from concurrent.futures import ProcessPoolExecutor
+
+from cross_validation import load_folds
+from embeddings import EmbeddingStore
+
+# defaults of train_net.py, overridden by the search space
+default_params = {'learning_rate': 2e-4, 'batch_size': 4, 'op': 'SGD', 'weight_decay': 0.0005,
+				  'step_size': 20, 'gamma': 0.5, 'res': [0, 1, 2], 'pool_after': False}
+
+
+class SweepStore(object):
+	"""sqlite record of trials and their per-epoch validation, shared by all worker processes"""
+	def __init__(self, filename):
+		self.filename = filename
+		with self._connect() as db:
+			db.execute('CREATE TABLE IF NOT EXISTS trials (id INTEGER PRIMARY KEY, params TEXT, status TEXT, '
+					   'best_acc REAL, final_acc REAL, epochs INTEGER, seconds REAL)')
+			db.execute('CREATE TABLE IF NOT EXISTS epochs (trial INTEGER, epoch INTEGER, val_acc REAL, val_loss REAL, '
+					   'PRIMARY KEY (trial, epoch))')
+
+	def _connect(self):
+		return sqlite3.connect(self.filename, timeout=60)
+
+	def add_trial(self, params):
+		with self._connect() as db:
+			return db.execute('INSERT INTO trials (params, status) VALUES (?, ?)', (json.dumps(params), 'pending')).lastrowid
+
+	def set_status(self, trial, status, **values):
+		fields = ', '.join(['status = ?'] + ['%s = ?' % k for k in values])
+		with self._connect() as db:
+			db.execute('UPDATE trials SET %s WHERE id = ?' % fields, [status] + list(values.values()) + [trial])
+
+	def report_epoch(self, trial, epoch, val_acc, val_loss):
+		with self._connect() as db:
+			db.execute('INSERT OR REPLACE INTO epochs VALUES (?, ?, ?, ?)', (trial, epoch, val_acc, val_loss))
+
+	def epoch_scores(self, epoch, exclude):
+		"""validation accuracy of all other trials at an epoch"""
+		with self._connect() as db:
+			rows = db.execute('SELECT val_acc FROM epochs WHERE epoch = ? AND trial != ?', (epoch, exclude)).fetchall()
+		return [r[0] for r in rows]
+
+	def trials(self):
+		with self._connect() as db:
+			rows = db.execute('SELECT id, params, status, best_acc, final_acc, epochs, seconds FROM trials ORDER BY best_acc DESC').fetchall()
+		return [dict(zip(['id', 'params', 'status', 'best_acc', 'final_acc', 'epochs', 'seconds'], r)) for r in rows]
+
+
+class CachedFeatures(object):
+	"""Frozen-trunk features of one tiling config, read from an EmbeddingStore
+
+	Pooled features (max_tile output) serve trials with pool_after False, per-tile features
+	serve pool_after True. Any res that is a subset of the exported resolutions is supported.
+	The store is memory-mapped, so all worker processes share it through the page cache.
+	"""
+	def __init__(self, path, res):
+		self.store = EmbeddingStore(path)
+		missing = [r for r in res if r not in self.store.res]
+		if missing:
+			raise ValueError('Resolutions %s were not exported to %s' % (missing, path))
+		dim = self.store.meta['dim']
+		blocks = [self.store.res.index(r) for r in res]
+		self.pooled_columns = np.concatenate([np.arange(b * dim, (b + 1) * dim) for b in blocks])
+		per_image = self.store.tile_meta[self.store.tiles_of(0)]['level']
+		self.tile_rows = np.nonzero(np.isin(per_image, res))[0]
+		self.tiles_per_image = per_image.size
+
+	def pooled(self, idx):
+		return torch.from_numpy(np.asarray(self.store.images[np.sort(idx)][:, self.pooled_columns], dtype=np.float32))
+
+	def tiles(self, idx):
+		rows = (np.sort(idx)[:, None] * self.tiles_per_image + self.tile_rows[None, :]).ravel()
+		features = np.asarray(self.store.tiles[rows], dtype=np.float32)
+		return torch.from_numpy(features).view(len(idx), len(self.tile_rows), -1)
+
+
+def _head_scores(head, features, pool_after):
+	if pool_after:
+		# fc1 on every tile, then max over the tiles of each image (ResNet_Tiling_maxpool_after)
+		return head(features).max(1)[0]
+	return head(features)
+
+
+def _make_optimizer(params, parameters):
+	if params['op'] == 'RMSprop':
+		return optim.RMSprop(parameters, lr=params['learning_rate'], momentum=0.9, weight_decay=params['weight_decay'], eps=1.0)
+	elif params['op'] == 'Adam':
+		return optim.Adam(parameters, lr=params['learning_rate'])
+	elif params['op'] == 'SGD':
+		return optim.SGD(parameters, lr=params['learning_rate'], momentum=0.9, weight_decay=params['weight_decay'])
+	raise ValueError('Unsupported Optimizer: ' + params['op'])
+
+
+def run_trial(trial, params, config):
+	"""
+	Trains fc1 of every fold in lockstep on cached features and reports the mean validation
+	accuracy after each epoch. Stops early (status 'pruned') when the trial falls below the
+	median of the other trials at the same epoch.
+
+	Args:
+		trial: trial id in the sweep store
+		params: hyperparameters, see default_params
+		config: dict with store, db, epochs, n_splits, folds, warmup, min_trials, num_classes, threads, seed
+	"""
+	torch.set_num_threads(config['threads'])
+	torch.manual_seed(config['seed'] + trial)
+	db = SweepStore(config['db'])
+	db.set_status(trial, 'running')
+	start = time.time()
+
+	features = CachedFeatures(config['store'], params['res'])
+	labels = features.store.labels
+	folds = list(load_folds(config['fold_file'], labels, n_splits=config['n_splits']))[:config['folds']]
+	load = features.tiles if params['pool_after'] else features.pooled
+	dim = features.store.meta['dim'] * (1 if params['pool_after'] else len(params['res']))
+
+	heads, optimizers, schedulers = [], [], []
+	for _ in folds:
+		head = nn.Linear(dim, config['num_classes'])
+		nn.init.normal_(head.weight, std=0.01)
+		nn.init.constant_(head.bias, 0)
+		optimizer = _make_optimizer(params, head.parameters())
+		heads.append(head)
+		optimizers.append(optimizer)
+		schedulers.append(optim.lr_scheduler.StepLR(optimizer, step_size=params['step_size'], gamma=params['gamma']))
+
+	# validation features are loaded once per trial
+	val = [(load(test_idx), torch.from_numpy(labels[np.sort(test_idx)])) for _, test_idx in folds]
+
+	best, acc, status = 0.0, 0.0, 'complete'
+	for epoch in range(config['epochs']):
+		for (train_idx, _), head, optimizer, scheduler in zip(folds, heads, optimizers, schedulers):
+			order = np.random.permutation(train_idx)
+			for b in range(0, len(order), params['batch_size']):
+				idx = np.sort(order[b:b + params['batch_size']])
+				scores = _head_scores(head, load(idx), params['pool_after'])
+				loss = F.cross_entropy(scores, torch.from_numpy(labels[idx]))
+				optimizer.zero_grad()
+				loss.backward()
+				optimizer.step()
+			scheduler.step()
+
+		correct, total, val_loss = 0, 0, 0.0
+		with torch.no_grad():
+			for (x, y), head in zip(val, heads):
+				scores = _head_scores(head, x, params['pool_after'])
+				val_loss += F.cross_entropy(scores, y, reduction='sum').item()
+				correct += (scores.argmax(1) == y).sum().item()
+				total += len(y)
+		acc = correct / total
+		best = max(best, acc)
+		db.report_epoch(trial, epoch, acc, val_loss / total)
+
+		others = db.epoch_scores(epoch, trial)
+		if epoch >= config['warmup'] and len(others) >= config['min_trials'] and acc < np.median(others):
+			status = 'pruned'
+			break
+
+	db.set_status(trial, status, best_acc=best, final_acc=acc, epochs=epoch + 1, seconds=time.time() - start)
+	return trial, status, best
+
+
+def expand_space(space, num_trials=None, seed=0):
+	"""
+	Trials from a search space of parameter -> list of values
+
+	Returns the full grid, or num_trials random draws from it.
+	"""
+	names = sorted(space)
+	grid = [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+	if num_trials is not None and num_trials < len(grid):
+		rng = np.random.RandomState(seed)
+		grid = [grid[i] for i in rng.choice(len(grid), num_trials, replace=False)]
+	trials = []
+	for values in grid:
+		params = dict(default_params)
+		params.update(values)
+		trials.append(params)
+	return trials
+
+
+def run_sweep(space, store, db='sweep.db', workers=4, epochs=100, n_splits=10, folds=None, num_trials=None,
+			  warmup=10, min_trials=4, num_classes=4, seed=0):
+	"""
+	Runs all trials of a search space on a local process pool
+
+	Args:
+		space: dict of parameter -> list of values, parameters as in default_params
+		store: EmbeddingStore directory with frozen-trunk features (embeddings.py export)
+		db: sqlite file recording trials and per-epoch validation
+		workers: number of trial processes
+		n_splits: folds of the cross validation
+		folds: number of folds evaluated per trial, None for all
+		num_trials: random subset of the grid, None for the full grid
+		warmup: epochs before a trial may be pruned
+		min_trials: other trials needed at an epoch before pruning against their median
+	"""
+	sweep = SweepStore(db)
+	config = {'store': store, 'db': db, 'epochs': epochs, 'n_splits': n_splits, 'folds': folds or n_splits,
+			  'fold_file': os.path.join(store, 'folds.npz'), 'warmup': warmup, 'min_trials': min_trials,
+			  'num_classes': num_classes, 'threads': max(1, (os.cpu_count() or 1) // workers), 'seed': seed}
+
+	# create the fold file once, so workers only read it
+	labels = EmbeddingStore(store).labels
+	if labels is None:
+		raise ValueError('The embedding store has no labels, re-export it with embeddings.py')
+	load_folds(config['fold_file'], labels, n_splits=n_splits)
+
+	trials = [(sweep.add_trial(params), params) for params in expand_space(space, num_trials, seed)]
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = [pool.submit(run_trial, trial, params, config) for trial, params in trials]
+		for future in futures:
+			trial, status, best = future.result()
+			print('trial %d %s, best validation accuracy %.4f' % (trial, status, best))
+
+	return sweep.trials()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Hyperparameter sweep of fc1 on cached frozen-trunk features')
+	parser.add_argument('--space', required=True, help='json file of parameter -> list of values')
+	parser.add_argument('--store', required=True, help='embedding store exported by embeddings.py')
+	parser.add_argument('--db', default='sweep.db')
+	parser.add_argument('--workers', type=int, default=4)
+	parser.add_argument('--epochs', type=int, default=100)
+	parser.add_argument('--k', type=int, default=10)
+	parser.add_argument('--folds', type=int, default=None)
+	parser.add_argument('--trials', type=int, default=None)
+	parser.add_argument('--warmup', type=int, default=10)
+	args = parser.parse_args()
+
+	with open(args.space) as f:
+		space = json.load(f)
+	results = run_sweep(space, args.store, args.db, args.workers, args.epochs, args.k, args.folds, args.trials, args.warmup)
+	for r in results[:10]:
+		print(r['id'], r['status'], r['best_acc'], r['params'])
+
+
+if __name__ == '__main__':
+	main()
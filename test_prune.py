@@ -0,0 +1,28 @@
+from __future__ import print_function, division
+import torch
+
+import resnet as R
+from prune import apply_pruning
+
+
+def _model():
+	torch.manual_seed(0)
+	model = R.ResNet_Tiling(R.Bottleneck, [1, 1, 1, 1], num_classes = 4, res = [0, 1])
+	# non-trivial running statistics, so train / eval mode BatchNorm differ
+	with torch.no_grad():
+		model.train()
+		model(torch.rand(2, 3, 96, 128))
+	return model.eval()
+
+
+def test_identity_plan_keeps_output():
+	model = _model()
+	x = torch.rand(1, 3, 96, 128)
+	with torch.no_grad():
+		expected = model(x)
+	plan = {'output': list(range(model.feature_dim)),
+			'layer4.0': {'mid1': list(range(model.layer4[0].conv1.out_channels)), 'mid2': list(range(model.layer4[0].conv2.out_channels))}}
+	apply_pruning(model, plan)
+	assert not any(m.training for m in model.modules())
+	with torch.no_grad():
+		assert torch.allclose(model(x), expected, atol = 1e-5)
@@ -0,0 +1,159 @@
+from __future__ import print_function, division
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from collections import deque
+
+import resnet_helper as H
+
+
+class TileBatchScheduler(object):
+	"""Packs the tiles of many images into fixed-size trunk batches for ResNet_Tiling inference
+
+	Images are queued as pre-cut uint8 tiles of any count (different image sizes, pruned or sampled
+	tiles). Every trunk batch takes exactly trunk_batch tiles from the front of the queue, possibly
+	spanning several images, and the tile features are written to the image that owns them. An
+	image's pooling + fc1 runs as soon as its last tile has gone through the trunk.
+	"""
+	def __init__(self, model, trunk_batch = 256, device = torch.device('cpu')):
+		"""
+		Args:
+			model: ResNet_Tiling
+			trunk_batch: tiles per trunk batch, tuned for the device (see trunk_throughput in distill.py)
+		"""
+		self.model = model.to(device = device).eval()
+		self.trunk_batch = trunk_batch
+		self.device = device
+		self.queue = deque()
+		self.images = {}
+		self.next_slot = 0
+		self.pending = 0
+		self.batches = 0
+		self.tiles_run = 0
+
+	def submit(self, key, tiles, levels):
+		"""
+		Queues the tiles of one image
+
+		Args:
+			key: returned with the result of the image
+			tiles: uint8 Tensor [num_tiles,3,tile,tile]
+			levels: position in model.res of the resolution of each tile, [num_tiles]
+		"""
+		slot = self.next_slot
+		self.next_slot += 1
+		self.images[slot] = {'key': key, 'levels': levels, 'num_tiles': tiles.shape[0], 'features': [], 'done': 0, 'submitted': time.time()}
+		self.queue.append([slot, tiles, 0])
+		self.pending += tiles.shape[0]
+
+	def submit_image(self, key, image):
+		""" queues a uint8 image [3,H,W], tiled with the geometry of the model """
+		tiles, levels = H.tile_image_uint8(image, self.model.res, spec = self.model.spec)
+		self.submit(key, tiles, levels)
+
+	def _next_batch(self):
+		### up to trunk_batch tiles from the front of the queue, with (slot, count) of every piece (in tile order of each image)
+		pieces, owners, size = [], [], 0
+		while self.queue and size < self.trunk_batch:
+			entry = self.queue[0]
+			slot, tiles, start = entry
+			count = min(self.trunk_batch - size, tiles.shape[0] - start)
+			pieces.append(tiles[start:start + count])
+			owners.append((slot, count))
+			size += count
+			entry[2] += count
+			if entry[2] == tiles.shape[0]:
+				self.queue.popleft()
+		self.pending -= size
+		return torch.cat(pieces, 0), owners
+
+	def step(self, flush = False):
+		"""
+		Runs every full trunk batch in the queue (and the last partial batch when flush is True)
+
+		Returns:
+			list of (key, logits [num_classes], latency in seconds) of the images completed, in completion order
+		"""
+		results = []
+		with torch.no_grad():
+			while self.pending >= self.trunk_batch or (flush and self.pending):
+				tiles, owners = self._next_batch()
+				x = H.normalize_tiles_uint8(tiles.to(device = self.device, non_blocking = True), dtype = self.model.conv1.weight.dtype)
+				features = self.model.trunk(x).view(x.shape[0], -1)
+				self.batches += 1
+				self.tiles_run += x.shape[0]
+
+				complete, offset = [], 0
+				for slot, count in owners:
+					image = self.images[slot]
+					image['features'].append(features[offset:offset + count])
+					image['done'] += count
+					offset += count
+					if image['done'] == image['num_tiles']:
+						complete.append(slot)
+				if complete:
+					results.extend(self._finish(complete))
+		return results
+
+	def _finish(self, slots):
+		### pooling + fc1 of completed images, as one head call
+		images = [self.images.pop(slot) for slot in slots]
+		features = torch.cat([f for image in images for f in image['features']], 0)
+		levels = torch.cat([image['levels'] for image in images], 0).to(device = self.device)
+		image_index = torch.cat([torch.full((image['num_tiles'],), i, dtype = torch.long) for i, image in enumerate(images)]).to(device = self.device)
+		logits = self.model.head(features, levels, image_index, len(images)).cpu()
+		now = time.time()
+		return [(image['key'], logits[i], now - image['submitted']) for i, image in enumerate(images)]
+
+	def utilization(self):
+		""" fraction of trunk batch slots filled with tiles """
+		return self.tiles_run / float(max(self.batches, 1) * self.trunk_batch)
+
+
+def predict(scheduler, filenames, decode_batch = 4, decode_size = None):
+	"""
+	Class probabilities of image files of any size, with the fixed-size trunk batches of a TileBatchScheduler
+
+	Yields:
+		(filename, probabilities, latency in seconds) as soon as each image is complete
+	"""
+	import decode
+	decoder = decode.BatchDecoder(decode_size)
+	for b in range(0, len(filenames), decode_batch):
+		names = filenames[b:b + decode_batch]
+		for name, image in zip(names, decoder(names)):
+			scheduler.submit_image(name, image)
+		for key, logits, latency in scheduler.step():
+			yield key, F.softmax(logits, dim = 0).numpy(), latency
+	for key, logits, latency in scheduler.step(flush = True):
+		yield key, F.softmax(logits, dim = 0).numpy(), latency
+	decoder.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Inference of a trained tiling model with fixed-size trunk batches')
+	parser.add_argument('images', nargs = '+')
+	parser.add_argument('--checkpoint', required = True)
+	parser.add_argument('--res', type = int, nargs = '+', default = [0, 1, 2])
+	parser.add_argument('--trunk_batch', type = int, default = None, help = 'defaults to the autotuned trunk batch of this host, else 256')
+	args = parser.parse_args()
+
+	import nets
+	import autotune
+	tuned = autotune.apply()
+	trunk_batch = args.trunk_batch or (tuned['trunk_batch'] if tuned is not None else 256)
+	device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+	model = nets.load_tiling_checkpoint(args.checkpoint, res = args.res)
+	scheduler = TileBatchScheduler(model, trunk_batch, device)
+	latencies = []
+	for filename, p, latency in predict(scheduler, args.images):
+		latencies.append(latency)
+		print('%s\t%s\t%d' % (filename, '\t'.join('%.4f' % v for v in p), int(np.argmax(p))))
+	print('trunk utilization %.3f, latency median %.3fs max %.3fs' % (scheduler.utilization(), np.median(latencies), np.max(latencies)))
+
+
+if __name__ == '__main__':
+	main()
@@ -7,15 +7,7 @@ import math
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.data import sampler
 from torch.utils.data import random_split
-from torchvision import transforms, utils, models
-from PIL import Image
-from cross_validation import k_folds, k_folds_2
-
-import pandas as pd
-from tensorboardX import SummaryWriter
-
-
-import pdb
+from cross_validation import k_folds, k_folds_2, load_folds
 
 import torch
 import torch.nn as nn
@@ -23,12 +15,20 @@ import torch.optim as optim
 import torch.nn.functional as F  # useful stateless functions
 
 import nets 
-import transformations
-from PathologyDataset import PathologyDataset
+from PathologyDataset import PathologyDataset, TiledPathologyDataset
+from resnet_helper import collate_tiles, default_spec
+from loaders import FoldLoaders, DevicePrefetcher, ImportanceSampler
+from results import ResultsWriter
+import fc1_solver
+import memory_planner
+import autotune
+from activation_cache import ActivationStore, CachedActivationDataset, CachedStageModel, export_activations, data_digest, stage_digest
 #### Settings 
 
 USE_GPU = True
 TILING = True
+# cut tiles in the data loader workers instead of inside the model (tiling only)
+PRETILE = False
 dtype = torch.float32 # we will be using float throughout this tutorial
 
 if USE_GPU and torch.cuda.is_available():
@@ -39,7 +39,13 @@ else:
 # Constant to control how frequently we print train loss
 print_every = 10
 
-print('using device:', device)
+# Data loader workers are kept alive across epochs and folds
+num_workers = 4
+prefetch_factor = 2
+# apply the threads / DataLoader workers / trunk batch tuned for this host by autotune.py, when there is a profile
+AUTOTUNE = True
+# tiles per trunk pass outside of training (validation), None runs every tile of the batch at once
+trunk_chunk = None
 
 if TILING: 
 	NUM_TRAIN = 360
@@ -50,8 +56,31 @@ if TILING:
 	k = 10
 	num_classes = 4
 
-	transform_train = transformations.tiling_train()
-	transform_val = transformations.tiling_val()
+	res = [0,1,2]
+	# tiling geometry (levels, scale, tile size, stride, padding), see resnet_helper.TilingSpec
+	spec = default_spec()
+	# tile pooling: 'max', 'topk', 'lse' or 'attention', see pooling.TilePooling
+	pooling = 'max'
+	# fine tiles sampled per training image when PRETILE, None uses all 234
+	fine_tiles = None
+	# every level of the spec is cut from the full resolution image
+	decode_size = None
+	# trunk layers trained with fc1, e.g. ['layer4'], and whether to keep only the max tiles' activations for backward
+	unfreeze = []
+	# recompute_argmax needs FREEZE_BN: every BatchNorm uses its running statistics (and keeps them) in training.
+	# FREEZE_BN also keeps the frozen trunk identical in every fold checkpoint, so ensemble.py shares it exactly
+	recompute_argmax = False
+	FREEZE_BN = False
+	# with unfreeze = ['layer4']: run conv1..layer3 once into a float16 cache and train layer4 + fc1 from it.
+	# Needs FREEZE_BN: the cache holds the frozen stages with BatchNorm running statistics, as FREEZE_BN trains them
+	CACHE_STAGE = None
+	# fit fc1 with full-batch L-BFGS on pooled features computed once, instead of minibatch SGD (frozen trunk only)
+	FC1_SOLVER = False
+	weight_decay = 0.0005
+	# replace batch_size with the largest batch whose estimated (and one-step measured) peak memory fits the device
+	AUTO_BATCH = False
+	# sample training images by their running loss, e.g. {'fraction': 0.5, 'mix': 0.2, 'refresh_every': 5}, see loaders.ImportanceSampler
+	IMPORTANCE = None
 
 else: 
 	NUM_TRAIN = 360
@@ -61,9 +90,29 @@ else:
 	learning_rate = 1e-3
 	k = 10
 	num_classes = 4
-
-	transform_train = transformations.randomcrop_resize()
-	transform_val = transformations.val()
+	res = [0,1,2]
+	spec = None
+	pooling = 'max'
+	# (height, width) to decode the images to, e.g. (768, 1024) to skip most of the decoding before the
+	# transforms downscale them; changes the pixels the transforms see, None decodes in full
+	decode_size = None
+	FC1_SOLVER = False
+	unfreeze = []
+	recompute_argmax = False
+	FREEZE_BN = False
+	CACHE_STAGE = None
+	AUTO_BATCH = False
+	IMPORTANCE = None
+
+
+def get_transforms():
+	### built when training starts, so importing this module does not load torchvision
+	import transformations
+	if TILING and PRETILE:
+		return transformations.tiling_train_uint8(), transformations.tiling_val_uint8()
+	elif TILING:
+		return transformations.tiling_train(), transformations.tiling_val()
+	return transformations.randomcrop_resize(), transformations.val()
 
 
 def check_accuracy(loader, model, train, cur_epoch = None, filename=None, writer = None):
@@ -73,7 +122,7 @@ def check_accuracy(loader, model, train, cur_epoch = None, filename=None, writer
 		loader: pytorch dataloader
 		model: pytorch module
 		train (boolean): in training mode or not
-		filename: name of result file
+		filename: name of the results directory, rows are streamed to it batch by batch
 		writer: tensorboard writer object for logging 
 
 	return:
@@ -84,13 +133,12 @@ def check_accuracy(loader, model, train, cur_epoch = None, filename=None, writer
 	total_loss = 0
 
 	if not train:
-		c0_list = np.empty((0,1), dtype = np.float32)
-		c1_list = np.empty((0,1), dtype = np.float32)
-		c2_list= np.empty((0,1), dtype = np.float32)
-		c3_list = np.empty((0,1), dtype = np.float32)
-		pred_list = np.empty((0,), dtype = np.uint8)
-		y_list = np.empty((0,), dtype = np.uint8)
-		eval_list = np.empty((0,), dtype = bool)
+		results = ResultsWriter(filename, num_classes)
+		# an ordered sampler lets us recover the image id of every row
+		sample_ids = None
+		if not getattr(loader.sampler, 'shuffle', True):
+			# only the fold's ids are decoded from the packed strings
+			sample_ids = loader.dataset.img_ids[np.asarray(loader.sampler.indices)]
 
 	model.eval()  # set model to evaluation mode
 	
@@ -101,30 +149,23 @@ def check_accuracy(loader, model, train, cur_epoch = None, filename=None, writer
 
 	with torch.no_grad():
 		counter = 0
-		for x, y in loader:
+		# batches arrive on device, the next one is transferred while this one computes
+		for x, y in DevicePrefetcher(loader, device, dtype):
 			counter += 1
-			x = x.to(device=device, dtype=dtype)  # move to device, e.g. GPU
-			y = y.to(device=device, dtype=torch.long)
 			scores = model(x)
 			loss = F.cross_entropy(scores, y)
 			total_loss += loss
 			_, preds = scores.max(1)
-			num_correct += (preds == y).sum()
-			num_samples += preds.size(0)
 			
 			if not train:
-				y = y.data.cpu().numpy()
-				preds = preds.data.cpu().numpy()
-				p = F.softmax(scores).data.cpu().numpy()
-				c0, c1, c2, c3 = np.split(p, 4, axis = 1)
-				c0_list = np.append(c0_list, c0)
-				c1_list = np.append(c1_list, c1)
-				c2_list = np.append(c2_list, c2)
-				c3_list = np.append(c3_list, c3)
-
-				y_list = np.append(y_list, y, axis = 0)
-				pred_list = np.append(pred_list, preds, axis = 0)
-				eval_list = np.append(eval_list, preds == y, axis = 0)
+				ids = None
+				if sample_ids is not None:
+					ids = sample_ids[num_samples:num_samples + preds.size(0)]
+				p = F.softmax(scores, dim = 1).data.cpu().numpy()
+				results.append(p, y.data.cpu().numpy(), preds.data.cpu().numpy(), ids)
+
+			num_correct += (preds == y).sum()
+			num_samples += preds.size(0)
 
 		acc = float(num_correct) / num_samples
 
@@ -136,20 +177,13 @@ def check_accuracy(loader, model, train, cur_epoch = None, filename=None, writer
 		print()
 
 		if not train:
-			results_dict = {'p0': c0_list.squeeze(), 
-						'p1': c1_list.squeeze(), 
-						'p2': c2_list.squeeze(), 
-						'p3': c3_list.squeeze(), 
-						'label': y_list, 
-						'pred': pred_list, 
-						'eval': eval_list}
-			results = pd.DataFrame.from_dict(results_dict)
-			results.to_csv(filename, index = False)
+			results.close()
 		
 		return acc
 
 
 def train_loop(model, loaders, optimizer, epochs=10, filename=None, log_dir=None, writer = None, scheduler = None):
+	from tensorboardX import SummaryWriter
 	writer = SummaryWriter(log_dir)
 	"""
 	Train a model on CIFAR-10 using the PyTorch Module API.
@@ -162,8 +196,8 @@ def train_loop(model, loaders, optimizer, epochs=10, filename=None, log_dir=None
 	Returns: model accuracy after training, and prints model accuracy through out training
 	"""
 
-	# configure multi-gpu training
-	if torch.cuda.device_count() > 1:
+	# configure multi-gpu training, pre-cut tile batches cannot be split across GPUs
+	if torch.cuda.device_count() > 1 and not PRETILE and CACHE_STAGE is None:
 		print("using", torch.cuda.device_count(), "GPUs")
 		model = nn.DataParallel(model)
 	
@@ -174,6 +208,9 @@ def train_loop(model, loaders, optimizer, epochs=10, filename=None, log_dir=None
 	# train_num = loader_train.dataset.__len__()
 	# batch_size = loader_train.batch_size
 	loader_val = loaders['val']
+	# importance sampling: per-image losses go back to the sampler, losses are weighted to stay unbiased
+	sampler = getattr(loader_train, 'sampler', None)
+	importance = isinstance(sampler, ImportanceSampler)
 
 	print('training begins')
 	print('base learning rate: ', learning_rate)
@@ -187,16 +224,25 @@ def train_loop(model, loaders, optimizer, epochs=10, filename=None, log_dir=None
 			adjust_learning_rate(optimizer, scheduler)
 
 
-		for t, (x, y) in enumerate(loader_train):
+		# batches arrive on device, the next one is transferred while this one computes
+		prefetcher = DevicePrefetcher(loader_train, device, dtype)
+		position = 0
+		seen = []
+		for t, (x, y) in enumerate(prefetcher):
 			counter+=1
 			model.train()  # put model to training mode
 
-			x = x.to(device=device, dtype=dtype)  # move to device, e.g. GPU
-			y = y.to(device=device, dtype=torch.long)
-
 			scores = model(x)
-			loss = F.cross_entropy(scores, y)
-			total_loss+=loss
+			if importance:
+				indices, weights = sampler.batch(position, y.shape[0])
+				position += y.shape[0]
+				losses = F.cross_entropy(scores, y, reduction = 'none')
+				loss = (losses * weights.to(device = losses.device)).mean()
+				# kept on device, copied once per epoch
+				seen.append((indices, losses.detach(), y))
+			else:
+				loss = F.cross_entropy(scores, y)
+			total_loss+=loss.detach()
 
 			# Zero out all of the gradients for the variables which the optimizer
 			# will update.
@@ -216,8 +262,34 @@ def train_loop(model, loaders, optimizer, epochs=10, filename=None, log_dir=None
 		
 		if writer: 
 			writer.add_scalar('train/loss', total_loss/counter, e)
+
+		if importance:
+			indices = torch.cat([i for i, _, _ in seen]).numpy()
+			# the draws must line up with the batches, or the weights and losses belong to other images
+			labels = torch.cat([y for _, _, y in seen]).cpu().numpy()
+			if position != len(sampler.drawn) or not np.array_equal(np.asarray(loader_train.dataset.img_labels)[indices], labels):
+				raise RuntimeError('Training batches do not follow the ImportanceSampler draws')
+			sampler.record(indices, torch.cat([l for _, l, _ in seen]).cpu().numpy())
+			sampled = sampler.report()
+			print('Epoch %d sampled %d draws of %d distinct images, %.2f of a full epoch (%.2f so far)' % (e, sampled['drawn'], sampled['distinct'], sampled['relative'], sampled['cumulative_relative']))
+			if writer:
+				writer.add_scalar('sampler/relative_forward_passes', sampled['relative'], e)
+				writer.add_scalar('sampler/cumulative_relative', sampled['cumulative_relative'], e)
+		
+		transfer = prefetcher.report()
+		print('Epoch %d input pipeline: load %.2fs, convert %.2fs, waited %.2fs (%.0f%% hidden)' % (e, transfer['load'], transfer['convert'], transfer['wait'], 100 * transfer['overlap']))
+		if writer:
+			writer.add_scalar('loader/wait', transfer['wait'], e)
+			writer.add_scalar('loader/overlap', transfer['overlap'], e)
+
+		if hasattr(loader_train, 'last_startup'):
+			print('Epoch %d loader startup: %.3fs' % (e, loader_train.last_startup))
+			if writer:
+				writer.add_scalar('loader/train_startup', loader_train.last_startup, e)
 		
 		acc = check_accuracy(loader_val, model, train=True, cur_epoch=e, filename=None, writer=writer)
+		if writer and hasattr(loader_val, 'last_startup'):
+			writer.add_scalar('loader/val_startup', loader_val.last_startup, e)
 
 	print()
 	acc = check_accuracy(loader_val, model, train=False, filename=filename)
@@ -232,12 +304,40 @@ def train_network(ssh = True, op = 'SGD'):
 		img_dir='/Users/admin/desktop/path_pytorch/Part-A_Original'
 		results_dir = '/Users/admin/desktop/path_pytorch/results'
 
-	path_data_train = PathologyDataset(csv_file='microscopy_ground_truth.csv', img_dir=img_dir, shuffle = True, transform=transform_train)
-	path_data_val = PathologyDataset(csv_file='microscopy_ground_truth.csv', img_dir=img_dir, shuffle = False, transform=transform_val)
+	print('using device:', device)
+	transform_train, transform_val = get_transforms()
+
+	if TILING and PRETILE:
+		path_data_train = TiledPathologyDataset(csv_file='microscopy_ground_truth.csv', img_dir=img_dir, shuffle = True, transform=transform_train, res = res, fine_tiles = fine_tiles, spec = spec)
+		path_data_val = TiledPathologyDataset(csv_file='microscopy_ground_truth.csv', img_dir=img_dir, shuffle = False, transform=transform_val, res = res, spec = spec)
+		collate_fn = collate_tiles
+	else:
+		path_data_train = PathologyDataset(csv_file='microscopy_ground_truth.csv', img_dir=img_dir, shuffle = True, transform=transform_train, decode_size = decode_size)
+		path_data_val = PathologyDataset(csv_file='microscopy_ground_truth.csv', img_dir=img_dir, shuffle = False, transform=transform_val, decode_size = decode_size)
+		collate_fn = None
 
 	if path_data_train.shuffle:
-		path_data_val.img_ids = path_data_train.img_ids.copy()
-		path_data_val.img_labels = path_data_train.img_labels.copy()
+		# the packed ids and labels are read-only shared memory, both datasets use the same buffers
+		path_data_val.img_ids = path_data_train.img_ids
+		path_data_val.img_labels = path_data_train.img_labels
+
+	if TILING and CACHE_STAGE is not None:
+		if not FREEZE_BN:
+			raise ValueError('CACHE_STAGE needs FREEZE_BN: the cached stages use the BatchNorm running statistics, '
+							 'training without FREEZE_BN would use batch statistics')
+		### frozen stages run once over every tile (in the shuffled train order), training from the cache has no random flips
+		cache_dir = os.path.join(results_dir, CACHE_STAGE + '_cache')
+		import transformations
+		dataset = TiledPathologyDataset(csv_file='microscopy_ground_truth.csv', img_dir=img_dir, shuffle = True, transform=transformations.tiling_val_uint8(), res = res, spec = spec)
+		model = nets.resnet50_train_tiling(num_classes, res = res, pool_after = False, spec = spec, pooling = pooling)
+		if not ActivationStore.is_complete(cache_dir, res, CACHE_STAGE, dataset.spec, dataset.image_size(), len(dataset),
+										   data_digest(dataset.img_ids, dataset.img_labels), stage_digest(model, CACHE_STAGE)):
+			print('exporting %s activations to %s' % (CACHE_STAGE, cache_dir))
+			export_activations(model, dataset, cache_dir, CACHE_STAGE, batch_size, num_workers, device)
+		store = ActivationStore(cache_dir)
+		path_data_train = CachedActivationDataset(store)
+		path_data_val = CachedActivationDataset(store)
+		collate_fn = collate_tiles
 
 	# initialize acc vector for cv results 
 	acc = np.zeros((k,))
@@ -245,8 +345,27 @@ def train_network(ssh = True, op = 'SGD'):
 	# fold counter
 	counter = 0
 
-	# k-fold eval
-	for train_idx, test_idx in k_folds_2(n_splits = k):
+	if FC1_SOLVER:
+		return train_network_solver(path_data_val, results_dir, collate_fn)
+
+	batch = batch_size
+	if AUTO_BATCH and CACHE_STAGE is None:
+		model = nets.resnet50_train_tiling(num_classes, res = res, pool_after = False, spec = spec, pooling = pooling,
+										   unfreeze = unfreeze, recompute_argmax = recompute_argmax, freeze_bn = FREEZE_BN).to(device = device)
+		# the size the training images are decoded to (decode_size, else the file header)
+		image_shape = (3,) + tuple(path_data_train.image_size())
+		plan = memory_planner.plan(model, image_shape, dtype, train = True, optimizer_states = 2 if op == 'Adam' else 1, measure = True)
+		batch = plan['batch_size']
+		print('memory plan: batch size %d, estimated peak %.2f GB of %.2f GB' % (batch, plan['estimate'] / 2.0**30, plan['budget'] / 2.0**30))
+		del model
+
+	### data loaders are created once, each fold only swaps the index sets
+	loaders = FoldLoaders(path_data_train, path_data_val, batch_size = batch, num_workers = num_workers, prefetch_factor = prefetch_factor, collate_fn = collate_fn,
+						  importance = IMPORTANCE)
+
+	# k-fold eval, fold assignments are persisted so reruns reuse identical splits
+	fold_file = os.path.join(results_dir, 'folds.npz')
+	for train_idx, test_idx in load_folds(fold_file, path_data_train.img_labels, n_splits = k):
 		### tensor log directory
 		log_dir = os.path.join(results_dir, 'results_' + str(counter))
 		if not os.path.exists(log_dir):
@@ -255,14 +374,17 @@ def train_network(ssh = True, op = 'SGD'):
 		print('training and evaluating fold ', counter)
 		### result file
 
-		filename = os.path.join(results_dir, 'results_' + str(counter) + '.csv')
+		filename = os.path.join(results_dir, 'results_' + str(counter) + '.cols')
 		
-		### initialize data loaders
-		loader_train = torch.utils.data.DataLoader(dataset = path_data_train, batch_size = batch_size, sampler = sampler.SubsetRandomSampler(train_idx),num_workers=4)
-		loader_val = torch.utils.data.DataLoader(dataset = path_data_val, batch_size = batch_size, sampler = sampler.SubsetRandomSampler(test_idx), num_workers=4)
-		loaders = {'train': loader_train, 'val': loader_val}
+		### point data loaders at this fold
+		loaders.set_fold(train_idx, test_idx)
 		### initialize model
-		model = nets.resnet50_train_tiling(num_classes, res = [0,1,2], pool_after = False)
+		model = nets.resnet50_train_tiling(num_classes, res = res, pool_after = False, spec = spec, pooling = pooling,
+										   unfreeze = unfreeze, recompute_argmax = recompute_argmax, freeze_bn = FREEZE_BN)
+		model.trunk_chunk = trunk_chunk
+		checkpoint = model
+		if CACHE_STAGE is not None:
+			model = CachedStageModel(model, CACHE_STAGE)
 		print(model)
 		print()
 
@@ -285,10 +407,36 @@ def train_network(ssh = True, op = 'SGD'):
 
 		### call training/eval
 		acc[counter] = train_loop(model, loaders, optimizer, epochs=EPOCH, filename=filename, log_dir=log_dir, scheduler = scheduler)
+		torch.save(checkpoint.state_dict(), os.path.join(results_dir, 'model_' + str(counter) + '.pt'))
 
 		### update counter
 		counter+=1
 	
+	print('loader startup overhead (s): ', loaders.startup_report())
+	loaders.close()
+	print('k-fold CV accuracy: ', acc)
+	print('final mean accuracy: ', np.mean(acc))
+
+
+def train_network_solver(dataset, results_dir, collate_fn = None):
+	### frozen trunk: pooled features are computed once (without augmentation), fc1 of every fold is a full-batch fit
+	model = nets.resnet50_train_tiling(num_classes, res = res, pool_after = False, spec = spec, pooling = pooling)
+	features = fc1_solver.pooled_features(model, dataset, batch_size, num_workers, device, collate_fn)
+	labels = np.asarray(dataset.img_labels, dtype = np.int64)
+
+	acc = np.zeros((k,))
+	fold_file = os.path.join(results_dir, 'folds.npz')
+	for counter, (train_idx, test_idx) in enumerate(load_folds(fold_file, labels, n_splits = k)):
+		print('fitting fold ', counter)
+		weight, bias, loss = fc1_solver.fit_fc1(features[train_idx], labels[train_idx], weight_decay, num_classes)
+		probs = fc1_solver.predict_proba(features[test_idx], weight, bias)
+		preds = probs.argmax(1)
+		with ResultsWriter(os.path.join(results_dir, 'results_' + str(counter) + '.cols'), num_classes) as results:
+			results.append(probs, labels[test_idx], preds, dataset.img_ids[test_idx])
+		acc[counter] = np.mean(preds == labels[test_idx])
+		print('training loss %.4f, got %d / %d correct (%.2f)' % (loss, np.sum(preds == labels[test_idx]), len(test_idx), 100 * acc[counter]))
+		fc1_solver.write_checkpoint(model, weight, bias, os.path.join(results_dir, 'model_' + str(counter) + '.pt'))
+
 	print('k-fold CV accuracy: ', acc)
 	print('final mean accuracy: ', np.mean(acc))
 
@@ -307,5 +455,11 @@ def test_cv(dset1, dset2):
 
 
 
-
-train_network()
+if __name__ == '__main__':
+	if AUTOTUNE:
+		tuned = autotune.apply()
+		if tuned is not None:
+			print('autotune profile %s: %d threads, %d inter-op threads' % (tuned['host'], tuned['num_threads'], tuned['num_interop_threads']))
+			num_workers = tuned['num_workers'] if tuned['num_workers'] is not None else num_workers
+			trunk_chunk = tuned['trunk_batch']
+	train_network()
@@ -71,5 +71,13 @@ def tiling_val():
 															std=[0.229, 0.224, 0.225])])
 	return transformation
 
+def tiling_train_uint8():
+	""" tiling_train without normalization, tiles are cut in the workers and normalized on device """
+	transformation = transforms.Compose([transforms.RandomVerticalFlip(),
+										transforms.RandomHorizontalFlip(),
+										transforms.PILToTensor()])
+	return transformation
 
-
+def tiling_val_uint8():
+	transformation = transforms.PILToTensor()
+	return transformation